@@ -0,0 +1,198 @@
+"""
+Orquestador SAGA nativo de asyncio.
+
+Produce las mismas transiciones de estado y los mismos registros en
+saga_metrics que SagaOrchestrator, pero los pasos se ejecutan con
+execute_async/rollback_async y el backoff usa asyncio.sleep, así que un
+solo proceso puede tener miles de sagas en vuelo.
+"""
+from state import SagaState
+from metrics import saga_metrics
+from orchestrator import SagaGraph, build_dlq_message, reject_open_circuit
+from circuit_breaker import get_breaker
+from dlq import get_dlq_publisher
+import asyncio
+import time
+
+
+class AsyncSagaOrchestrator(SagaGraph):
+
+    async def _attempt(self, step, phase="execute"):
+        if not get_breaker(step.name).allow():
+            return reject_open_circuit(step)
+        started_at = time.perf_counter()
+        try:
+            return await step.execute_async()
+        except Exception as e:
+            self.logger.warning("❌ Error en %s (%s): %s", step.name, phase, e,
+                                extra={"step": step.name})
+            return {"status": False}
+        finally:
+            saga_metrics.record_step_time(step.name, phase,
+                                          time.perf_counter() - started_at)
+
+    async def _run_step(self, step):
+        """Ejecuta un paso con sus reintentos; retorna (status, última respuesta)"""
+        self.logger.debug("➡️ Ejecutando paso: %s", step.name, extra={"step": step.name})
+        # Write-ahead: el comando sale después del commit de STEP_STARTED
+        committed = self.log_started(step)
+        if committed is not None:
+            await asyncio.wrap_future(committed)
+
+        response = await self._attempt(step)
+        status = response["status"]
+
+        if not status:
+            policy = step.retry_policy
+
+            for attempt in range(1, policy.max_retries + 1):
+                # Si otra rama ya falló, la saga se va a compensar; con el
+                # circuito abierto reintentar solo agrega timeouts
+                if self.aborted or get_breaker(step.name).is_open():
+                    break
+
+                wait_time = policy.delay_before(attempt)
+                if wait_time > 0:
+                    self.logger.debug("⏱ Esperando %.2fs antes del siguiente retry...",
+                                      wait_time, extra={"step": step.name})
+                    await asyncio.sleep(wait_time)
+
+                saga_metrics.record_retry()
+                self.logger.info("🔄 Retry %d/%d en %s", attempt, policy.max_retries,
+                                 step.name, extra={"step": step.name})
+
+                response = await self._attempt(step, "retry")
+                status = response["status"]
+                if status:
+                    self.logger.info("✅ Éxito en retry %d", attempt, extra={"step": step.name})
+                    break
+
+        return status, response
+
+    async def _run_graph(self):
+        """
+        Igual que SagaOrchestrator._submit_graph, con una tarea por rama: si
+        un paso falla (o lanza) no se lanzan pasos nuevos, pero se espera a
+        las ramas en vuelo para poder compensarlas.
+        """
+        finished = {step.name for step in self.completed}
+        started = set(finished)
+        running = {}
+        failure = None
+
+        try:
+            while True:
+                if failure is None:
+                    for step in self.ready_steps(finished, started):
+                        started.add(step.name)
+                        running[asyncio.ensure_future(self._run_step(step))] = step
+                if not running:
+                    return failure
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    step = running.pop(task)
+                    try:
+                        status, response = task.result()
+                        if status:
+                            self.mark_completed(step)
+                            finished.add(step.name)
+                    except Exception as e:
+                        # P.ej. el saga log no confirmó STEP_STARTED
+                        self.logger.exception("❌ Error en %s: %s", step.name, e,
+                                              extra={"step": step.name})
+                        status, response = False, {"status": False, "error": repr(e)}
+                    if not status and failure is None:
+                        failure = (step, response)
+                        self.aborted = True
+        finally:
+            # Si la espera se interrumpe (p.ej. la saga se cancela), las ramas
+            # en vuelo terminan antes de que execute_saga compense
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    async def execute_saga(self):
+
+        saga_metrics.record_saga_start()
+        start_time = time.time()
+
+        self.logger.info("☸️ Iniciando Saga Orchestrator (asyncio)...")
+        self.start()
+
+        try:
+            failure = await self._run_graph()
+
+            if failure is not None:
+                step, response = failure
+                self.logger.error("❌ Fallo definitivo en %s tras retries", step.name,
+                                  extra={"step": step.name})
+                self.mark_failed(step)
+                await self.send_to_dlq(step, response)
+                await self.compensate()
+
+                execution_time = time.time() - start_time
+                saga_metrics.record_saga_failure(
+                    step.name, execution_time)
+                self.set_state(SagaState.COMPENSATED)
+                return
+
+            execution_time = time.time() - start_time
+            saga_metrics.record_saga_success(execution_time)
+            self.set_state(SagaState.SUCCEEDED)
+            self.logger.info("✅ Saga completada")
+
+        except Exception as e:
+            self.logger.exception("❌ Error inesperado en saga: %s", e)
+            await self.compensate()
+
+            execution_time = time.time() - start_time
+            saga_metrics.record_saga_failure("Exception", execution_time)
+            self.set_state(SagaState.COMPENSATED)
+
+    async def compensate(self):
+        compensation_start = time.time()
+        self.logger.info("🔁 Iniciando compensación...")
+        self.set_state(SagaState.COMPENSATING)
+
+        for step in reversed(self.completed):
+            started_at = time.perf_counter()
+            await step.rollback_async()
+            saga_metrics.record_step_time(step.name, "rollback",
+                                          time.perf_counter() - started_at)
+            self.mark_compensated(step)
+
+        compensation_time = time.time() - compensation_start
+        saga_metrics.record_compensation_time(compensation_time)
+
+        self.logger.info("✅ Compensación completada")
+
+    async def send_to_dlq(self, step, last_response):
+        """Envía el paso fallido al DLQ para análisis posterior"""
+        dlq_message = build_dlq_message(step, last_response)
+
+        # Solo encola (ver dlq.DLQPublisher); no espera al broker
+        get_dlq_publisher().publish(dlq_message)
+
+        # Registrar mensaje enviado al DLQ
+        saga_metrics.record_dlq()
+        self.logger.info("Paso fallido enviado a DLQ: %s", step.name, extra={"step": step.name})
+
+
+async def run_sagas(payloads, concurrency=1000):
+    """
+    Ejecuta un conjunto de sagas en el event loop actual con como máximo
+    `concurrency` sagas en vuelo. Retorna los orquestadores en el mismo
+    orden que los payloads.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(raw_data):
+        async with semaphore:
+            saga = AsyncSagaOrchestrator()
+            saga.send_data(raw_data)
+            await saga.execute_saga()
+            return saga
+
+    return await asyncio.gather(*(run_one(data) for data in payloads))
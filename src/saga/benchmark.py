@@ -0,0 +1,232 @@
+"""
+Benchmark de punta a punta del orquestador SAGA.
+
+Ejecuta N sagas con una concurrencia y una proporción de fallos dadas,
+contra RabbitMQ (con message_broker.py corriendo) o contra el transporte
+en memoria (transport.InMemoryTransport), que llama directamente a los
+handlers de message_broker sobre bases SQLite temporales. El resultado es el reporte de SagaMetrics más
+throughput y configuración, guardado con save_with_history para que dos
+corridas se puedan comparar con calculate_trends.
+
+    python benchmark.py -n 1000 --concurrency 64 --failure-ratio 0.1 --broker memory
+"""
+from orchestrator import SagaOrchestrator, SAGA_DEFINITION
+from async_orchestrator import AsyncSagaOrchestrator
+from initialize_databases import initialize_database_by_type, database_types
+from transport import InMemoryTransport, set_transport, get_transport
+from codec import CODECS, SAGA_CODEC
+from storage import Storage, STORAGE_MODES
+from db_pool import connections
+from dlq import get_dlq_publisher
+from metrics import saga_metrics
+from logger import ROOT_LOGGER, set_level, flush as flush_logs
+from retry import RetryPolicy
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+BENCHMARK_FILE = "benchmark_metrics.json"
+
+
+def build_payloads(n, failure_ratio, seed=None):
+    """Payloads de saga; una fracción `failure_ratio` falla en un paso al azar"""
+    rng = random.Random(seed)
+    payloads = []
+    for i in range(n):
+        fail = [False] * len(SAGA_DEFINITION)
+        if rng.random() < failure_ratio:
+            fail[rng.randrange(len(fail))] = True
+        payloads.append({
+            "user": {"id": str(uuid.uuid4()), "name": f"bench-{i}",
+                     "email": f"bench-{i}@example.com"},
+            "permissions": ["read", "write"],
+            "quota": {"storage_gb": 10, "ops_per_month": 1000},
+            "fail": fail
+        })
+    return payloads
+
+
+# BROKER EN MEMORIA
+
+def use_memory_transport(db_dir, latency=0.0, codec=None, layout=None):
+    """
+    Cambia el transporte del proceso por colas en memoria que llaman
+    directamente a los handlers del broker, con las tablas en `db_dir`
+    (en bases separadas o en un solo archivo según `layout`).
+    """
+    layout = layout or connections.storage
+    initialize_database_by_type(database_types, db_dir, layout)
+    connections.db_dir = db_dir
+    connections.storage = layout
+    transport = InMemoryTransport(latency=latency, codec=codec)
+    set_transport(transport)
+    return transport
+
+
+# EJECUCIÓN
+
+def run_threads(orchestrator_cls, payloads, concurrency, retry_policies):
+    """Como máximo `concurrency` sagas en vuelo sobre el pool de pasos"""
+    window = threading.BoundedSemaphore(concurrency)
+    futures = []
+    for raw_data in payloads:
+        window.acquire()
+        saga = orchestrator_cls()
+        saga.send_data(raw_data, retry_policies=retry_policies)
+        future = saga.submit()
+        future.add_done_callback(lambda _: window.release())
+        futures.append(future)
+    return [future.result() for future in futures]
+
+
+async def run_asyncio(orchestrator_cls, payloads, concurrency, retry_policies):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(raw_data):
+        async with semaphore:
+            saga = orchestrator_cls()
+            saga.send_data(raw_data, retry_policies=retry_policies)
+            await saga.execute_saga()
+            return saga.state
+
+    return await asyncio.gather(*(run_one(raw_data) for raw_data in payloads))
+
+
+def run_benchmark(sagas, concurrency=16, failure_ratio=0.0, broker="memory",
+                  engine="threads", base_delay=0.01, max_retries=5,
+                  latency=0.0, db_dir=None, seed=None, codec=None, storage=None):
+    """Ejecuta el benchmark y retorna el reporte (get_report + throughput)"""
+    previous_transport = get_transport()
+    previous_storage = connections.storage
+    layout = Storage(storage) if storage else previous_storage
+    if broker == "memory":
+        transport = use_memory_transport(db_dir or tempfile.mkdtemp(prefix="saga-bench-"),
+                                         latency, codec, layout)
+
+    retry_policies = {step_type: RetryPolicy(max_retries=max_retries, base_delay=base_delay)
+                      for step_type, _ in SAGA_DEFINITION}
+    payloads = build_payloads(sagas, failure_ratio, seed)
+
+    saga_metrics.reset()
+    start_time = time.perf_counter()
+    try:
+        if engine == "asyncio":
+            asyncio.run(run_asyncio(AsyncSagaOrchestrator, payloads, concurrency, retry_policies))
+        else:
+            run_threads(SagaOrchestrator, payloads, concurrency, retry_policies)
+        wall_time = time.perf_counter() - start_time
+        # El DLQ se publica en segundo plano: que termine antes de cambiar el transporte
+        get_dlq_publisher().flush()
+    finally:
+        if broker == "memory":
+            transport.close()
+            set_transport(previous_transport)
+            connections.storage = previous_storage
+
+    report = saga_metrics.get_report()
+    report.update(benchmark_fields(sagas, wall_time, {
+        'sagas': sagas, 'concurrency': concurrency, 'failure_ratio': failure_ratio,
+        'broker': broker, 'engine': engine, 'base_delay': base_delay,
+        'max_retries': max_retries, 'latency': latency, 'codec': codec or SAGA_CODEC,
+        'storage': layout.mode,
+    }))
+    return report
+
+
+def benchmark_fields(sagas, wall_time, config):
+    """Campos que el benchmark agrega al reporte de SagaMetrics"""
+    return {
+        'throughput': f"{sagas / wall_time:.2f}" if wall_time else "0",
+        'wall_time': f"{wall_time:.2f}s",
+        'total_retries': saga_metrics.data['total_retries'],
+        'config': config,
+    }
+
+
+def print_summary(report):
+    print("\n" + "="*60)
+    print(" BENCHMARK SAGA")
+    print("="*60)
+    config = report['config']
+    print(f"Sagas:                        {config['sagas']} "
+          f"(concurrencia {config['concurrency']}, fallos {config['failure_ratio']:.0%}, "
+          f"{config['broker']}/{config['engine']})")
+    print(f"Tiempo total:                 {report['wall_time']}")
+    print(f"Throughput:                   {report['throughput']} sagas/s")
+    print(f"Reintentos:                   {report['total_retries']}")
+    saga_metrics.print_report()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de throughput del orquestador SAGA")
+    parser.add_argument("-n", "--sagas", type=int, default=1000,
+                        help="Cantidad de sagas a ejecutar")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="Sagas en vuelo como máximo")
+    parser.add_argument("--failure-ratio", type=float, default=0.0,
+                        help="Fracción de sagas con un paso que falla (0-1)")
+    parser.add_argument("--broker", choices=["memory", "rabbitmq"], default="memory",
+                        help="memory: handlers en proceso; rabbitmq: requiere message_broker.py")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="SagaOrchestrator (threads) o AsyncSagaOrchestrator (asyncio)")
+    parser.add_argument("--base-delay", type=float, default=0.01,
+                        help="Delay base del backoff de reintentos, en segundos")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Latencia simulada por mensaje con --broker memory")
+    parser.add_argument("--codec", choices=sorted(CODECS), default=None,
+                        help="Codec de los mensajes con --broker memory (por defecto, SAGA_CODEC)")
+    parser.add_argument("--storage", choices=STORAGE_MODES, default=None,
+                        help="Bases separadas o un solo archivo con --broker memory "
+                             "(por defecto, SAGA_STORAGE)")
+    parser.add_argument("--db-dir", default=None,
+                        help="Directorio de las bases con --broker memory (por defecto, uno temporal)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=BENCHMARK_FILE,
+                        help="Archivo JSON del resultado; la corrida anterior queda en *_previous.json")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Muestra la salida de cada saga (más lento)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # La salida por saga domina el tiempo de CPU; se descarta salvo --verbose
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+            previous_level = logging.getLogger(ROOT_LOGGER).level
+            set_level(logging.WARNING)
+            stack.callback(set_level, previous_level)
+            # Lo que quedó en la cola de logs se escribe antes de restaurar stdout
+            stack.callback(flush_logs)
+        report = run_benchmark(args.sagas, args.concurrency, args.failure_ratio,
+                               args.broker, args.engine, args.base_delay,
+                               args.max_retries, args.latency, args.db_dir, args.seed,
+                               args.codec, args.storage)
+
+    print_summary(report)
+    saga_metrics.save_with_history(args.output, extra={
+        key: report[key] for key in ('throughput', 'wall_time', 'total_retries', 'config')
+    })
+
+    trends = saga_metrics.calculate_trends(args.output.replace('.json', '_previous.json'),
+                                           current=report)
+    if trends:
+        print("📊 Trends (comparado con la corrida anterior):")
+        icons = {'mejora': '📈', 'empeora': '📉', 'igual': '➡️'}
+        for metric, trend in trends.items():
+            print(f"   {icons[trend]} {metric}: {trend}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
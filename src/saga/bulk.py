@@ -0,0 +1,221 @@
+"""
+API de envío masivo de sagas.
+
+En lugar de un mensaje AMQP y un INSERT por paso y por saga, agrupa los
+pasos del mismo tipo de todas las sagas en un comando por lotes
+(p.ej. ProvisionUserBatch), que el broker resuelve con un executemany en
+una sola transacción. Con SAGA_STORAGE=single los tres pasos de cada
+saga van juntos en un ProvisionAccountBatch, que escribe usuario,
+permisos y cuota de todo el lote en una sola transacción; las cuentas
+que fallan siguen por los lotes de cada paso. Solo los ítems que fallan
+siguen el camino individual: reintentos, DLQ y compensación por saga.
+"""
+from orchestrator import SagaOrchestrator
+from state import SagaState
+from steps import rpc_call_many
+from metrics import saga_metrics
+from storage import storage
+from logger import get_logger
+from concurrent.futures import Future
+import time
+
+BULK_CHUNK_SIZE = 500
+BULK_TIMEOUT = 30.0
+
+logger = get_logger("bulk")
+
+
+def _batch_event(step_name, steps):
+    # Cada ítem lleva la clave de su saga y paso: un lote reenviado tras un
+    # timeout, o el reintento individual de un ítem, no escribe dos veces
+    return {
+        "type": f"{step_name}Batch",
+        "data": {"items": [step.keyed_command()["data"] for step in steps]}
+    }
+
+
+def _mark_started(pairs):
+    """STEP_STARTED de cada (saga, paso), confirmado antes de enviar el lote"""
+    committed = [saga.log_started(step) for saga, step in pairs]
+    for future in committed:
+        if future is not None:
+            future.result()
+
+
+def _account_event(sagas):
+    items = []
+    for saga in sagas:
+        keys = {}
+        for step in saga.steps:
+            event = step.keyed_command()
+            keys[event["type"]] = event["data"].get("idempotency_key")
+        items.append(dict(saga.raw_data, idempotency_keys=keys))
+    return {"type": "ProvisionAccountBatch", "data": {"items": items}}
+
+
+# Campo de la respuesta de ProvisionAccountBatch con el id de cada paso
+ACCOUNT_IDS = {"ProvisionUser": "id", "AssignPermissions": "permissions_id",
+               "CreateQuota": "quota_id"}
+
+
+def _provision_accounts(sagas):
+    """
+    Escribe las tres filas de cada saga con un solo ProvisionAccountBatch y
+    retorna los índices de las sagas que siguen por los lotes de cada paso.
+    """
+    try:
+        _mark_started([(saga, step) for saga in sagas for step in saga.steps])
+        response = rpc_call_many([_account_event(sagas)], timeout=BULK_TIMEOUT)[0]
+    except Exception as e:
+        # Las cuentas siguen por los lotes de cada paso, que manejan su propio error
+        logger.error("❌ Falló el lote de cuentas: %s", e)
+        return list(range(len(sagas)))
+    pending = []
+    for i, result in enumerate(_item_results(response, len(sagas))):
+        if result.get('status') != 'ok':
+            pending.append(i)
+            continue
+        # Cada paso guarda su id para el rollback, como con su respuesta individual
+        for step in sagas[i].steps:
+            step.handle_result({'status': 'ok', 'id': result[ACCOUNT_IDS[step.name]]})
+            sagas[i].mark_completed(step)
+    return pending
+
+
+def _item_results(response, size):
+    """Respuestas por ítem; si el lote entero falló, todas cuentan como error"""
+    if not response or response.get('status') != 'ok':
+        return [response or {'status': 'error', 'detail': 'sin respuesta'}] * size
+    return response['results']
+
+
+def _run_level(sagas, steps_by_name, level, active, failures):
+    """
+    Un lote por paso del nivel. El lote cuenta como el intento 0 de cada
+    ítem: los fallidos siguen desde el primer reintento de su política.
+    """
+    step_names = [step.name for step in level]
+    _mark_started([(sagas[i], steps_by_name[i][name])
+                   for name in step_names for i in active])
+    # Los lotes de un mismo nivel son independientes y van en paralelo
+    events = [_batch_event(name, [steps_by_name[i][name] for i in active])
+              for name in step_names]
+    responses = rpc_call_many(events, timeout=BULK_TIMEOUT)
+
+    retry = []
+    for name, response in zip(step_names, responses):
+        for i, result in zip(active, _item_results(response, len(active))):
+            step = steps_by_name[i][name]
+            try:
+                ok = step.handle_result(result)["status"]
+            except Exception:
+                ok = False
+            if ok:
+                sagas[i].mark_completed(step)
+            elif step.retry_policy.max_retries > 0:
+                retry.append((i, step))
+            elif i not in failures:
+                failures[i] = (step, result)
+
+    # Los ítems fallidos se reintentan uno a uno con la política normal;
+    # las esperas de backoff no ocupan workers
+    futures = []
+    for i, step in retry:
+        try:
+            futures.append(sagas[i].submit_step(step, attempt=1))
+        except Exception as e:
+            # Se espera a los reintentos ya lanzados antes de salir del nivel
+            futures.append(Future())
+            futures[-1].set_exception(e)
+    for (i, step), future in zip(retry, futures):
+        try:
+            status, response = future.result()
+        except Exception as e:
+            status, response = False, {"status": False, "error": repr(e)}
+        if status:
+            sagas[i].mark_completed(step)
+        elif i not in failures:
+            failures[i] = (step, response)
+
+
+def _run_chunk(payloads, retry_policies=None):
+    sagas, steps_by_name = [], []
+    for raw_data in payloads:
+        saga = SagaOrchestrator()
+        saga.send_data(raw_data, retry_policies=retry_policies)
+        saga_metrics.record_saga_start()
+        saga.start()
+        sagas.append(saga)
+        steps_by_name.append({step.name: step for step in saga.steps})
+
+    # índice de la saga -> (paso fallido, última respuesta)
+    failures = {}
+    start_time = time.time()
+    pending = range(len(sagas))
+    if storage.single and sagas:
+        pending = _provision_accounts(sagas)
+
+    # Todas las sagas comparten la definición: se recorre por niveles
+    for level in sagas[0].levels() if pending else []:
+        active = [i for i in pending if i not in failures]
+        if not active:
+            break
+        try:
+            _run_level(sagas, steps_by_name, level, active, failures)
+        except Exception as e:
+            # P.ej. el broker no responde: los pasos del nivel que no llegaron a
+            # completarse fallan y sus sagas se compensan como las demás
+            logger.error("❌ Falló el nivel %s del lote: %s",
+                         [step.name for step in level], e)
+            for i in active:
+                done = {step.name for step in sagas[i].completed}
+                step = next((steps_by_name[i][level_step.name] for level_step in level
+                             if level_step.name not in done), None)
+                if step is not None and i not in failures:
+                    failures[i] = (step, {"status": False, "error": repr(e)})
+
+    execution_time = time.time() - start_time
+    outcomes = []
+    for i, saga in enumerate(sagas):
+        failed_step = None
+        if i not in failures:
+            saga_metrics.record_saga_success(execution_time)
+            saga.set_state(SagaState.SUCCEEDED)
+        else:
+            step, response = failures[i]
+            failed_step = step.name
+            saga.mark_failed(step)
+            saga.send_to_dlq(step, response)
+            saga_metrics.record_saga_failure(step.name, execution_time)
+            try:
+                saga.compensate()
+                saga.set_state(SagaState.COMPENSATED)
+            except Exception as e:
+                # Queda en COMPENSATING en el saga log: la recuperación la termina
+                saga.logger.exception("❌ Compensación incompleta: %s", e)
+
+        outcomes.append({
+            'user_id': saga.steps[0].data.get('user', {}).get('id'),
+            'state': saga.state.value,
+            'failed_step': failed_step,
+        })
+    return outcomes
+
+
+def run_bulk(payloads, chunk_size=BULK_CHUNK_SIZE, retry_policies=None):
+    """
+    Ejecuta un iterable de payloads de saga en lotes de `chunk_size` y
+    retorna un resultado por saga, en el mismo orden:
+    {'user_id': ..., 'state': 'SUCCEEDED' | 'COMPENSATED', 'failed_step': ...}
+    `retry_policies` se aplica a los reintentos individuales (ver
+    SagaGraph.send_data).
+    """
+    outcomes, chunk = [], []
+    for raw_data in payloads:
+        chunk.append(raw_data)
+        if len(chunk) >= chunk_size:
+            outcomes.extend(_run_chunk(chunk, retry_policies))
+            chunk = []
+    if chunk:
+        outcomes.extend(_run_chunk(chunk, retry_policies))
+    return outcomes
@@ -0,0 +1,154 @@
+"""
+Circuit breaker por tipo de paso.
+
+Cuenta las llamadas al broker de cada paso en una ventana deslizante
+(buckets de un segundo). Si la tasa de fallos supera el umbral, el
+circuito se abre y el orquestador deja de llamar a ese servicio: las
+sagas fallan en el acto y van directo a compensación y DLQ, en lugar de
+gastar 1 + max_retries timeouts cada una. Pasado `open_seconds` el
+circuito queda semiabierto y deja pasar una sola llamada de prueba: si
+responde se cierra, si no vuelve a abrirse.
+
+Solo cuentan como fallo las llamadas sin respuesta (timeout o error de
+transporte). Una respuesta de error del broker significa que el servicio
+está respondiendo, así que no abre el circuito.
+"""
+from collections import deque
+from enum import Enum
+import os
+import threading
+import time
+
+from logger import get_logger
+
+BREAKER_WINDOW = float(os.getenv("SAGA_BREAKER_WINDOW", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("SAGA_BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("SAGA_BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("SAGA_BREAKER_OPEN_SECONDS", "30"))
+
+logger = get_logger("circuit_breaker")
+
+# Respuesta del paso cuando el circuito rechaza la llamada
+CIRCUIT_OPEN = "circuit_open"
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+# Valor numérico para exportar como gauge
+BREAKER_STATE_VALUES = {BreakerState.CLOSED: 0, BreakerState.HALF_OPEN: 1, BreakerState.OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, open_seconds=BREAKER_OPEN_SECONDS,
+                 clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self._state = BreakerState.CLOSED
+        # [segundo, llamadas, fallos], del más viejo al más nuevo
+        self._buckets = deque()
+        self._opened_at = 0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            self._refresh(self.clock())
+            return self._state
+
+    def is_open(self):
+        return self.state == BreakerState.OPEN
+
+    def allow(self):
+        """True si se puede llamar al servicio; en semiabierto, una prueba a la vez"""
+        with self._lock:
+            now = self.clock()
+            self._refresh(now)
+            if self._state == BreakerState.CLOSED:
+                return True
+            if self._state == BreakerState.OPEN:
+                return False
+            # Una prueba que nunca registró resultado (p.ej. excepción antes
+            # del RPC) no bloquea el circuito para siempre
+            if self._probe_started is None or now - self._probe_started >= self.open_seconds:
+                self._probe_started = now
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            now = self.clock()
+            self._refresh(now)
+            if self._state == BreakerState.HALF_OPEN:
+                if success:
+                    self._transition(BreakerState.CLOSED, now)
+                else:
+                    self._transition(BreakerState.OPEN, now)
+                return
+            if self._state == BreakerState.OPEN:
+                # Respuestas tardías de llamadas hechas antes de abrir
+                return
+
+            second = int(now)
+            if self._buckets and self._buckets[-1][0] == second:
+                bucket = self._buckets[-1]
+            else:
+                bucket = [second, 0, 0]
+                self._buckets.append(bucket)
+            bucket[1] += 1
+            if not success:
+                bucket[2] += 1
+
+            calls = sum(b[1] for b in self._buckets)
+            failures = sum(b[2] for b in self._buckets)
+            if calls >= self.min_calls and failures / calls >= self.failure_rate:
+                self._transition(BreakerState.OPEN, now)
+
+    def _refresh(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+        if self._state == BreakerState.OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(BreakerState.HALF_OPEN, now)
+
+    def _transition(self, state, now):
+        self._state = state
+        self._probe_started = None
+        if state == BreakerState.OPEN:
+            self._opened_at = now
+            logger.warning("⚡ Circuito abierto para %s durante %.0fs", self.name,
+                           self.open_seconds, extra={"step": self.name})
+        elif state == BreakerState.CLOSED:
+            self._buckets.clear()
+            logger.info("✅ Circuito cerrado para %s", self.name, extra={"step": self.name})
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name) -> CircuitBreaker:
+    """Breaker compartido del proceso para un tipo de paso"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def breaker_states():
+    """Estado actual de cada breaker: nombre -> 'closed' | 'open' | 'half_open'"""
+    return {name: breaker.state.value for name, breaker in list(_breakers.items())}
+
+
+def reset_breakers():
+    with _breakers_lock:
+        _breakers.clear()
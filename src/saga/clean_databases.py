@@ -1,20 +1,26 @@
 
 import sqlite3
+import os
+
+from db_pool import DB_DIR
+from storage import storage
 
 db_names = ["users", "permissions", "quotas"]
 
-def get_connection(db_type):
-        return sqlite3.connect(f'db/{db_type}.db')
+def get_connection(database, db_dir=DB_DIR):
+        return sqlite3.connect(os.path.join(db_dir, f'{database}.db'))
 
-def clean():
+def clean(db_dir=DB_DIR, layout=storage):
 
-    for db_name in db_names:
-        conn = get_connection(db_name)
+    for database, tables in layout.databases(db_names).items():
+        conn = get_connection(database, db_dir)
         cursor = conn.cursor()
-        cursor.execute(f"DELETE FROM {db_name};")
+        # Primero las tablas que referencian a users (FOREIGN KEY en modo single)
+        for db_name in reversed(tables):
+            cursor.execute(f"DELETE FROM {db_name};")
         conn.commit()
         cursor.close()
         conn.close()
 
 if __name__ == "__main__":
-    clean()
\ No newline at end of file
+    clean()
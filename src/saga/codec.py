@@ -0,0 +1,139 @@
+"""
+Codificación de los mensajes que viajan por el broker.
+
+JSON es el formato por defecto; con SAGA_CODEC=msgpack los comandos y
+mensajes publicados se codifican en MessagePack, más compacto y más
+rápido de decodificar. El formato viaja en el content_type de AMQP: el
+receptor decodifica según el content_type del mensaje (sin content_type,
+como publicaban las versiones anteriores, se asume JSON) y el worker
+responde en el mismo formato de la petición. Así un worker nuevo atiende
+a orquestadores viejos y nuevos; msgpack solo debe activarse en los
+emisores cuando todos los workers ya lo entienden.
+
+    python codec.py --iterations 100000   # micro-benchmark de los codecs
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - dependencia opcional
+    msgpack = None
+
+# Formato de los mensajes que este proceso envía
+SAGA_CODEC = os.getenv("SAGA_CODEC", "json")
+
+
+class JsonCodec:
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, message) -> bytes:
+        # Sin espacios: mismo JSON, menos bytes por mensaje
+        return json.dumps(message, separators=(",", ":")).encode()
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def _require(self):
+        if msgpack is None:
+            raise RuntimeError("El codec msgpack requiere msgpack (pip install msgpack)")
+
+    def encode(self, message) -> bytes:
+        self._require()
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, body):
+        self._require()
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec())}
+_BY_CONTENT_TYPE = {codec.content_type: codec for codec in CODECS.values()}
+
+
+def get_codec(name=None):
+    """Codec para enviar; por defecto el de SAGA_CODEC"""
+    name = name or SAGA_CODEC
+    if name not in CODECS:
+        raise ValueError(f"Codec desconocido: {name} (opciones: {', '.join(CODECS)})")
+    return CODECS[name]
+
+
+def codec_for(content_type):
+    """Codec de un mensaje recibido; sin content_type (o desconocido) es JSON"""
+    return _BY_CONTENT_TYPE.get(content_type, CODECS["json"])
+
+
+def decode(body, content_type=None):
+    return codec_for(content_type).decode(body)
+
+
+# MICRO-BENCHMARK
+
+def sample_messages():
+    """Mensajes representativos del tráfico del broker"""
+    user_id = str(uuid.uuid4())
+    return {
+        "comando": {"type": "ProvisionUser",
+                    "data": {"id": user_id, "name": "user-1234",
+                             "email": "user-1234@example.com", "fail": False}},
+        "permisos": {"type": "AssignPermissions",
+                     "data": {"user_id": user_id, "permissions": ["read", "write", "admin"],
+                              "fail": False}},
+        "respuesta": {"status": "ok", "id": user_id,
+                      "detail": f"Usuario {user_id} provisionado", "handler_time": 0.00123},
+        "dlq": {"type": "FailedStep", "step_name": "CreateQuota",
+                "step_data": {"user": {"id": user_id, "name": "user-1234",
+                                       "email": "user-1234@example.com"},
+                              "permissions": ["read", "write"],
+                              "quota": {"storage_gb": 10, "ops_per_month": 1000},
+                              "fail": [False, False, True], "user_id": user_id},
+                "last_response": {"status": False}, "timestamp": time.time(),
+                "retry_attempts": 5},
+    }
+
+
+def benchmark_codec(codec, message, iterations):
+    """(bytes, µs por encode, µs por decode) de un mensaje"""
+    body = codec.encode(message)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.encode(message)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.decode(body)
+    decode_time = time.perf_counter() - start
+    return len(body), encode_time / iterations * 1e6, decode_time / iterations * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara los codecs de mensajes del broker")
+    parser.add_argument("--iterations", type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    codecs = [CODECS["json"]] + ([CODECS["msgpack"]] if msgpack is not None else [])
+    if msgpack is None:
+        print("msgpack no está instalado: solo se mide JSON (pip install msgpack)")
+
+    results = {}
+    print(f"{'mensaje':<11}{'codec':<9}{'bytes':>7}{'encode µs':>12}{'decode µs':>12}")
+    for label, message in sample_messages().items():
+        for codec in codecs:
+            size, encode_us, decode_us = benchmark_codec(codec, message, args.iterations)
+            results[(label, codec.name)] = (size, encode_us, decode_us)
+            print(f"{label:<11}{codec.name:<9}{size:>7}{encode_us:>12.2f}{decode_us:>12.2f}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Conexiones SQLite persistentes para los handlers del broker.
+
+Cada hilo worker mantiene una conexión de larga duración por base de
+datos, en modo WAL y con un nivel de `synchronous` configurable. Como la
+conexión no se cierra tras cada comando, el caché de sentencias
+preparadas de sqlite3 se reutiliza entre mensajes. Con SAGA_STORAGE=single
+todas las tablas comparten la conexión a saga.db (ver storage.py).
+"""
+import os
+import sqlite3
+import threading
+
+from storage import storage as default_storage
+
+DB_DIR = os.getenv("SAGA_DB_DIR", "db")
+# NORMAL en WAL solo hace fsync en los checkpoints, no en cada commit
+SYNCHRONOUS = os.getenv("SAGA_DB_SYNCHRONOUS", "NORMAL")
+CACHED_STATEMENTS = 256
+BUSY_TIMEOUT_MS = 5000
+
+
+class ConnectionManager:
+    def __init__(self, db_dir=DB_DIR, synchronous=SYNCHRONOUS,
+                 cached_statements=CACHED_STATEMENTS, storage=None):
+        self.db_dir = db_dir
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self.storage = storage or default_storage
+        self._local = threading.local()
+
+    def path_for(self, db_type):
+        return self.storage.path_for(db_type, self.db_dir)
+
+    def _connections(self):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = {}
+            self._local.connections = connections
+        return connections
+
+    def open(self, path):
+        conn = sqlite3.connect(path, cached_statements=self.cached_statements)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        if self.storage.single:
+            # Solo en un archivo existe users(id) para las FOREIGN KEY
+            conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def get(self, db_type):
+        """Conexión del hilo actual para `db_type`, abierta una sola vez"""
+        connections = self._connections()
+        database = self.storage.database_for(db_type)
+        conn = connections.get(database)
+        if conn is None:
+            conn = self.open(self.path_for(db_type))
+            connections[database] = conn
+        return conn
+
+    def close_all(self):
+        """Cierra las conexiones del hilo actual"""
+        connections = self._connections()
+        for conn in connections.values():
+            conn.close()
+        connections.clear()
+
+
+# Instancia compartida por los handlers del broker
+connections = ConnectionManager()
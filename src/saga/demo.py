@@ -1,9 +1,28 @@
-from orchestrator import SagaOrchestrator
+from orchestrator import SagaOrchestrator, retry_scheduler, recover_sagas
 from metrics import saga_metrics
+from exporter import start_exporter, SAGA_METRICS_PORT
+import os
 import uuid
 
+# "compensate" o "resume": recupera las sagas sin terminar antes de arrancar.
+# Vacío por defecto, porque con otro orquestador escribiendo en el mismo log
+# sus sagas en curso también figuran como sin terminar
+SAGA_RECOVER_ON_START = os.getenv("SAGA_RECOVER_ON_START", "")
+
 
 def main():
+    if SAGA_METRICS_PORT:
+        start_exporter(SAGA_METRICS_PORT, gauges={
+            "saga_retries_pending": ("Reintentos esperando su backoff", None,
+                                     retry_scheduler.pending),
+        })
+
+    # Sin SAGA_RECOVER_ON_START la recuperación se corre aparte, con
+    # `python saga_log.py`, cuando ningún orquestador usa el mismo log
+    if SAGA_RECOVER_ON_START:
+        recovered = recover_sagas(mode=SAGA_RECOVER_ON_START)
+        print(f"Sagas recuperadas al iniciar: {len(recovered)}")
+
     print("\n" + "="*70)
     print(" DEMO: SAGA Orchestrator con Compensación Automática")
     print("="*70)
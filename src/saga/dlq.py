@@ -0,0 +1,211 @@
+"""
+Publicador del Dead Letter Queue.
+
+send_to_dlq solo encola el mensaje: un hilo en segundo plano los publica
+por lotes reutilizando la conexión del transporte. Si el broker no está
+disponible, el lote se agrega a un archivo local (una línea JSON por
+mensaje) y se vuelve a publicar más tarde, así que ningún fallo se
+pierde y las sagas que fallan no esperan al broker.
+"""
+from transport import get_transport
+from routing import DLQ_QUEUE_NAME
+from logger import get_logger
+import argparse
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+DLQ_SPILL_PATH = os.getenv("DLQ_SPILL_PATH", os.path.join("db", "dlq_spill.jsonl"))
+DLQ_BATCH_SIZE = int(os.getenv("DLQ_BATCH_SIZE", "100"))
+DLQ_FLUSH_INTERVAL = 0.05
+# Cada cuánto se reintenta publicar lo derramado a disco
+DLQ_REPLAY_INTERVAL = float(os.getenv("DLQ_REPLAY_INTERVAL", "30"))
+
+_STOP = object()
+
+logger = get_logger("dlq")
+
+
+class DLQPublisher:
+    def __init__(self, spill_path=DLQ_SPILL_PATH, batch_size=DLQ_BATCH_SIZE,
+                 flush_interval=DLQ_FLUSH_INTERVAL, replay_interval=DLQ_REPLAY_INTERVAL,
+                 transport=None):
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.replay_interval = replay_interval
+        # None = el transporte del proceso al momento de publicar
+        self.transport = transport
+        self.queue = queue.Queue()
+        self.published = 0
+        self.spilled = 0
+        self._next_replay = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _transport(self):
+        return self.transport or get_transport()
+
+    def publish(self, message):
+        """Encola el mensaje sin bloquear; lo publica el hilo del publicador"""
+        self._ensure_thread()
+        self.queue.put(message)
+
+    def flush(self):
+        """Bloquea hasta que todo lo encolado esté publicado o en disco"""
+        if self._thread is not None:
+            self.queue.join()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(_STOP)
+            thread.join()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="saga-dlq-publisher",
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self.replay_interval)
+            except queue.Empty:
+                self._replay_safely()
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is _STOP
+            messages = [message for message in batch if message is not _STOP]
+            try:
+                if messages:
+                    self._publish_or_spill(messages)
+            except Exception as e:
+                # Ni el broker ni el disco (p.ej. disco lleno): el lote se
+                # pierde, pero queda en el log y el hilo sigue vivo; si
+                # muriera, flush() y close() esperarían para siempre
+                logger.exception("No se pudieron publicar ni guardar %d mensajes del DLQ (%r): %s",
+                                 len(messages), e, json.dumps(messages, default=str))
+            finally:
+                self._replay_safely()
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _replay_safely(self):
+        try:
+            self._replay_if_due()
+        except Exception as e:
+            logger.exception("Error al reenviar el DLQ guardado en %s: %s", self.spill_path, e)
+            self._next_replay = time.monotonic() + self.replay_interval
+
+    def _publish_or_spill(self, messages):
+        # Con mensajes en disco no se publica por delante: se agregan detrás
+        # para conservar el orden, y se reintenta todo junto en el replay
+        if not os.path.exists(self.spill_path):
+            try:
+                self._transport().publish_many(DLQ_QUEUE_NAME, messages)
+                self.published += len(messages)
+                return
+            except Exception as e:
+                logger.warning("Broker no disponible para el DLQ (%r); guardando en %s",
+                               e, self.spill_path)
+                self._next_replay = time.monotonic() + self.replay_interval
+        self._spill(messages)
+
+    def _spill(self, messages):
+        directory = os.path.dirname(self.spill_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.spill_path, "a") as f:
+            for message in messages:
+                f.write(json.dumps(message) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.spilled += len(messages)
+
+    def _replay_if_due(self):
+        if time.monotonic() >= self._next_replay and os.path.exists(self.spill_path):
+            self.replay_spill()
+
+    def replay_spill(self):
+        """
+        Publica lo derramado a disco y retorna cuántos mensajes se enviaron.
+        Solo el hilo del publicador (o la CLI, con el publicador detenido)
+        escribe el archivo, así que no hay carreras con _spill.
+        """
+        if not os.path.exists(self.spill_path):
+            return 0
+        with open(self.spill_path) as f:
+            messages = [json.loads(line) for line in f if line.strip()]
+
+        sent = 0
+        try:
+            for i in range(0, len(messages), self.batch_size):
+                batch = messages[i:i + self.batch_size]
+                self._transport().publish_many(DLQ_QUEUE_NAME, batch)
+                sent += len(batch)
+        except Exception as e:
+            logger.warning("No se pudo reenviar el DLQ derramado (%r); se reintentará", e)
+            self._next_replay = time.monotonic() + self.replay_interval
+            # Se reescriben solo los que faltan, para no duplicar los ya enviados
+            self._rewrite(messages[sent:])
+            self.published += sent
+            return sent
+
+        os.remove(self.spill_path)
+        self.published += sent
+        logger.info("Reenviados %d mensajes del DLQ guardados en disco", sent)
+        return sent
+
+    def _rewrite(self, messages):
+        tmp_path = self.spill_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for message in messages:
+                f.write(json.dumps(message) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.spill_path)
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_dlq_publisher() -> DLQPublisher:
+    """Publicador compartido del proceso; al salir vacía lo pendiente"""
+    global _publisher
+    if _publisher is not None:
+        return _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = DLQPublisher()
+            atexit.register(_publisher.close)
+    return _publisher
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reenvía al DLQ los mensajes guardados en disco")
+    parser.add_argument("--spill-path", default=DLQ_SPILL_PATH)
+    args = parser.parse_args()
+
+    publisher = DLQPublisher(spill_path=args.spill_path)
+    print(f"Mensajes reenviados: {publisher.replay_spill()}")
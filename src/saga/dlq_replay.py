@@ -0,0 +1,274 @@
+"""
+Reprocesa los pasos fallidos del Dead Letter Queue.
+
+Lee saga_dlq por lotes, filtra por nombre de paso y ventana de tiempo, y
+vuelve a ejecutar cada mensaje como una saga nueva con el payload
+original. La concurrencia está acotada (sagas en vuelo) y el ritmo lo
+limita un token bucket, para no saturar los servicios que acaban de
+recuperarse. Cada mensaje reprocesado se confirma (ack) al terminar su
+saga: si vuelve a fallar, la propia saga lo reenvía al DLQ. Cada pasada
+lee solo los mensajes que había en la cola al empezar, así que esos
+reenvíos quedan para la próxima en lugar de reprocesarse sin fin. Los
+mensajes que no pasan el filtro, y los que no se pueden reprocesar (p.ej.
+sin step_data), se devuelven a la cola al final.
+
+Los mensajes derramados a disco por dlq.py no están en la cola todavía:
+reenviarlos antes con `python dlq.py`.
+
+    python dlq_replay.py --step CreateQuota --since 2024-05-01T10:00 --rate 20
+"""
+from orchestrator import SagaOrchestrator
+from routing import DLQ_QUEUE_NAME
+from transport import get_transport
+from metrics import saga_metrics
+from state import SagaState
+from logger import get_logger
+from datetime import datetime
+import argparse
+import queue
+import threading
+import time
+
+REPLAY_BATCH_SIZE = 100
+REPLAY_CONCURRENCY = 8
+# Sagas nuevas por segundo
+REPLAY_RATE = 20.0
+
+# Campos que agregan los pasos al ejecutarse; la saga nueva los regenera
+GENERATED_KEYS = ("user_id", "permision_id", "qt_id")
+
+logger = get_logger("dlq_replay")
+
+
+class TokenBucket:
+    """Hasta `burst` operaciones seguidas y `rate` por segundo sostenidas"""
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError(f"rate debe ser mayor que 0: {rate}")
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Bloquea hasta que haya un token disponible"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def parse_time(value):
+    """Epoch en segundos o fecha ISO 8601 (hora local)"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def positive_float(value):
+    """Tipo de argparse para --rate: con 0 el token bucket no avanza nunca"""
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"debe ser mayor que 0: {value}")
+    return number
+
+
+def matches(message, steps=None, since=None, until=None):
+    if not isinstance(message, dict) or message.get('type') != 'FailedStep':
+        return False
+    if steps and message.get('step_name') not in steps:
+        return False
+    timestamp = message.get('timestamp', 0)
+    if since is not None and timestamp < since:
+        return False
+    if until is not None and timestamp > until:
+        return False
+    return True
+
+
+def payload_from(message, keep_fail=False):
+    """
+    Payload de la saga nueva a partir de step_data. Las marcas de fallo
+    simulado se limpian salvo keep_fail, para que el reproceso no repita
+    el mismo fallo a propósito.
+    """
+    raw_data = {key: value for key, value in message['step_data'].items()
+                if key not in GENERATED_KEYS}
+    if not keep_fail and 'fail' in raw_data:
+        raw_data['fail'] = [False] * len(raw_data['fail'])
+    return raw_data
+
+
+class DLQReplayer:
+    def __init__(self, transport=None, batch_size=REPLAY_BATCH_SIZE,
+                 concurrency=REPLAY_CONCURRENCY, rate=REPLAY_RATE, steps=None,
+                 since=None, until=None, limit=None, keep_fail=False,
+                 orchestrator_cls=SagaOrchestrator):
+        self.transport = transport or get_transport()
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate)
+        self.steps = set(steps or ())
+        self.since = since
+        self.until = until
+        self.limit = limit
+        self.keep_fail = keep_fail
+        self.orchestrator_cls = orchestrator_cls
+        self.counts = {'succeeded': 0, 'compensated': 0, 'error': 0, 'skipped': 0}
+        self._counts_lock = threading.Lock()
+        # Tags de sagas terminadas; el ack se hace desde el hilo que hizo fetch()
+        # porque los canales de pika no son thread-safe
+        self._done = queue.Queue()
+
+    def _ack_done(self):
+        tags = []
+        while True:
+            try:
+                tags.append(self._done.get_nowait())
+            except queue.Empty:
+                break
+        if tags:
+            self.transport.ack(tags)
+
+    def _record(self, outcome):
+        with self._counts_lock:
+            self.counts[outcome] += 1
+        saga_metrics.record_dlq_replay(outcome)
+
+    def _finished(self, tag, future, window):
+        try:
+            state = future.result()
+            outcome = 'succeeded' if state == SagaState.SUCCEEDED else 'compensated'
+        except Exception as e:
+            logger.error("Error al reprocesar un mensaje del DLQ: %r", e)
+            outcome = 'error'
+        self._record(outcome)
+        self._done.put(tag)
+        window.release()
+
+    def _submit(self, tag, message, window):
+        """Lanza la saga del mensaje; retorna None si no se pudo lanzar"""
+        self.bucket.acquire()
+        window.acquire()
+        try:
+            saga = self.orchestrator_cls()
+            saga.send_data(payload_from(message, self.keep_fail))
+            future = saga.submit()
+        except Exception as e:
+            # Un mensaje mal formado no detiene la pasada; vuelve a la cola
+            window.release()
+            logger.error("No se pudo reprocesar un mensaje del DLQ: %r", e)
+            self._record('error')
+            return None
+        future.add_done_callback(lambda f: self._finished(tag, f, window))
+        return future
+
+    def run(self):
+        """
+        Reprocesa los mensajes que había en la cola al empezar (o hasta
+        `limit`) y retorna el resumen. Lo que llega durante la pasada, como
+        las sagas reprocesadas que vuelven a fallar, queda en la cola.
+        """
+        window = threading.BoundedSemaphore(self.concurrency)
+        futures, skipped, rejected = [], [], []
+        remaining = self.transport.depth(DLQ_QUEUE_NAME)
+        start_time = time.perf_counter()
+        try:
+            while remaining > 0 and (self.limit is None
+                                     or len(futures) + len(rejected) < self.limit):
+                batch = self.transport.fetch(DLQ_QUEUE_NAME, min(self.batch_size, remaining))
+                if not batch:
+                    break
+                remaining -= len(batch)
+                for tag, message in batch:
+                    if self.limit is not None and len(futures) + len(rejected) >= self.limit:
+                        skipped.append(tag)
+                    elif matches(message, self.steps, self.since, self.until):
+                        future = self._submit(tag, message, window)
+                        if future is None:
+                            rejected.append(tag)
+                        else:
+                            futures.append(future)
+                    else:
+                        skipped.append(tag)
+                self._ack_done()
+                self._print_progress(len(futures) + len(rejected), len(skipped), start_time)
+
+            # Los callbacks corren después de resolver el Future: se espera a
+            # que todos liberen su lugar en la ventana, no solo a result()
+            for _ in range(self.concurrency):
+                window.acquire()
+        finally:
+            self._ack_done()
+            # Sin ack hasta el final: si se devolvieran antes, fetch() los volvería a leer
+            if skipped or rejected:
+                self.transport.requeue(skipped + rejected)
+
+        for _ in skipped:
+            saga_metrics.record_dlq_replay('skipped')
+        self.counts['skipped'] = len(skipped)
+        elapsed = time.perf_counter() - start_time
+        replayed = len(futures) + len(rejected)
+        return dict(self.counts, replayed=replayed, elapsed=f"{elapsed:.2f}s",
+                    throughput=f"{replayed / elapsed:.2f}" if elapsed else "0")
+
+    def _print_progress(self, submitted, skipped, start_time):
+        elapsed = time.perf_counter() - start_time
+        done = self.counts['succeeded'] + self.counts['compensated'] + self.counts['error']
+        rate = done / elapsed if elapsed else 0
+        print(f" DLQ: {submitted} enviados, {done} terminados ({rate:.1f} sagas/s), "
+              f"{skipped} omitidos")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocesa los pasos fallidos del DLQ como sagas nuevas")
+    parser.add_argument("--step", action="append", dest="steps",
+                        help="Solo mensajes de este paso, p.ej. CreateQuota (se puede repetir)")
+    parser.add_argument("--since", type=parse_time, default=None,
+                        help="Solo fallos desde esta fecha (ISO 8601 o epoch)")
+    parser.add_argument("--until", type=parse_time, default=None,
+                        help="Solo fallos hasta esta fecha (ISO 8601 o epoch)")
+    parser.add_argument("--batch-size", type=int, default=REPLAY_BATCH_SIZE,
+                        help="Mensajes leídos del DLQ por lote")
+    parser.add_argument("--concurrency", type=int, default=REPLAY_CONCURRENCY,
+                        help="Sagas reprocesadas en vuelo como máximo")
+    parser.add_argument("--rate", type=positive_float, default=REPLAY_RATE,
+                        help="Sagas nuevas por segundo como máximo")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Cantidad máxima de mensajes a reprocesar")
+    parser.add_argument("--keep-fail", action="store_true",
+                        help="Conserva las marcas de fallo simulado del payload")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    replayer = DLQReplayer(batch_size=args.batch_size, concurrency=args.concurrency,
+                           rate=args.rate, steps=args.steps, since=args.since,
+                           until=args.until, limit=args.limit, keep_fail=args.keep_fail)
+    summary = replayer.run()
+
+    print("\n" + "="*60)
+    print(" REPROCESO DEL DLQ")
+    print("="*60)
+    print(f"Reprocesados:                 {summary['replayed']} "
+          f"(éxito {summary['succeeded']}, compensados {summary['compensated']}, "
+          f"errores {summary['error']})")
+    print(f"Omitidos por el filtro:       {summary['skipped']}")
+    print(f"Tiempo total:                 {summary['elapsed']}")
+    print(f"Throughput:                   {summary['throughput']} sagas/s")
+    saga_metrics.print_report()
+    return summary
+
+
+if __name__ == "__main__":
+    main()
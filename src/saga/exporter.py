@@ -0,0 +1,207 @@
+"""
+Endpoint /metrics en formato de texto de Prometheus (OpenMetrics compatible).
+
+El servidor HTTP corre en un hilo daemon y solo lee: cada scrape combina
+los shards de saga_metrics y consulta los gauges registrados, así que el
+hot path de las sagas no hace nada extra. Los gauges que necesitan
+RabbitMQ o SQLite abren sus conexiones en el hilo del servidor.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from metrics import saga_metrics
+from histogram import LatencyHistogram
+from circuit_breaker import breaker_states, BreakerState, BREAKER_STATE_VALUES
+from storage import storage
+from logger import get_logger
+import os
+import sqlite3
+import threading
+import pika
+
+# Puerto del exporter en el orquestador (0 = deshabilitado)
+SAGA_METRICS_PORT = int(os.getenv("SAGA_METRICS_PORT", "0"))
+# Cotas (en segundos) de los buckets publicados
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+OUTBOX_DB_PATH = storage.path_for("users", "./db")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = get_logger("exporter")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _histogram(lines, name, histogram: LatencyHistogram, labels=None):
+    labels = labels or {}
+    for bound, count in zip(BUCKETS, histogram.cumulative_counts(BUCKETS)):
+        lines.append(f"{name}_bucket{_labels(dict(labels, le=bound))} {count}")
+    lines.append(f"{name}_bucket{_labels(dict(labels, le='+Inf'))} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(labels)} {_number(histogram.total)}")
+    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+
+def render_metrics(metrics=saga_metrics, gauges=None):
+    """Texto de exposición con los contadores, histogramas y gauges actuales"""
+    data = metrics.data
+    lines = []
+
+    counters = (
+        ("saga_sagas_total", "Sagas iniciadas", data['total_sagas']),
+        ("saga_succeeded_total", "Sagas completadas con éxito", data['succeeded']),
+        ("saga_compensations_total", "Sagas compensadas", data['compensated']),
+        ("saga_retries_total", "Reintentos de pasos", data['total_retries']),
+        ("saga_dlq_messages_total", "Pasos enviados al DLQ", data['total_dlq_messages']),
+    )
+    for name, help_text, value in counters:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+
+    lines += ["# HELP saga_step_failures_total Fallos definitivos por paso",
+              "# TYPE saga_step_failures_total counter"]
+    for step, count in data['step_failures'].items():
+        lines.append(f"saga_step_failures_total{_labels({'step': step})} {count}")
+
+    lines += ["# HELP saga_broker_commands_total Comandos atendidos por el broker",
+              "# TYPE saga_broker_commands_total counter"]
+    for command, statuses in data['commands'].items():
+        for status, count in statuses.items():
+            lines.append(f"saga_broker_commands_total"
+                         f"{_labels({'command': command, 'status': status})} {count}")
+
+    lines += ["# HELP saga_broker_command_seconds Tiempo del handler por comando, medido en el broker",
+              "# TYPE saga_broker_command_seconds histogram"]
+    for command, histogram in data['command_timings'].items():
+        _histogram(lines, "saga_broker_command_seconds", histogram, {'command': command})
+
+    lines += ["# HELP saga_dlq_replays_total Mensajes del DLQ reprocesados por resultado",
+              "# TYPE saga_dlq_replays_total counter"]
+    for outcome, count in data['dlq_replays'].items():
+        lines.append(f"saga_dlq_replays_total{_labels({'outcome': outcome})} {count}")
+
+    lines += ["# HELP saga_breaker_rejections_total Llamadas rechazadas por un circuito abierto",
+              "# TYPE saga_breaker_rejections_total counter"]
+    for step, count in data['breaker_rejections'].items():
+        lines.append(f"saga_breaker_rejections_total{_labels({'step': step})} {count}")
+
+    # 0 = cerrado, 1 = semiabierto, 2 = abierto
+    lines += ["# HELP saga_circuit_breaker_state Estado del circuit breaker por paso",
+              "# TYPE saga_circuit_breaker_state gauge"]
+    for step, state in breaker_states().items():
+        lines.append(f"saga_circuit_breaker_state{_labels({'step': step})} "
+                     f"{BREAKER_STATE_VALUES[BreakerState(state)]}")
+
+    # En vuelo = iniciadas que todavía no terminaron ni se compensaron
+    in_flight = data['total_sagas'] - data['succeeded'] - data['failed']
+    lines += ["# HELP saga_in_flight Sagas en ejecución",
+              "# TYPE saga_in_flight gauge", f"saga_in_flight {max(in_flight, 0)}"]
+
+    lines += ["# HELP saga_execution_seconds Duración de las sagas",
+              "# TYPE saga_execution_seconds histogram"]
+    _histogram(lines, "saga_execution_seconds", data['execution_times'])
+    lines += ["# HELP saga_compensation_seconds Duración de las compensaciones",
+              "# TYPE saga_compensation_seconds histogram"]
+    _histogram(lines, "saga_compensation_seconds", data['compensation_times'])
+
+    lines += ["# HELP saga_step_seconds Duración de cada fase de los pasos",
+              "# TYPE saga_step_seconds histogram"]
+    for step, phases in data['step_timings'].items():
+        for phase, histogram in phases.items():
+            _histogram(lines, "saga_step_seconds", histogram, {'step': step, 'phase': phase})
+
+    for name, (help_text, label, read) in (gauges or {}).items():
+        try:
+            value = read()
+        except Exception as e:
+            # Un gauge caído no debe romper el scrape completo
+            logger.error("Error al leer el gauge %s: %s", name, e)
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        if label is None:
+            lines.append(f"{name} {_number(value)}")
+        else:
+            for label_value, number in value.items():
+                lines.append(f"{name}{_labels({label: label_value})} {_number(number)}")
+
+    return "\n".join(lines) + "\n"
+
+
+class QueueDepthProbe:
+    """Mensajes listos por cola, con una conexión propia del hilo del exporter"""
+
+    def __init__(self, queues, host='localhost'):
+        self.queues = list(queues)
+        self.host = host
+        self.connection = None
+        self.channel = None
+
+    def __call__(self):
+        if self.connection is None or not self.connection.is_open:
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+            self.channel = self.connection.channel()
+        depths = {}
+        try:
+            for queue in self.queues:
+                # passive: solo consulta, no crea la cola
+                result = self.channel.queue_declare(queue=queue, passive=True)
+                depths[queue] = result.method.message_count
+        except pika.exceptions.ChannelClosedByBroker:
+            # La cola no existe todavía; el canal se cerró y se reabre en el próximo scrape
+            self.channel = self.connection.channel()
+        return depths
+
+
+def outbox_backlog(db_path=OUTBOX_DB_PATH):
+    """Eventos del outbox pendientes de publicar"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM outbox WHERE processed=0").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def broker_gauges(queues, host='localhost', db_path=OUTBOX_DB_PATH):
+    return {
+        "saga_queue_depth": ("Mensajes listos en la cola", "queue", QueueDepthProbe(queues, host)),
+        "saga_outbox_backlog": ("Eventos del outbox sin publicar", None,
+                                lambda: outbox_backlog(db_path)),
+    }
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics(self.server.metrics, self.server.gauges).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Sin una línea en stdout por cada scrape
+        pass
+
+
+def start_exporter(port, host="", metrics=saga_metrics, gauges=None):
+    """
+    Sirve /metrics en un hilo daemon y retorna el servidor (server.shutdown()
+    lo detiene). Con port=0 el sistema elige un puerto libre:
+    server.server_address[1].
+    """
+    server = HTTPServer((host, port), _MetricsHandler)
+    server.metrics = metrics
+    server.gauges = gauges
+    thread = threading.Thread(target=server.serve_forever, name="saga-metrics-exporter",
+                              daemon=True)
+    thread.start()
+    print(f"Exportando métricas en http://{host or '0.0.0.0'}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,100 @@
+"""
+Histograma de latencias de memoria fija.
+
+Los valores se agrupan en buckets logarítmicos (cada bucket es un
+`precision` más ancho que el anterior), así que el error relativo de los
+percentiles queda acotado por `precision` y la memoria no depende de
+cuántas muestras se registren.
+"""
+import math
+
+
+class LatencyHistogram:
+    def __init__(self, min_value=1e-4, max_value=3600.0, precision=0.02):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.precision = precision
+        self._log_growth = math.log1p(precision)
+        # bucket 0: valores <= min_value; último bucket: valores >= max_value
+        self.bucket_count = int(math.ceil(
+            math.log(max_value / min_value) / self._log_growth)) + 2
+        self.counts = [0] * self.bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        if value <= self.min_value:
+            return 0
+        if value >= self.max_value:
+            return self.bucket_count - 1
+        return int(math.log(value / self.min_value) / self._log_growth) + 1
+
+    def _bucket_value(self, index):
+        """Valor representativo (punto medio geométrico) del bucket"""
+        if index == 0:
+            return self.min_value
+        if index == self.bucket_count - 1:
+            return self.max_value
+        lower = self.min_value * math.exp((index - 1) * self._log_growth)
+        return lower * math.sqrt(1 + self.precision)
+
+    def record(self, value):
+        self.counts[self._bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        """Percentil p (0-100) en O(buckets); 0 si no hay muestras"""
+        if not self.count:
+            return 0
+        target = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                # Acotado a los extremos reales observados
+                return min(max(self._bucket_value(index), self.min), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99)):
+        result = {f"p{p}": self.percentile(p) for p in percentiles}
+        result['max'] = self.max or 0
+        return result
+
+    def cumulative_counts(self, bounds):
+        """
+        Muestras <= cada cota (ordenadas de menor a mayor), para exportar
+        como histograma con buckets fijos. El error es el de un bucket.
+        """
+        result, seen, index = [], 0, 0
+        for bound in bounds:
+            last = self._bucket(bound)
+            while index <= last:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+    def merge(self, other):
+        """Suma las muestras de otro histograma con la misma configuración"""
+        if other.bucket_count != self.bucket_count:
+            raise ValueError("Los histogramas tienen configuraciones distintas")
+        for index, bucket_count in enumerate(other.counts):
+            if bucket_count:
+                self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
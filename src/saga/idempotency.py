@@ -0,0 +1,105 @@
+"""
+Deduplicación de comandos en el broker.
+
+Cada comando de un paso lleva en `data` una clave de idempotencia
+"<saga_id>:<paso>". El handler guarda la respuesta exitosa en la tabla
+processed_commands de la misma base y en la misma transacción que la
+escritura, así que un comando repetido (p.ej. el reintento de uno cuya
+respuesta venció el timeout pero sí se aplicó) recibe la respuesta
+original en lugar de escribir de nuevo. Las claves viejas se borran
+según SAGA_IDEMPOTENCY_TTL.
+"""
+import json
+import os
+import threading
+import time
+
+# Segundos que se recuerda un comando procesado
+IDEMPOTENCY_TTL = float(os.getenv("SAGA_IDEMPOTENCY_TTL", str(24 * 3600)))
+# Cada cuánto cada worker limpia las claves vencidas de una base
+PRUNE_INTERVAL = 300
+
+PROCESSED_COMMANDS_DDL = (
+    '''
+    CREATE TABLE IF NOT EXISTS processed_commands (
+        idempotency_key TEXT PRIMARY KEY,
+        command_type TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_processed_commands_created_at "
+    "ON processed_commands(created_at)",
+)
+
+# Por hilo: id(conexión) -> momento de la próxima limpieza
+_local = threading.local()
+
+
+def idempotency_key(saga_id, step_name):
+    return f"{saga_id}:{step_name}"
+
+
+def saga_id_from_key(key):
+    """saga_id de una clave "<saga_id>:<paso>", o None si el comando no la trae"""
+    if not key:
+        return None
+    return key.rpartition(":")[0] or None
+
+
+def create_table(cursor):
+    for statement in PROCESSED_COMMANDS_DDL:
+        cursor.execute(statement)
+
+
+def _schedule():
+    schedule = getattr(_local, 'schedule', None)
+    if schedule is None:
+        schedule = _local.schedule = {}
+    return schedule
+
+
+def prepare(conn, ttl=IDEMPOTENCY_TTL):
+    """
+    Crea la tabla la primera vez que el hilo usa la conexión (bases creadas
+    antes de esta versión) y borra las claves vencidas cada PRUNE_INTERVAL.
+    """
+    schedule = _schedule()
+    next_prune = schedule.get(id(conn))
+    now = time.time()
+    if next_prune is None:
+        create_table(conn)
+        conn.commit()
+    if next_prune is None or now >= next_prune:
+        prune(conn, ttl, now)
+        schedule[id(conn)] = now + PRUNE_INTERVAL
+
+
+def lookup(conn, key):
+    """Respuesta guardada para la clave, o None si no se procesó"""
+    row = conn.execute("SELECT response FROM processed_commands WHERE idempotency_key=?",
+                       (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def remember(conn, key, command_type, response):
+    """
+    Registra la respuesta dentro de la transacción abierta del handler (sin
+    commit). Si otro worker ya registró la clave, el INSERT falla y el
+    handler hace rollback de su escritura.
+    """
+    if key is None:
+        return
+    conn.execute(
+        "INSERT INTO processed_commands (idempotency_key, command_type, response, created_at) "
+        "VALUES (?, ?, ?, ?)",
+        (key, command_type, json.dumps(response), time.time()),
+    )
+
+
+def prune(conn, ttl=IDEMPOTENCY_TTL, now=None):
+    """Borra las claves más viejas que `ttl` y retorna cuántas se borraron"""
+    cursor = conn.execute("DELETE FROM processed_commands WHERE created_at < ?",
+                          ((now or time.time()) - ttl,))
+    conn.commit()
+    return cursor.rowcount
@@ -1,64 +1,182 @@
+"""
+Esquema de las bases del broker con migraciones versionadas.
+
+Cada base guarda su versión en PRAGMA user_version y solo se aplican las
+migraciones posteriores, cada una en su propia transacción junto con el
+nuevo número de versión. La versión 1 es el esquema original (con
+IF NOT EXISTS, así que las bases creadas antes de las migraciones la
+adoptan sin cambios). Para cambiar el esquema se agrega una migración al
+final de la lista de la base; nunca se editan las ya publicadas.
+
+Con SAGA_STORAGE=single las tres tablas van en saga.db (ver storage.py) y
+la versión de cada una se guarda en la tabla schema_versions.
+"""
+from idempotency import PROCESSED_COMMANDS_DDL
+from storage import Storage, storage, STORAGE_MODES
+import argparse
 import sqlite3
 import os
 
 database_types = ["users", "permissions", "quotas"]
+DB_DIR = os.path.join(os.path.dirname(__file__), 'db')
+# Solo se puede fijar al crear la base (luego exigiría un VACUUM fuera de WAL)
+PAGE_SIZE = int(os.getenv("SAGA_DB_PAGE_SIZE", "8192"))
+
+MIGRATIONS = {
+    "users": [
+        # 1: esquema original
+        ['''
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                email TEXT NOT NULL
+            )
+        ''', '''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                step TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                processed INTEGER DEFAULT 0
+            )
+        '''],
+        # 2: comandos ya aplicados (ver idempotency.py)
+        list(PROCESSED_COMMANDS_DDL),
+        # 3: el relay lee solo las filas pendientes, sin recorrer las
+        #    procesadas; processed_at permite podar las viejas por antigüedad
+        ["CREATE INDEX IF NOT EXISTS idx_outbox_unprocessed ON outbox(id) WHERE processed=0",
+         "ALTER TABLE outbox ADD COLUMN processed_at REAL",
+         # Lo ya procesado cuenta desde la migración para la retención
+         "UPDATE outbox SET processed_at=CAST(strftime('%s', 'now') AS REAL) WHERE processed=1",
+         "CREATE INDEX IF NOT EXISTS idx_outbox_processed_at "
+         "ON outbox(processed_at) WHERE processed=1"],
+    ],
+    "permissions": [
+        ['''
+            CREATE TABLE IF NOT EXISTS permissions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                permissions TEXT,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        '''],
+        list(PROCESSED_COMMANDS_DDL),
+        ["CREATE INDEX IF NOT EXISTS idx_permissions_user_id ON permissions(user_id)"],
+    ],
+    "quotas": [
+        ['''
+            CREATE TABLE IF NOT EXISTS quotas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                storage_gb INTEGER,
+                ops_per_month INTEGER,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        '''],
+        list(PROCESSED_COMMANDS_DDL),
+        ["CREATE INDEX IF NOT EXISTS idx_quotas_user_id ON quotas(user_id)"],
+    ],
+}
 
 
-def get_connection(db_type):
+def get_connection(database, db_dir=DB_DIR):
     # Crear directorio db si no existe
-    db_dir = os.path.join(os.path.dirname(__file__), 'db')
     os.makedirs(db_dir, exist_ok=True)
 
-    db_path = os.path.join(db_dir, f'{db_type}.db')
+    db_path = os.path.join(db_dir, f'{database}.db')
     return sqlite3.connect(db_path)
 
 
-def initialize_database_by_type(db_types):
-    for db_type in db_types:
-        conn = get_connection(db_type)
-        cursor = conn.cursor()
-
-        if (db_type == "users"):
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    email TEXT NOT NULL
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS outbox (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    step TEXT NOT NULL,
-                    payload TEXT NOT NULL,
-                    processed INTEGER DEFAULT 0
-                )
-            ''')
-        elif (db_type == "permissions"):
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS permissions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT,
-                    permissions TEXT,
-                    FOREIGN KEY(user_id) REFERENCES users(id)
-                )
-            ''')
-        elif (db_type == "quotas"):
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS quotas (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT,
-                    storage_gb INTEGER,
-                    ops_per_month INTEGER,
-                    FOREIGN KEY(user_id) REFERENCES users(id)
-                )
-            ''')
-
-        conn.commit()
-        conn.close()
+# Versiones por tabla cuando varias comparten el archivo
+SCHEMA_VERSIONS_DDL = '''
+    CREATE TABLE IF NOT EXISTS schema_versions (
+        db_type TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )
+'''
+
+
+def schema_version(conn, db_type=None):
+    """Versión del archivo, o la de `db_type` si el archivo es compartido"""
+    if db_type is None:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    row = conn.execute("SELECT version FROM schema_versions WHERE db_type=?",
+                       (db_type,)).fetchone()
+    return row[0] if row else 0
+
+
+def _set_schema_version(conn, number, db_type=None):
+    if db_type is None:
+        conn.execute(f"PRAGMA user_version={number}")
+    else:
+        conn.execute("INSERT OR REPLACE INTO schema_versions (db_type, version) VALUES (?, ?)",
+                     (db_type, number))
+
+
+def pending_migrations(conn, db_type, shared=False):
+    """Cantidad de migraciones de `db_type` que todavía no se aplicaron"""
+    if shared:
+        has_versions = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                                    "AND name='schema_versions'").fetchone()
+        version = schema_version(conn, db_type) if has_versions else 0
+    else:
+        version = schema_version(conn)
+    return max(len(MIGRATIONS[db_type]) - version, 0)
+
+
+def _is_empty(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+
+
+def migrate(conn, db_type, shared=False):
+    """
+    Aplica las migraciones pendientes de `db_type` y retorna la versión
+    final. `shared` indica que el archivo guarda varias tablas.
+    """
+    if _is_empty(conn):
+        # Solo tienen efecto antes de crear la primera tabla
+        conn.execute(f"PRAGMA page_size={PAGE_SIZE}")
+        # Las páginas que libera la poda del outbox se devuelven con
+        # PRAGMA incremental_vacuum, sin reescribir la base entera
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL queda guardado en el archivo: lectores y escritor no se bloquean
+    conn.execute("PRAGMA journal_mode=WAL")
+    if shared:
+        conn.execute(SCHEMA_VERSIONS_DDL)
+    versioned = db_type if shared else None
+
+    version = schema_version(conn, versioned)
+    migrations = MIGRATIONS[db_type]
+    for number, statements in enumerate(migrations[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            _set_schema_version(conn, number, versioned)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"   {db_type}: migración {number} aplicada")
+    return len(migrations)
+
+
+def initialize_database_by_type(db_types, db_dir=DB_DIR, layout=storage):
+    for database, tables in layout.databases(db_types).items():
+        conn = get_connection(database, db_dir)
+        try:
+            for db_type in tables:
+                migrate(conn, db_type, shared=layout.single)
+        finally:
+            conn.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crea o migra las bases de datos del broker")
+    parser.add_argument("--db-dir", default=DB_DIR)
+    parser.add_argument("--storage", choices=STORAGE_MODES, default=storage.mode,
+                        help="Bases separadas o un solo archivo saga.db (env SAGA_STORAGE)")
+    args = parser.parse_args()
+
     print("=====Inicializando bases de datos=====")
-    initialize_database_by_type(database_types)
+    initialize_database_by_type(database_types, args.db_dir, Storage(args.storage))
     print("Bases de datos inicializadas correctamente.")
@@ -0,0 +1,141 @@
+"""
+Logging estructurado y asíncrono del SAGA.
+
+Cada módulo usa get_logger(nombre) y registra con formato diferido
+(logger.info("Ejecutando paso: %s", step.name)): si el nivel está
+deshabilitado la llamada retorna sin armar el mensaje. Los registros
+habilitados se encolan y un hilo (QueueListener) los formatea y escribe,
+así que el hot path no hace I/O ni formatea. Los argumentos se formatean
+en ese hilo: no se deben modificar después de registrarlos.
+
+Cada registro puede llevar saga_id y step (ver bind), que el formato text
+agrega al final de la línea y el formato json emite como campos.
+
+    SAGA_LOG_LEVEL=WARNING    # DEBUG incluye cada mensaje del broker
+    SAGA_LOG_FORMAT=json
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+SAGA_LOG_LEVEL = os.getenv("SAGA_LOG_LEVEL", "INFO").upper()
+SAGA_LOG_FORMAT = os.getenv("SAGA_LOG_FORMAT", "text")
+ROOT_LOGGER = "saga"
+CONTEXT_FIELDS = ("saga_id", "step")
+
+
+class ContextAdapter(logging.LoggerAdapter):
+    """Agrega saga_id/step a cada registro, sin pisar el extra de la llamada"""
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return msg, kwargs
+
+
+def bind(logger, **context):
+    return ContextAdapter(logger, context)
+
+
+def _context(record):
+    return {field: getattr(record, field) for field in CONTEXT_FIELDS
+            if getattr(record, field, None) is not None}
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        context = " ".join(f"{field}={value}" for field, value in _context(record).items())
+        return f"{message} [{context}]" if context else message
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": record.created, "level": record.levelname,
+                 "logger": record.name, "message": record.getMessage().strip()}
+        entry.update(_context(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler formatea en el hilo que registra; la cola es del mismo
+    # proceso, así que el registro puede viajar sin preparar
+    def prepare(self, record):
+        return record
+
+
+class _Stdout:
+    """sys.stdout del momento de escribir (respeta redirect_stdout y pytest)"""
+
+    def write(self, text):
+        sys.stdout.write(text)
+
+    def flush(self):
+        sys.stdout.flush()
+
+
+_listener = None
+_lock = threading.Lock()
+_settings = {}
+
+
+def configure(level=SAGA_LOG_LEVEL, fmt=SAGA_LOG_FORMAT, stream=None):
+    """(Re)configura el logger raíz "saga"; `stream` por defecto es stdout"""
+    global _listener
+    with _lock:
+        _settings.update(fmt=fmt, stream=stream)
+        if _listener is not None:
+            _listener.stop()
+        output = logging.StreamHandler(stream or _Stdout())
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter("%(message)s"))
+        records = queue.SimpleQueue()
+
+        root = logging.getLogger(ROOT_LOGGER)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_DeferredQueueHandler(records))
+        root.setLevel(level)
+        root.propagate = False
+
+        _listener = logging.handlers.QueueListener(records, output)
+        _listener.start()
+        return _listener
+
+
+def set_level(level):
+    logging.getLogger(ROOT_LOGGER).setLevel(level)
+
+
+def flush():
+    """Espera a que se escriban los registros encolados"""
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener.start()
+
+
+def get_logger(name):
+    if _listener is None:
+        configure()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def _after_fork_in_child():
+    # El hilo del listener no sobrevive al fork (BROKER_MODE=process)
+    global _listener, _lock
+    _lock = threading.Lock()
+    if _listener is not None:
+        _listener = None
+        configure(level=logging.getLogger(ROOT_LOGGER).level, **_settings)
+
+
+atexit.register(flush)
+# register_at_fork solo existe en POSIX (no en Windows)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -3,72 +3,94 @@ import json
 import sqlite3
 import random
 import os
+import argparse
+import threading
+import multiprocessing
+import time
+
+from db_pool import connections
+from metrics import saga_metrics
+from exporter import start_exporter, broker_gauges
+from routing import queues_for
+from transport import get_transport, handle_delivery
+from idempotency import prepare, lookup, remember, saga_id_from_key
+from logger import get_logger
+from storage import insert_account
 
-EXCHANGE_NAME = "saga_exchange"
-COMMAND_QUEUE_NAME = "saga_commands"
-DLQ_QUEUE_NAME = "saga_dlq"
 TEST_FAILS = os.getenv("FAILS", "false").lower() == "true"
 NUMBER_RANDOM = os.getenv("RANDOM", "false").lower() == "true"
+# Modo de ejecución de los workers (ver start_workers)
+BROKER_WORKERS = int(os.getenv("BROKER_WORKERS", "1"))
+BROKER_PREFETCH = int(os.getenv("BROKER_PREFETCH", "1"))
+BROKER_MODE = os.getenv("BROKER_MODE", "thread")
+# Tipos de comando que consume este worker, separados por coma (vacío = todos)
+BROKER_COMMANDS = os.getenv("BROKER_COMMANDS", "")
+# Puerto del endpoint /metrics (0 = deshabilitado)
+BROKER_METRICS_PORT = int(os.getenv("BROKER_METRICS_PORT", "0"))
+
+logger = get_logger("message_broker")
+
+
+def log_context(evt_type, data):
+    """Campos saga_id y step de los registros de un comando"""
+    return {"saga_id": saga_id_from_key(data.get('idempotency_key')), "step": evt_type}
+
 
 def get_connection(db_type):
-    return sqlite3.connect(f'db/{db_type}.db')
+    # Conexión persistente del hilo actual (ver db_pool); no se debe cerrar
+    return connections.get(db_type)
 
 
 # HANDLERS PARA ELIMINAR RECURSOS
 def handler_composite_provision_user(data):
     db_id = data.get("db_id")
     if db_id is None:
-        print("     - Rollback: No se tiene db_id para eliminar usuario")
+        logger.debug("     - Rollback: No se tiene db_id para eliminar usuario")
         return
     conn = get_connection("users")
     cursor = conn.cursor()
     try:
         cursor.execute("DELETE FROM users WHERE id=?", (db_id,))
         conn.commit()
-        print(
-            f"     - Rollback: Usuario eliminado con ID {db_id} de tabla users")
+        logger.debug("     - Rollback: Usuario eliminado con ID %s de tabla users", db_id)
     except Exception as e:
-        print(f"Fallo al hacer rollback de ProvisionUser: {e}")
-    finally:
-        conn.close()
+        conn.rollback()
+        logger.error("Fallo al hacer rollback de ProvisionUser: %s", e)
     return {'status': 'ok', 'detail': f'Usuario {db_id} eliminado'}
 
 
 def handler_composite_assign_permissions(data):
     perm_id = data.get("db_id")
     if perm_id is None:
-        print("     - Rollback: No se tiene db_id para eliminar permisos")
+        logger.debug("     - Rollback: No se tiene db_id para eliminar permisos")
         return
     conn = get_connection("permissions")
     cursor = conn.cursor()
     try:
         cursor.execute("DELETE FROM permissions WHERE id=?", (perm_id,))
         conn.commit()
-        print(
-            f"     - Rollback: Permisos eliminados con ID {perm_id} de tabla permissions")
+        logger.debug("     - Rollback: Permisos eliminados con ID %s de tabla permissions",
+                     perm_id)
     except Exception as e:
-        print(f"Fallo al hacer rollback de AssignPermissions: {e}")
-    finally:
-        conn.close()
+        conn.rollback()
+        logger.error("Fallo al hacer rollback de AssignPermissions: %s", e)
     return {'status': 'ok', 'detail': 'Permisos eliminados'}
 
 
 def handler_composite_create_quota(data):
     quota_row_id = data.get("db_id")
     if quota_row_id is None:
-        print("     - Rollback: No se tiene db_id para eliminar quota")
+        logger.debug("     - Rollback: No se tiene db_id para eliminar quota")
         return
     conn = get_connection("quotas")
     cursor = conn.cursor()
     try:
         cursor.execute("DELETE FROM quotas WHERE id=?", (quota_row_id,))
         conn.commit()
-        print(
-            f"     - Rollback: Quota eliminada con ID {quota_row_id} de tabla quotas")
+        logger.debug("     - Rollback: Quota eliminada con ID %s de tabla quotas", quota_row_id)
     except Exception as e:
-        print(f"Fallo al hacer rollback de CreateQuota: {e}")
-    finally:
-        conn.close()
+        conn.rollback()
+        logger.error("Fallo al hacer rollback de CreateQuota: %s", e)
     return {'status': 'ok', 'detail': 'Quotas eliminadas'}
 
 
@@ -90,19 +112,20 @@ def handle_provision_user(data: dict) -> dict:
     if (fail and num is not None and num < 14):
         return {'status': 'error', 'detail': f'Fallo al registrar usuario(default)'}
 
+    conn = get_connection("users")
     try:
-        conn = get_connection("users")
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO users (id, name, email) VALUES ( ?,?, ?)",
             (user_id, user_name, user_email),
         )
+        response = {'status': 'ok', 'id': user_id, 'detail': f'Usuario {user_id} provisionado'}
+        remember(conn, data.get('idempotency_key'), 'ProvisionUser', response)
         conn.commit()
     except Exception as e:
+        conn.rollback()
         return {'status': 'error', 'detail': f'Fallo al registrar usuario: {e}'}
-    finally:
-        conn.close()
-    return {'status': 'ok', 'id': user_id, 'detail': f'Usuario {user_id} provisionado'}
+    return response
 
 
 def handle_assign_permissions(data: dict) -> dict:
@@ -120,22 +143,24 @@ def handle_assign_permissions(data: dict) -> dict:
     if (fail and num is not None and num < 14):
         return {'status': 'error', 'detail': f'Fallo al registrar usuario(default)'}
 
+    conn = get_connection("permissions")
     try:
-        conn = get_connection("permissions")
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO permissions (user_id, permissions) VALUES (?, ?)",
             (user_id, json.dumps(permissions)),
         )
-        conn.commit()
         perm_id = cursor.lastrowid
-        print(
-            f"     - Permisos asignados a user {user_id} en tabla permissions: {permissions} (perm_id={perm_id})")
+        response = {'status': 'ok', 'id': perm_id, 'detail': f'Permisos asignados a {user_id}'}
+        remember(conn, data.get('idempotency_key'), 'AssignPermissions', response)
+        conn.commit()
+        logger.debug("     - Permisos asignados a user %s en tabla permissions: %s (perm_id=%s)",
+                     user_id, permissions, perm_id,
+                     extra=log_context('AssignPermissions', data))
     except Exception as e:
+        conn.rollback()
         return {'status': 'error', 'detail': f'Fallo al asignar permisos: {e}'}
-    finally:
-        conn.close()
-    return {'status': 'ok', 'id': perm_id, 'detail': f'Permisos asignados a {user_id}'}
+    return response
 
 
 def handle_create_quota(data: dict) -> dict:
@@ -155,23 +180,313 @@ def handle_create_quota(data: dict) -> dict:
     if (fail and num is not None and num < 14):
         return {'status': 'error', 'detail': f'Fallo al registrar usuario(default)'}
 
+    conn = get_connection("quotas")
     try:
-        conn = get_connection("quotas")
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO quotas (user_id, storage_gb, ops_per_month) VALUES ( ?, ?, ?)",
             (user_id, storage_gb, ops_per_month),
         )
-        conn.commit()
         quota_row_id = cursor.lastrowid
-        print(
-            f"     - Quota creada con ID {quota_id} para user {user_id} en tabla quotas (row_id={quota_row_id})")
+        response = {'status': 'ok', 'id': quota_row_id,
+                    'detail': f'Quota {quota_id} creada para {user_id}'}
+        remember(conn, data.get('idempotency_key'), 'CreateQuota', response)
+        conn.commit()
+        logger.debug("     - Quota creada con ID %s para user %s en tabla quotas (row_id=%s)",
+                     quota_id, user_id, quota_row_id, extra=log_context('CreateQuota', data))
     except Exception as e:
+        conn.rollback()
         return {'status': 'error', 'detail': f'Fallo al crear quota: {e}'}
-    finally:
-        conn.close()
-    return {'status': 'ok', 'id': quota_row_id, 'detail': f'Quota {quota_id} creada para {user_id}'}
+    return response
+
+
+# HANDLERS POR LOTES (un solo executemany y un solo commit por lote)
+
+def _simulated_failure(fail):
+    """Misma inyección de fallos que los handlers individuales"""
+    if TEST_FAILS:
+        return True
+    if fail and not NUMBER_RANDOM:
+        return True
+    num = random.randint(12, 16) if NUMBER_RANDOM else None
+    return bool(fail and num is not None and num < 14)
+
+
+def _insert_batch(conn, insert_many, insert_one, rows, respond):
+    """
+    Inserta `rows` en una sola transacción y retorna, en el mismo orden, la
+    respuesta de cada fila o la excepción que la rechazó. respond(i, id)
+    arma la respuesta de la fila i dentro de la transacción, para que se
+    registre con su clave de idempotencia en el mismo commit. Primero
+    prueba el lote entero con insert_many; si una fila viola una
+    restricción (p.ej. un id repetido o una clave ya registrada) lo rehace
+    con un SAVEPOINT por fila, así que solo esa fila queda afuera y las
+    demás se confirman en el mismo commit.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        ids = insert_many(conn, rows)
+        responses = [respond(i, row_id) for i, row_id in enumerate(ids)]
+        conn.commit()
+        return responses
+    except sqlite3.IntegrityError:
+        conn.rollback()
+    except Exception:
+        conn.rollback()
+        raise
+
+    outcomes = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for i, row in enumerate(rows):
+            conn.execute("SAVEPOINT batch_row")
+            try:
+                outcomes.append(respond(i, insert_one(conn, row)))
+            except sqlite3.IntegrityError as e:
+                conn.execute("ROLLBACK TO batch_row")
+                outcomes.append(e)
+            conn.execute("RELEASE batch_row")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return outcomes
+
+
+def _table_writer(table, columns):
+    """
+    (insert_many, insert_one) para _insert_batch sobre una tabla con id
+    autoincremental. BEGIN IMMEDIATE toma el lock de escritura, así que los
+    ids mayores al máximo previo son exactamente los del executemany.
+    """
+    sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+           f"VALUES ({', '.join('?' * len(columns))})")
+
+    def insert_many(conn, rows):
+        last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+        conn.executemany(sql, rows)
+        return [row[0] for row in conn.execute(
+            f"SELECT id FROM {table} WHERE id > ? ORDER BY id", (last_id,))]
+
+    def insert_one(conn, row):
+        return conn.execute(sql, row).lastrowid
+
+    return insert_many, insert_one
+
+
+def _stored_response(conn, item):
+    key = item.get('idempotency_key')
+    return lookup(conn, key) if key is not None else None
+
+
+def _run_batch(conn, items, command_type, error_detail, build_row, writer, ok_result,
+               fail_flag=lambda item: item.get('fail'), stored=_stored_response,
+               record=None):
+    """
+    Arma una respuesta por ítem en el mismo orden que `items`. Los ítems
+    cuya idempotency_key ya se procesó (p.ej. un lote reenviado tras un
+    timeout) reciben la respuesta guardada sin escribir de nuevo; al resto
+    se le aplica la inyección de fallos y se inserta de una vez, registrando
+    cada clave como `command_type` en la misma transacción. Así un
+    reintento individual del paso (keyed_command) también se deduplica.
+    `stored` y `record` reemplazan la búsqueda y el registro de las claves.
+    """
+    if record is None:
+        def record(conn, item, response):
+            remember(conn, item.get('idempotency_key'), command_type, response)
+
+    results = [None] * len(items)
+    prepare(conn)
+    rows, positions = [], []
+    for pos, item in enumerate(items):
+        replayed = stored(conn, item)
+        if replayed is not None:
+            results[pos] = replayed
+        elif _simulated_failure(fail_flag(item)):
+            results[pos] = {'status': 'error', 'detail': f'{error_detail}(default)'}
+        else:
+            rows.append(build_row(item))
+            positions.append(pos)
+
+    def respond(i, row_id):
+        item = items[positions[i]]
+        response = ok_result(item, row_id)
+        record(conn, item, response)
+        return response
+
+    if rows:
+        try:
+            outcomes = _insert_batch(conn, *writer, rows, respond)
+        except Exception as e:
+            outcomes = [e] * len(rows)
+        for pos, outcome in zip(positions, outcomes):
+            if not isinstance(outcome, Exception):
+                results[pos] = outcome
+                continue
+            # Otro worker pudo registrar la misma clave en paralelo
+            results[pos] = stored(conn, items[pos]) or \
+                {'status': 'error', 'detail': f'{error_detail}: {outcome}'}
+
+    return {'status': 'ok', 'results': results}
+
+
+USERS_SQL = "INSERT INTO users (id, name, email) VALUES ( ?,?, ?)"
+
+
+def _insert_users(conn, rows):
+    conn.executemany(USERS_SQL, rows)
+    return [row[0] for row in rows]
+
+
+def _insert_user(conn, row):
+    conn.execute(USERS_SQL, row)
+    return row[0]
+
 
+USERS_WRITER = (_insert_users, _insert_user)
+PERMISSIONS_WRITER = _table_writer("permissions", ("user_id", "permissions"))
+QUOTAS_WRITER = _table_writer("quotas", ("user_id", "storage_gb", "ops_per_month"))
+
+
+def handle_provision_user_batch(data: dict) -> dict:
+    return _run_batch(
+        get_connection("users"), data.get('items', []), 'ProvisionUser',
+        'Fallo al registrar usuario',
+        lambda item: (item.get('id'), item.get('name'), item.get('email')),
+        USERS_WRITER,
+        lambda item, user_id: {'status': 'ok', 'id': user_id,
+                               'detail': f'Usuario {user_id} provisionado'},
+    )
+
+
+def handle_assign_permissions_batch(data: dict) -> dict:
+    return _run_batch(
+        get_connection("permissions"), data.get('items', []), 'AssignPermissions',
+        'Fallo al asignar permisos',
+        lambda item: (item.get('id'), json.dumps(item.get('permissions'))),
+        PERMISSIONS_WRITER,
+        lambda item, perm_id: {'status': 'ok', 'id': perm_id,
+                               'detail': f"Permisos asignados a {item.get('id')}"},
+    )
+
+
+def handle_create_quota_batch(data: dict) -> dict:
+    return _run_batch(
+        get_connection("quotas"), data.get('items', []), 'CreateQuota',
+        'Fallo al crear quota',
+        lambda item: (item.get('id'), item.get('storage_gb'), item.get('ops_per_month')),
+        QUOTAS_WRITER,
+        lambda item, row_id: {'status': 'ok', 'id': row_id,
+                              'detail': f"Quota {item.get('quota_id')} creada para {item.get('id')}"},
+    )
+
+
+def _account_result(item, ids):
+    user_id, perm_id, quota_row_id = ids
+    return {'status': 'ok', 'id': user_id, 'permissions_id': perm_id,
+            'quota_id': quota_row_id, 'detail': f'Cuenta {user_id} provisionada'}
+
+
+def _account_steps(item, response):
+    """Respuesta de cada paso, igual a la de su handler individual"""
+    user_id = response['id']
+    quota_id = item.get('quota', {}).get('quota_id')
+    return {
+        'ProvisionUser': {'status': 'ok', 'id': user_id,
+                          'detail': f'Usuario {user_id} provisionado'},
+        'AssignPermissions': {'status': 'ok', 'id': response['permissions_id'],
+                              'detail': f'Permisos asignados a {user_id}'},
+        'CreateQuota': {'status': 'ok', 'id': response['quota_id'],
+                        'detail': f'Quota {quota_id} creada para {user_id}'},
+    }
+
+
+def _stored_account(conn, item):
+    """Respuesta de una cuenta cuyos tres pasos ya se registraron, o None"""
+    keys = item.get('idempotency_keys')
+    if not keys:
+        return None
+    stored = {step: lookup(conn, key) for step, key in keys.items()}
+    if None in stored.values():
+        return None
+    # Un paso cancelado por la recuperación de la saga hace fallar la cuenta
+    for response in stored.values():
+        if response.get('status') != 'ok':
+            return response
+    return _account_result(item, (stored['ProvisionUser']['id'],
+                                  stored['AssignPermissions']['id'],
+                                  stored['CreateQuota']['id']))
+
+
+def _record_account(conn, item, response):
+    keys = item.get('idempotency_keys') or {}
+    for step, step_response in _account_steps(item, response).items():
+        remember(conn, keys.get(step), step, step_response)
+
+
+def _insert_accounts(conn, rows):
+    return [insert_account(conn, row) for row in rows]
+
+
+def handle_provision_account_batch(data: dict) -> dict:
+    """
+    Usuario, permisos y cuota de varias sagas en una sola transacción
+    (requiere SAGA_STORAGE=single). Cada ítem es un payload de saga con
+    `idempotency_keys` = {paso: clave}: cada paso se registra con su clave,
+    así que el reintento individual de un paso también se deduplica.
+    """
+    # La disposición de las conexiones del broker (ver db_pool), no la del proceso
+    if not connections.storage.single:
+        return {'status': 'error',
+                'detail': 'ProvisionAccountBatch requiere SAGA_STORAGE=single'}
+    # Cada ítem trae las marcas de los tres pasos ([False, False, True]): la
+    # cuenta falla si falla cualquiera
+    return _run_batch(
+        get_connection("users"), data.get('items', []), None,
+        'Fallo al provisionar cuenta', lambda item: item,
+        (_insert_accounts, insert_account), _account_result,
+        fail_flag=lambda item: any(item.get('fail') or []),
+        stored=_stored_account, record=_record_account,
+    )
+
+
+# Comandos con deduplicación -> base donde se registran (misma transacción que la escritura)
+IDEMPOTENT_COMMANDS = {
+    'ProvisionUser': 'users',
+    'AssignPermissions': 'permissions',
+    'CreateQuota': 'quotas',
+}
+
+
+def handle_resolve_command(data: dict) -> dict:
+    """
+    Recuperación de un paso iniciado sin respuesta en el saga log: retorna
+    la respuesta guardada si el comando se aplicó. Si no, registra la clave
+    con una respuesta de error, así que si el comando todavía está en una
+    cola el handler la encuentra (o pierde la carrera en processed_commands)
+    y no escribe.
+    """
+    key = data.get('idempotency_key')
+    command_type = data.get('command_type')
+    db_type = IDEMPOTENT_COMMANDS.get(command_type)
+    if key is None or db_type is None:
+        return {'status': 'error', 'detail': f'Comando no resoluble: {command_type}'}
+    conn = get_connection(db_type)
+    prepare(conn)
+    cancelled = {'status': 'error', 'detail': 'Cancelado por la recuperación de la saga'}
+    try:
+        conn.execute(
+            "INSERT OR IGNORE INTO processed_commands "
+            "(idempotency_key, command_type, response, created_at) VALUES (?, ?, ?, ?)",
+            (key, command_type, json.dumps(cancelled), time.time()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    stored = lookup(conn, key)
+    if stored.get('status') != 'ok':
+        return {'status': 'ok', 'applied': False}
+    return {'status': 'ok', 'applied': True, 'response': stored}
 
 HANDLERS = {
     'ProvisionUser': handle_provision_user,
@@ -179,19 +494,32 @@ HANDLERS = {
     'CreateQuota': handle_create_quota,
     'CompositeAssignPermissions': handler_composite_assign_permissions,
     'CompositeProvisionUser': handler_composite_provision_user,
-    'CompositeCreateQuota': handler_composite_create_quota
+    'CompositeCreateQuota': handler_composite_create_quota,
+    'ProvisionUserBatch': handle_provision_user_batch,
+    'AssignPermissionsBatch': handle_assign_permissions_batch,
+    'CreateQuotaBatch': handle_create_quota_batch,
+    'ProvisionAccountBatch': handle_provision_account_batch,
+    'ResolveCommand': handle_resolve_command
 }
 
 
-def callback(ch, method, properties, body):
-    try:
-        evt = json.loads(body)
-    except Exception:
-        try:
-            evt = body.decode()
-        except Exception:
-            evt = body
+def replayed_response(evt_type, data):
+    """
+    Respuesta ya registrada de un comando con clave de idempotencia, o None
+    si hay que ejecutarlo. Los fallos no se registran: un reintento de un
+    comando que falló se vuelve a ejecutar.
+    """
+    key = data.get('idempotency_key')
+    db_type = IDEMPOTENT_COMMANDS.get(evt_type)
+    if key is None or db_type is None:
+        return None
+    conn = get_connection(db_type)
+    prepare(conn)
+    return lookup(conn, key)
+
 
+def dispatch(evt):
+    """Ejecuta el handler del comando y retorna la respuesta que se envía a reply_to"""
     resp_payload = {'status': 'error', 'detail': 'no handler'}
     try:
         evt_type = evt.get('type')
@@ -199,62 +527,122 @@ def callback(ch, method, properties, body):
         handler = HANDLERS.get(evt_type)
 
         if handler:
-            resp_payload = handler(data)
+            started_at = time.perf_counter()
+            status = None
+            resp_payload = replayed_response(evt_type, data)
+            if resp_payload is None:
+                resp_payload = handler(data)
+                if (isinstance(resp_payload, dict) and resp_payload.get('status') != 'ok'
+                        and data.get('idempotency_key') is not None):
+                    # Otro worker pudo procesar la misma clave en paralelo: el
+                    # handler perdió la carrera en processed_commands
+                    resp_payload = replayed_response(evt_type, data) or resp_payload
+            else:
+                status = 'duplicate'
+                logger.info("Comando repetido %s: se devuelve la respuesta guardada",
+                            data['idempotency_key'], extra=log_context(evt_type, data))
+            handler_time = time.perf_counter() - started_at
+            if isinstance(resp_payload, dict):
+                # Tiempo del handler (base de datos) para las métricas por paso
+                resp_payload['handler_time'] = handler_time
+                saga_metrics.record_command(evt_type, handler_time,
+                                            status or resp_payload.get('status', 'error'))
         else:
             resp_payload = {'status': 'error',
                             'detail': f'Tipo de operación desconocido: {evt_type}'}
     except Exception as e:
         resp_payload = {'status': 'error', 'detail': str(e)}
+    return resp_payload
 
-    try:
-        if properties.reply_to:
-            ch.basic_publish(
-                exchange='',
-                routing_key=properties.reply_to,
-                body=json.dumps(resp_payload),
-                properties=pika.BasicProperties(
-                    correlation_id=properties.correlation_id),
-            )
-    except Exception as e:
-        print(f"Fallo al enviar la repuesta: {e}")
-
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-    print(f"Mensaje procesado: {evt} -> Respuesta: {resp_payload}")
-
-
-def connect_to_message_broker():
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters("localhost")
-    )
-    return connection
-
-
-def start_listening():
 
-    conn = connect_to_message_broker()
+def callback(ch, method, properties, body):
+    handle_delivery(ch, method, properties, body, dispatch)
 
-    channel = conn.channel()
-    channel.queue_declare(queue=COMMAND_QUEUE_NAME, durable=True)
-    channel.queue_declare(queue=DLQ_QUEUE_NAME, durable=True)
-    channel.exchange_declare(exchange=EXCHANGE_NAME,
-                             exchange_type="direct", durable=True)
 
-    channel.queue_bind(exchange=EXCHANGE_NAME,
-                       queue=COMMAND_QUEUE_NAME, routing_key=COMMAND_QUEUE_NAME)
-    channel.queue_bind(exchange=EXCHANGE_NAME,
-                       queue=DLQ_QUEUE_NAME, routing_key=DLQ_QUEUE_NAME)
+def start_listening(prefetch_count=1, subscriptions=None):
+    """
+    Consumidor bloqueante; cada worker usa su propia conexión y canal.
+    `subscriptions` limita las colas consumidas (ver routing.queues_for).
+    El transporte (RabbitMQ o en memoria) se elige con SAGA_TRANSPORT.
+    """
+    try:
+        get_transport().listen(queues_for(subscriptions), dispatch, prefetch_count)
+    finally:
+        connections.close_all()
 
-    channel.basic_qos(prefetch_count=1)
 
-    print(f"Escuchando mensajes en cola '{COMMAND_QUEUE_NAME}'...")
+def run_worker(prefetch_count=1, subscriptions=None, reconnect_delay=2):
+    """Mantiene vivo un consumidor, reconectando si se pierde la conexión"""
+    while True:
+        try:
+            start_listening(prefetch_count, subscriptions)
+            return
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.warning("Conexión perdida con el broker: %s. Reintentando en %ss...",
+                           e, reconnect_delay)
+            time.sleep(reconnect_delay)
+
+
+def start_workers(workers=1, prefetch_count=1, mode="thread", subscriptions=None):
+    """
+    Levanta `workers` consumidores en paralelo sobre la cola de comandos.
+    - thread: un hilo por worker, cada uno con su conexión y canal
+      (pika no permite compartir una conexión entre hilos).
+    - process: un proceso por worker, útil cuando los handlers compiten por el GIL.
+    Cada worker hace ack en su propio canal y responde a reply_to/correlation_id
+    igual que el consumidor único.
+    """
+    if workers <= 1:
+        run_worker(prefetch_count, subscriptions)
+        return
 
-    channel.basic_consume(
-        queue=COMMAND_QUEUE_NAME,
-        on_message_callback=callback
-    )
+    if mode == "thread":
+        runners = [threading.Thread(target=run_worker, args=(prefetch_count, subscriptions),
+                                    name=f"broker-worker-{i}", daemon=True)
+                   for i in range(workers)]
+    elif mode == "process":
+        runners = [multiprocessing.Process(target=run_worker, args=(prefetch_count, subscriptions),
+                                           name=f"broker-worker-{i}", daemon=True)
+                   for i in range(workers)]
+    else:
+        raise ValueError(f"Modo de worker desconocido: {mode}")
+
+    logger.info("Iniciando %d workers en modo %s (prefetch=%d)", workers, mode, prefetch_count)
+    for runner in runners:
+        runner.start()
 
-    channel.start_consuming()
+    try:
+        for runner in runners:
+            runner.join()
+    except KeyboardInterrupt:
+        logger.info("Deteniendo workers...")
+        if mode == "process":
+            for runner in runners:
+                runner.terminate()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Worker del message broker SAGA")
+    parser.add_argument("--workers", type=int, default=BROKER_WORKERS,
+                        help="Número de consumidores en paralelo (env BROKER_WORKERS)")
+    parser.add_argument("--prefetch", type=int, default=BROKER_PREFETCH,
+                        help="Mensajes sin ack por consumidor (env BROKER_PREFETCH)")
+    parser.add_argument("--mode", choices=["thread", "process"], default=BROKER_MODE,
+                        help="Hilos o procesos para los workers (env BROKER_MODE)")
+    parser.add_argument("--commands", default=BROKER_COMMANDS,
+                        help="Tipos de comando a consumir separados por coma, "
+                             "p.ej. 'CreateQuota,compensations' (env BROKER_COMMANDS)")
+    parser.add_argument("--metrics-port", type=int, default=BROKER_METRICS_PORT,
+                        help="Puerto del endpoint Prometheus /metrics; 0 lo deshabilita "
+                             "(env BROKER_METRICS_PORT)")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    start_listening()
+    args = parse_args()
+    subscriptions = [name.strip() for name in args.commands.split(",") if name.strip()]
+    if args.metrics_port:
+        # Con --mode process los contadores quedan en cada proceso hijo;
+        # este endpoint publica los del proceso padre y los gauges
+        start_exporter(args.metrics_port, gauges=broker_gauges(queues_for(subscriptions)))
+    start_workers(args.workers, args.prefetch, args.mode, subscriptions)
@@ -1,71 +1,229 @@
 import json
 import time
 import sqlite3
+import os
+import argparse
 import pika
-
-DB_PATH = "./db/users.db"
+from routing import COMMAND_QUEUE_NAME
+from transport import get_transport
+from storage import storage
+from initialize_databases import pending_migrations
+from logger import get_logger
+
+# El outbox vive junto a la tabla users (saga.db con SAGA_STORAGE=single)
+DB_PATH = storage.path_for("users", "./db")
+BATCH_SIZE = int(os.getenv("RELAY_BATCH_SIZE", "100"))
+IDLE_INTERVAL = float(os.getenv("RELAY_IDLE_INTERVAL", "2"))
+# Límite conservador de parámetros por sentencia en SQLite
+MAX_SQL_VARIABLES = 500
+# Las filas ya publicadas se borran pasado este tiempo (segundos)
+OUTBOX_RETENTION = float(os.getenv("RELAY_OUTBOX_RETENTION", str(7 * 24 * 3600)))
+OUTBOX_PRUNE_INTERVAL = 600
+# Filas borradas por transacción, para no retener el lock de escritura
+PRUNE_CHUNK_SIZE = 5000
+
+logger = get_logger("message_relay")
 
 def send_to_rabbit(event: dict):
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters('localhost')
-    )
-    channel = connection.channel()
-
-    channel.queue_declare(queue='saga_commands', durable=True)
-
-    channel.basic_publish(
-        exchange='saga_exchange',
-        routing_key='saga_commands',
-        body=json.dumps(event),
-        properties=pika.BasicProperties(
-            delivery_mode=2  
-        )
-    )
-
-    connection.close()
-
-
-def start_processing_outbox():
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "SELECT id, step, payload FROM outbox WHERE processed=0 ORDER BY id LIMIT 2"
+    get_transport().publish(COMMAND_QUEUE_NAME, event)
+
+
+class OutboxRelay:
+    """
+    Publica los eventos pendientes del outbox en lotes a través del
+    transporte (con RabbitMQ, una conexión persistente con publisher
+    confirms): las filas se marcan como procesadas solo cuando el broker
+    confirmó el lote completo.
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_size=BATCH_SIZE,
+                 idle_interval=IDLE_INTERVAL, transport=None,
+                 retention=OUTBOX_RETENTION, prune_interval=OUTBOX_PRUNE_INTERVAL):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.transport = transport or get_transport()
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self._next_prune = 0
+        self.db = None
+
+    def close(self):
+        self.close_broker()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _ensure_connections(self):
+        if self.db is None:
+            db = sqlite3.connect(self.db_path)
+            try:
+                self.check_schema(db)
+            except Exception:
+                db.close()
+                raise
+            self.db = db
+
+    def check_schema(self, db):
+        """
+        El relay usa columnas de migraciones posteriores (processed_at): con
+        una base sin migrar cada lote fallaría igual, así que se rechaza
+        antes de publicar nada.
+        """
+        pending = pending_migrations(db, "users", shared=storage.single)
+        if pending:
+            raise RuntimeError(
+                f"{self.db_path}: faltan {pending} migraciones del outbox; "
+                f"aplicarlas con `python initialize_databases.py` antes de iniciar el relay")
+
+    def fetch_batch(self):
+        cursor = self.db.execute(
+            "SELECT id, step, payload FROM outbox WHERE processed=0 ORDER BY id LIMIT ?",
+            (self.batch_size,)
         )
-        rows = cursor.fetchall()
-
-        if not rows:
-            return
-
-        for row in rows:
-            id, step, payload = row
+        return cursor.fetchall()
+
+    def publish_batch(self, rows):
+        """
+        Publica las filas con publish_many (una sola llamada por lote, sobre
+        la conexión persistente) y retorna los ids confirmados: todos o, si
+        el broker no confirmó el lote, ninguno.
+        """
+        events = []
+        for id, step, payload in rows:
             try:
                 payload = json.loads(payload)
             except Exception:
                 payload = payload
-
-            event = {"id": id, "step": step, "payload": payload}
-
+            events.append({"id": id, "step": step, "payload": payload})
+
+        try:
+            self.transport.publish_many(COMMAND_QUEUE_NAME, events)
+        except pika.exceptions.AMQPError as e:
+            logger.error("No se pudo enviar el lote de %d eventos (ids %s-%s) a rabbitmq: %s",
+                         len(events), rows[0][0], rows[-1][0], e)
+            # La conexión ya no es usable: se reabrirá en el siguiente lote
+            self.close_broker()
+            return []
+        return [id for id, _, _ in rows]
+
+    def close_broker(self):
+        self.transport.close()
+
+    def mark_processed(self, ids):
+        """Marca los ids como procesados en una sola transacción"""
+        if not ids:
+            return
+        with self.db:
+            for i in range(0, len(ids), MAX_SQL_VARIABLES):
+                chunk = ids[i:i + MAX_SQL_VARIABLES]
+                placeholders = ",".join("?" * len(chunk))
+                self.db.execute(
+                    f"UPDATE outbox SET processed=1, processed_at=? WHERE id IN ({placeholders})",
+                    [time.time()] + chunk
+                )
+
+    def prune_processed(self, now=None):
+        """
+        Borra las filas publicadas hace más de `retention` segundos, en
+        transacciones cortas, y retorna cuántas se borraron. El índice
+        parcial sobre processed_at evita recorrer las pendientes.
+        """
+        self._ensure_connections()
+        cutoff = (now or time.time()) - self.retention
+        deleted = 0
+        while True:
+            with self.db:
+                cursor = self.db.execute(
+                    "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox "
+                    "WHERE processed=1 AND processed_at < ? LIMIT ?)",
+                    (cutoff, PRUNE_CHUNK_SIZE)
+                )
+            deleted += cursor.rowcount
+            if cursor.rowcount < PRUNE_CHUNK_SIZE:
+                break
+        if deleted:
+            # Con auto_vacuum=INCREMENTAL devuelve al sistema las páginas liberadas
+            self.db.execute("PRAGMA incremental_vacuum")
+            logger.info("Outbox: %d filas procesadas eliminadas", deleted)
+        return deleted
+
+    def _prune_if_due(self):
+        now = time.monotonic()
+        if now >= self._next_prune:
+            self._next_prune = now + self.prune_interval
+            self.prune_processed()
+
+    def process_batch(self):
+        """Procesa un lote y retorna (filas leídas, filas confirmadas)"""
+        self._ensure_connections()
+        rows = self.fetch_batch()
+        if not rows:
+            return 0, 0
+
+        confirmed = self.publish_batch(rows)
+        self.mark_processed(confirmed)
+        return len(rows), len(confirmed)
+
+    def run_forever(self):
+        """
+        Drena el outbox lote tras lote mientras haya backlog y solo duerme
+        cuando está vacío (o cuando el broker no confirma nada).
+        """
+        # Un esquema viejo no se arregla reintentando: se falla al arrancar
+        self._ensure_connections()
+        logger.info("Procesando registros del Outbox...")
+        while True:
             try:
-                send_to_rabbit(event)
-                cursor.execute("UPDATE outbox SET processed=1 WHERE id=?", (id,))
+                fetched, confirmed = self.process_batch()
+                self._prune_if_due()
             except Exception as e:
-                print(f"No se pudo enviar el evento con id={id} a rabbitmq: {e}")
+                logger.error("Error al procesar el Outbox: %s", e)
+                self.close()
+                fetched, confirmed = 0, 0
+
+            if fetched == 0 or confirmed == 0:
+                time.sleep(self.idle_interval)
+
+
+_relay = None
 
-        conn.commit()
 
+def start_processing_outbox():
+    """Procesa un lote del outbox con el relay compartido del proceso"""
+    global _relay
+    if _relay is None:
+        _relay = OutboxRelay()
+    try:
+        _relay.process_batch()
     except Exception as e:
-        print(f"Error al procesar el Outbox: {e}")
+        logger.error("Error al procesar el Outbox: %s", e)
+        _relay.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Relay del outbox hacia RabbitMQ")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Filas por lote (env RELAY_BATCH_SIZE)")
+    parser.add_argument("--idle-interval", type=float, default=IDLE_INTERVAL,
+                        help="Segundos de espera cuando el outbox está vacío (env RELAY_IDLE_INTERVAL)")
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--retention", type=float, default=OUTBOX_RETENTION,
+                        help="Segundos que se conservan las filas ya publicadas "
+                             "(env RELAY_OUTBOX_RETENTION)")
+    parser.add_argument("--prune", action="store_true",
+                        help="Solo borra las filas publicadas vencidas y termina")
+    return parser.parse_args(argv)
 
-    finally:
-        if conn:
-            conn.close()
-    
 
 if __name__ == "__main__":
-    print("Procesando registros del Outbox...")
-    while True:
-        start_processing_outbox()
-        time.sleep(2)
+    args = parse_args()
+    relay = OutboxRelay(args.db_path, args.batch_size, args.idle_interval,
+                        retention=args.retention)
+    try:
+        if args.prune:
+            print(f"Filas eliminadas: {relay.prune_processed()}")
+        else:
+            relay.run_forever()
+    finally:
+        relay.close()
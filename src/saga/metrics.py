@@ -1,52 +1,252 @@
 import json
+import os
+import threading
 import time
+import weakref
 from datetime import datetime
+from histogram import LatencyHistogram
+from circuit_breaker import breaker_states
+
+# Fases que se miden por paso:
+#   execute  -> primer intento del paso (orquestador)
+#   retry    -> cada reintento (orquestador)
+#   rollback -> compensación del paso (orquestador)
+#   rpc_wait -> ida y vuelta del comando al broker, incluida la cola
+#   handler  -> tiempo del handler en el broker (acceso a la base de datos),
+#               según el handler_time de la respuesta
+#   rollback_rpc_wait / rollback_handler -> lo mismo para el comando de compensación
+# El broker registra sus propios tiempos en command_timings, no aquí: en un
+# mismo proceso el handler de cada comando se contaría dos veces.
+STEP_PHASES = ("execute", "retry", "rollback", "rpc_wait", "handler",
+               "rollback_rpc_wait", "rollback_handler")
+# Fase de espera del RPC -> fase del handler que informa su respuesta
+RPC_PHASES = {"rpc_wait": "handler", "rollback_rpc_wait": "rollback_handler"}
+
+
+def format_percentiles(histogram, decimals=2):
+    """Resumen p50/p90/p99/max de un histograma, con el formato del reporte"""
+    if not histogram.count:
+        return {}
+    return {name: f"{value:.{decimals}f}s" for name, value in histogram.summary().items()}
+
+
+def _new_shard():
+    return {
+        'total_sagas': 0,
+        'succeeded': 0,
+        'failed': 0,
+        'compensated': 0,
+        'total_retries': 0,
+        'total_dlq_messages': 0,
+        # Histogramas de memoria fija en lugar de listas con cada duración
+        'execution_times': LatencyHistogram(),
+        'compensation_times': LatencyHistogram(),
+        'step_failures': {},
+        # paso -> fase -> histograma (ver STEP_PHASES)
+        'step_timings': {},
+        # comandos atendidos por el broker: tipo -> status -> cantidad
+        'commands': {},
+        # tiempo del handler medido en el broker: tipo de comando -> histograma
+        'command_timings': {},
+        # mensajes del DLQ reprocesados: resultado -> cantidad (ver dlq_replay)
+        'dlq_replays': {},
+        # llamadas rechazadas por un circuito abierto: paso -> cantidad
+        'breaker_rejections': {},
+    }
+
+
+def _compare(previous, current, higher_is_better=True):
+    if current == previous:
+        return 'igual'
+    return 'mejora' if (current > previous) == higher_is_better else 'empeora'
+
+
+def _merge_timings(target, timings):
+    for step, phases in dict(timings).items():
+        step_target = target.setdefault(step, {})
+        for phase, histogram in dict(phases).items():
+            step_target.setdefault(phase, LatencyHistogram()).merge(histogram)
+
+
+def _merge_shard(target, shard):
+    for key, value in shard.items():
+        if key in ('step_failures', 'dlq_replays', 'breaker_rejections'):
+            # Copia atómica: el dueño del shard puede estar agregando pasos
+            for step, count in dict(value).items():
+                target[key][step] = target[key].get(step, 0) + count
+        elif key == 'step_timings':
+            _merge_timings(target[key], value)
+        elif key == 'command_timings':
+            for command, histogram in dict(value).items():
+                target[key].setdefault(command, LatencyHistogram()).merge(histogram)
+        elif key == 'commands':
+            for command, statuses in dict(value).items():
+                command_target = target[key].setdefault(command, {})
+                for status, count in dict(statuses).items():
+                    command_target[status] = command_target.get(status, 0) + count
+        elif isinstance(value, LatencyHistogram):
+            target[key].merge(value)
+        else:
+            target[key] += value
+    return target
+
+
+# Instancias vivas, para vaciarlas en el proceso hijo después de un fork
+_instances = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for metrics in list(_instances):
+        metrics._clear_shards()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 class SagaMetrics:
+    """
+    Cada hilo registra en su propio shard, sin locks en el hot path, y los
+    lectores combinan los shards al pedir el reporte. En asyncio todas las
+    corutinas del loop comparten el shard del hilo del loop. Para pools de
+    procesos cada worker envía su snapshot() y el padre lo suma con merge();
+    el hijo de un fork empieza con los shards vacíos, así su snapshot no
+    repite lo que el padre ya tenía registrado.
+    """
+
     def __init__(self):
-        self.data = {
-            'total_sagas': 0,
-            'succeeded': 0,
-            'failed': 0,
-            'compensated': 0,
-            'total_retries': 0,
-            'total_dlq_messages': 0,
-            'execution_times': [],
-            'compensation_times': [],
-            'step_failures': {},
-            'timestamp': datetime.now().isoformat()
-        }
+        self._clear_shards()
+        self.timestamp = datetime.now().isoformat()
+        _instances.add(self)
+
+    def _clear_shards(self):
+        self._local = threading.local()
+        # Lock nuevo: el del padre pudo quedar tomado por otro hilo al hacer fork
+        self._lock = threading.Lock()
+        # (hilo dueño, shard); los shards de hilos terminados se pliegan en _retired
+        self._shards = []
+        self._retired = _new_shard()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _new_shard()
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    @property
+    def data(self):
+        """Vista combinada de todos los shards (se calcula en cada lectura)"""
+        merged = _new_shard()
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    # El hilo ya no escribe: su shard se suma una sola vez
+                    _merge_shard(self._retired, shard)
+            self._shards = alive
+            _merge_shard(merged, self._retired)
+            for _, shard in alive:
+                _merge_shard(merged, shard)
+        merged['timestamp'] = self.timestamp
+        return merged
+
+    def snapshot(self):
+        """Estado combinado serializable con pickle, para enviarlo entre procesos"""
+        snapshot = self.data
+        del snapshot['timestamp']
+        return snapshot
+
+    def merge(self, snapshot):
+        """Suma el snapshot de otro proceso (o de otro SagaMetrics)"""
+        _merge_shard(self._shard(), snapshot)
 
     def record_saga_start(self):
-        self.data['total_sagas'] += 1
+        self._shard()['total_sagas'] += 1
 
     def record_saga_success(self, execution_time):
-        self.data['succeeded'] += 1
-        self.data['execution_times'].append(execution_time)
+        shard = self._shard()
+        shard['succeeded'] += 1
+        shard['execution_times'].record(execution_time)
 
     def record_saga_failure(self, failed_step, execution_time):
-        self.data['failed'] += 1
-        self.data['compensated'] += 1
-        self.data['execution_times'].append(execution_time)
+        shard = self._shard()
+        shard['failed'] += 1
+        shard['compensated'] += 1
+        shard['execution_times'].record(execution_time)
 
-        if failed_step not in self.data['step_failures']:
-            self.data['step_failures'][failed_step] = 0
-        self.data['step_failures'][failed_step] += 1
+        if failed_step not in shard['step_failures']:
+            shard['step_failures'][failed_step] = 0
+        shard['step_failures'][failed_step] += 1
 
     def record_retry(self):
-        self.data['total_retries'] += 1
+        self._shard()['total_retries'] += 1
 
     def record_dlq(self):
-        self.data['total_dlq_messages'] += 1
+        self._shard()['total_dlq_messages'] += 1
+
+    def record_dlq_replay(self, outcome):
+        """outcome: succeeded, compensated, error o skipped"""
+        replays = self._shard()['dlq_replays']
+        replays[outcome] = replays.get(outcome, 0) + 1
+
+    def record_breaker_rejection(self, step_name):
+        rejections = self._shard()['breaker_rejections']
+        rejections[step_name] = rejections.get(step_name, 0) + 1
 
     def record_compensation_time(self, compensation_time):
         """Registra el tiempo de compensación"""
-        self.data['compensation_times'].append(compensation_time)
+        self._shard()['compensation_times'].record(compensation_time)
+
+    def record_step_time(self, step_name, phase, seconds):
+        """Registra la duración de una fase de un paso (ver STEP_PHASES)"""
+        timings = self._shard()['step_timings']
+        phases = timings.get(step_name)
+        if phases is None:
+            phases = timings[step_name] = {}
+        histogram = phases.get(phase)
+        if histogram is None:
+            histogram = phases[phase] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def record_rpc(self, step_name, seconds, response, phase="rpc_wait"):
+        """Tiempo de espera de un RPC y, si el broker lo informa, del handler (ver RPC_PHASES)"""
+        self.record_step_time(step_name, phase, seconds)
+        handler_time = response.get('handler_time') if isinstance(response, dict) else None
+        if handler_time is not None:
+            self.record_step_time(step_name, RPC_PHASES[phase], handler_time)
+
+    def record_command(self, command_type, seconds, status):
+        """Comando atendido por el broker: tiempo del handler y status de la respuesta"""
+        shard = self._shard()
+        histogram = shard['command_timings'].get(command_type)
+        if histogram is None:
+            histogram = shard['command_timings'][command_type] = LatencyHistogram()
+        histogram.record(seconds)
+        commands = shard['commands']
+        statuses = commands.get(command_type)
+        if statuses is None:
+            statuses = commands[command_type] = {}
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def get_step_latencies(self, data=None):
+        """Percentiles por paso y por fase, en el formato del reporte"""
+        timings = (data or self.data)['step_timings']
+        return {
+            # Las fases de un paso duran milisegundos: se reportan con más decimales
+            step: {phase: format_percentiles(phases[phase], decimals=4)
+                   for phase in STEP_PHASES if phase in phases}
+            for step, phases in timings.items()
+        }
 
     def get_report(self):
         """Genera un reporte con las métricas calculadas"""
-        total_sagas = self.data['total_sagas']
+        # Una sola combinación de shards por reporte
+        data = self.data
+        total_sagas = data['total_sagas']
 
         if total_sagas == 0:
             return {
@@ -57,16 +257,17 @@ class SagaMetrics:
                 'avg_retries_per_saga': "0",
                 'total_dlq_messages': 0,
                 'avg_compensation_time': "0s",
-                'step_failures': {}
+                'step_failures': {},
+                'execution_time_percentiles': {},
+                'compensation_time_percentiles': {},
+                'step_latencies': {}
             }
 
-        avg_time = sum(self.data['execution_times']) / len(
-            self.data['execution_times']) if self.data['execution_times'] else 0
-        avg_retries = self.data['total_retries'] / total_sagas
-        compensation_rate = (self.data['compensated'] / total_sagas * 100)
-        success_rate = (self.data['succeeded'] / total_sagas * 100)
-        avg_comp_time = sum(self.data['compensation_times']) / len(
-            self.data['compensation_times']) if self.data['compensation_times'] else 0
+        avg_time = data['execution_times'].mean()
+        avg_retries = data['total_retries'] / total_sagas
+        compensation_rate = (data['compensated'] / total_sagas * 100)
+        success_rate = (data['succeeded'] / total_sagas * 100)
+        avg_comp_time = data['compensation_times'].mean()
 
         return {
             'total_sagas': total_sagas,
@@ -74,15 +275,20 @@ class SagaMetrics:
             'compensation_rate': f"{compensation_rate:.2f}%",
             'avg_execution_time': f"{avg_time:.2f}s",
             'avg_retries_per_saga': f"{avg_retries:.2f}",
-            'total_dlq_messages': self.data['total_dlq_messages'],
+            'total_dlq_messages': data['total_dlq_messages'],
             'avg_compensation_time': f"{avg_comp_time:.2f}s",
-            'step_failures': self.data['step_failures']
+            'step_failures': data['step_failures'],
+            'execution_time_percentiles': format_percentiles(data['execution_times']),
+            'compensation_time_percentiles': format_percentiles(data['compensation_times']),
+            'step_latencies': self.get_step_latencies(data)
         }
 
-    def save_to_file(self, filename='saga_metrics.json'):
-        """Guarda el reporte en un archivo JSON"""
+    def save_to_file(self, filename='saga_metrics.json', extra=None):
+        """Guarda el reporte en un archivo JSON; `extra` agrega campos (p.ej. throughput)"""
+        report = self.get_report()
+        report.update(extra or {})
         with open(filename, 'w') as f:
-            json.dump(self.get_report(), f, indent=2)
+            json.dump(report, f, indent=2)
         print(f" Métricas guardadas en {filename}")
 
     def print_report(self):
@@ -101,6 +307,21 @@ class SagaMetrics:
             f"Reintentos promedio:          {report['avg_retries_per_saga']}")
         print(f"Mensajes en DLQ:              {report['total_dlq_messages']}")
 
+        for label, key in (("ejecución", 'execution_time_percentiles'),
+                           ("compensación", 'compensation_time_percentiles')):
+            percentiles = report[key]
+            if percentiles:
+                values = " ".join(f"{name}={value}" for name, value in percentiles.items())
+                print(f"Latencia {label + ':':<21}{values}")
+
+        if report['step_latencies']:
+            print("\n Latencia por paso:")
+            for step, phases in report['step_latencies'].items():
+                print(f"   {step}")
+                for phase, percentiles in phases.items():
+                    values = " ".join(f"{name}={value}" for name, value in percentiles.items())
+                    print(f"     {phase:<10}{values}")
+
         if report['step_failures']:
             print("\n Pasos que más fallan:")
             for step, count in report['step_failures'].items():
@@ -111,10 +332,11 @@ class SagaMetrics:
 
         print("="*60 + "\n")
 
-    def calculate_trends(self, previous_file='saga_metrics_previous.json'):
+    def calculate_trends(self, previous_file='saga_metrics_previous.json', current=None):
         """
         Calcula trends comparando con ejecución anterior
         Retorna dict con trend por métrica (mejora/empeora/igual)
+        `current` permite comparar un reporte ya guardado (p.ej. el del benchmark)
         """
         import os
 
@@ -127,7 +349,7 @@ class SagaMetrics:
         except:
             return None
 
-        current = self.get_report()
+        current = current or self.get_report()
         trends = {}
 
         # Comparar tasa de éxito
@@ -150,27 +372,41 @@ class SagaMetrics:
         else:
             trends['retries'] = 'igual'
 
+        # Throughput y p99 solo existen en los reportes del benchmark
+        if 'throughput' in prev and 'throughput' in current:
+            trends['throughput'] = _compare(float(prev['throughput']),
+                                            float(current['throughput']))
+        prev_p99 = prev.get('execution_time_percentiles', {}).get('p99')
+        curr_p99 = current.get('execution_time_percentiles', {}).get('p99')
+        if prev_p99 and curr_p99:
+            trends['latency_p99'] = _compare(float(prev_p99.rstrip('s')),
+                                             float(curr_p99.rstrip('s')),
+                                             higher_is_better=False)
+
         return trends
 
     def get_resilience_report(self):
         """Genera informe específico de resiliencia"""
-        total = self.data['total_sagas']
+        data = self.data
+        total = data['total_sagas']
         if total == 0:
             return {}
 
         # Calcular tasa de recuperación (SAGAs que se compensaron correctamente)
-        recovery_rate = (self.data['compensated'] / total * 100) if self.data['compensated'] > 0 else 0
+        recovery_rate = (data['compensated'] / total * 100) if data['compensated'] > 0 else 0
 
         # MTTR aproximado (tiempo promedio de compensación)
-        mttr = sum(self.data['compensation_times']) / len(self.data['compensation_times']) \
-               if self.data['compensation_times'] else 0
+        mttr = data['compensation_times'].mean()
 
         return {
-            'total_failures': self.data['failed'],
+            'total_failures': data['failed'],
             'recovery_rate': f"{recovery_rate:.2f}%",
             'mttr': f"{mttr:.2f}s",
-            'dlq_messages': self.data['total_dlq_messages'],
-            'avg_retries': f"{self.data['total_retries'] / total:.2f}"
+            'dlq_messages': data['total_dlq_messages'],
+            'dlq_replays': data['dlq_replays'],
+            'breaker_rejections': data['breaker_rejections'],
+            'circuit_breakers': breaker_states(),
+            'avg_retries': f"{data['total_retries'] / total:.2f}"
         }
 
     def print_resilience_report(self):
@@ -185,7 +421,17 @@ class SagaMetrics:
         print(f"Tasa de recuperación:         {resilience.get('recovery_rate', '0%')}")
         print(f"MTTR (tiempo recuperación):   {resilience.get('mttr', '0s')}")
         print(f"Mensajes en DLQ:              {resilience.get('dlq_messages', 0)}")
+        replays = resilience.get('dlq_replays')
+        if replays:
+            values = " ".join(f"{outcome}={count}" for outcome, count in replays.items())
+            print(f"Reprocesados del DLQ:         {values}")
         print(f"Reintentos promedio:          {resilience.get('avg_retries', '0')}")
+        breakers = resilience.get('circuit_breakers')
+        if breakers:
+            rejections = resilience.get('breaker_rejections', {})
+            print("\n Circuit breakers:")
+            for step, state in breakers.items():
+                print(f"   - {step}: {state} ({rejections.get(step, 0)} rechazadas)")
 
         if trends:
             print("\n📊 Trends (comparado con ejecución anterior):")
@@ -196,7 +442,7 @@ class SagaMetrics:
 
         print("="*60 + "\n")
 
-    def save_with_history(self, filename='saga_metrics.json'):
+    def save_with_history(self, filename='saga_metrics.json', extra=None):
         import os
         import shutil
 
@@ -204,7 +450,7 @@ class SagaMetrics:
             shutil.copy(filename, filename.replace('.json', '_previous.json'))
 
         # Guardar las nuevas métricas
-        self.save_to_file(filename)
+        self.save_to_file(filename, extra)
 
     def reset(self):
         self.__init__()
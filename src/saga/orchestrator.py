@@ -2,147 +2,509 @@ from factory import StepFactory
 from state import SagaState
 from steps import Step
 from metrics import saga_metrics
+from saga_log import (get_saga_log, SAGA_STARTED, STATE_CHANGED, STEP_STARTED,
+                      STEP_COMPLETED, STEP_COMPENSATED, STEP_FAILED)
+from retry import RetryScheduler
+from circuit_breaker import get_breaker, CIRCUIT_OPEN
+from dlq import get_dlq_publisher
+from logger import get_logger, bind
+from concurrent.futures import ThreadPoolExecutor, Future
+import os
+import threading
 import time
-import pika
-import json
-import random
-
-
-class SagaOrchestrator():
-    def __init__(self):
+import uuid
+
+# Definición del SAGA como grafo: (tipo de paso, tipos de los que depende).
+# AssignPermissions y CreateQuota solo necesitan que el usuario exista,
+# así que se ejecutan en paralelo.
+SAGA_DEFINITION = [
+    ("provision_user", []),
+    ("assign_permissions", ["provision_user"]),
+    ("create_quota", ["provision_user"]),
+]
+
+# Políticas de reintento por tipo de paso (ver retry.RetryPolicy); los
+# pasos sin entrada usan la política por defecto
+RETRY_POLICIES = {}
+
+# Pool compartido para los intentos de los pasos. Ningún intento duerme en
+# el pool: los reintentos esperan su backoff en retry_scheduler.
+STEP_WORKERS = int(os.getenv("SAGA_STEP_WORKERS", "16"))
+_step_executor = ThreadPoolExecutor(max_workers=STEP_WORKERS,
+                                    thread_name_prefix="saga-step")
+retry_scheduler = RetryScheduler(_step_executor)
+
+logger = get_logger("orchestrator")
+
+
+def build_dlq_message(step, last_response):
+    return {
+        'type': 'FailedStep',
+        'step_name': step.name,
+        'step_data': step.data,
+        'last_response': last_response,
+        'timestamp': time.time(),
+        'retry_attempts': step.retry_policy.max_retries
+    }
+
+
+def reject_open_circuit(step):
+    """Respuesta de un paso cuyo circuito está abierto"""
+    saga_metrics.record_breaker_rejection(step.name)
+    logger.warning("⛔ Circuito abierto en %s: la saga falla sin llamar al servicio", step.name,
+                   extra={"saga_id": getattr(step, "saga_id", None), "step": step.name})
+    return {"status": False, "error": CIRCUIT_OPEN}
+
+
+class SagaGraph():
+    """Pasos del SAGA y sus dependencias, compartido por los orquestadores"""
+
+    def __init__(self, saga_id=None, saga_log=None):
+        # Log durable opcional; por defecto el del proceso (SAGA_LOG_PATH)
+        self.saga_log = saga_log if saga_log is not None else get_saga_log()
+        self._reset(saga_id)
+
+    def _reset(self, saga_id=None):
+        self.saga_id = saga_id or str(uuid.uuid4())
+        # Todos los registros de la saga llevan su saga_id
+        self.logger = bind(logger, saga_id=self.saga_id)
         self.state = SagaState.PENDING
+        self.raw_data = None
         self.steps = []
+        # nombre del paso -> nombres de los pasos de los que depende
+        self.dependencies = {}
+        # pasos completados, en orden de finalización (orden topológico)
         self.completed = []
-
-    def send_data(self, raw_data):
-        step1 = StepFactory.create("provision_user", data=raw_data)
-        step2 = StepFactory.create("assign_permissions", data=raw_data)
-        step3 = StepFactory.create("create_quota", data=raw_data)
-        self.steps = [step1, step2, step3]
-
-    def execute_saga(self):
-
-        saga_metrics.record_saga_start()
-        start_time = time.time()
-
-        print("☸️ Iniciando Saga Orchestrator...")
+        # True cuando un paso falló definitivamente y la saga se va a compensar
+        self.aborted = False
+        # nombre del paso -> (handle, Future, última respuesta) de su reintento
+        # estacionado en retry_scheduler
+        self._parked = {}
+        self._parked_lock = threading.Lock()
+        # Pasos iniciados sin respuesta registrada (solo en sagas recuperadas)
+        self.unconfirmed = []
+
+    @classmethod
+    def restore(cls, saga_id, saga_log):
+        """
+        Reconstruye una saga a partir de sus registros en el saga log. Los
+        pasos con STEP_STARTED pero sin STEP_COMPLETED quedan en
+        `unconfirmed`: el broker pudo haber aplicado el comando sin que la
+        respuesta llegara al log (ver RpcStep.resolve).
+        """
+        data, state, started, completed, compensated = None, None, [], [], set()
+        for entry in saga_log.entries(saga_id):
+            if entry['event'] == SAGA_STARTED:
+                data = entry['payload']
+            elif entry['payload'] is not None and data is not None:
+                # Cada STEP_COMPLETED agrega los ids que generó su paso
+                data.update(entry['payload'])
+            if entry['state'] is not None:
+                state = entry['state']
+            if entry['event'] == STEP_STARTED and entry['step'] not in started:
+                started.append(entry['step'])
+            elif entry['event'] == STEP_COMPLETED:
+                completed.append(entry['step'])
+            elif entry['event'] == STEP_COMPENSATED:
+                compensated.add(entry['step'])
+
+        saga = cls(saga_id=saga_id, saga_log=saga_log)
+        saga.send_data(data)
+        by_name = {step.name: step for step in saga.steps}
+        saga.completed = [by_name[name] for name in completed
+                          if name not in compensated]
+        saga.unconfirmed = [by_name[name] for name in started
+                            if name not in completed and name not in compensated]
+        saga.state = SagaState(state)
+        return saga
+
+    def log(self, event, step=None, state=None, payload=None, durable=False):
+        """Registra en el saga log; con durable=True retorna el Future del commit"""
+        if self.saga_log is not None:
+            return self.saga_log.append(self.saga_id, event, step, state, payload,
+                                        durable=durable)
+        return None
+
+    def start(self):
         self.state = SagaState.RUNNING
-
+        self.log(SAGA_STARTED, state=self.state.value, payload=self.raw_data)
+
+    def set_state(self, state):
+        self.state = state
+        self.log(STATE_CHANGED, state=state.value)
+
+    def log_started(self, step):
+        """
+        Registra STEP_STARTED sin esperar; retorna el Future de su commit (o
+        None sin saga log). El comando no se debe enviar antes de que se
+        resuelva.
+        """
+        return self.log(STEP_STARTED, step=step.name, durable=True)
+
+    def mark_started(self, step):
+        """Registra STEP_STARTED y espera a que esté confirmado (write-ahead)"""
+        committed = self.log_started(step)
+        if committed is not None:
+            committed.result()
+
+    def mark_completed(self, step):
+        self.completed.append(step)
+        # Solo los ids del paso: `data` es compartido y otras ramas lo están
+        # modificando, así que serializarlo entero no es seguro
+        self.log(STEP_COMPLETED, step=step.name,
+                 payload={field: step.data.get(field) for field in step.result_fields})
+
+    def mark_compensated(self, step):
+        self.log(STEP_COMPENSATED, step=step.name)
+
+    def mark_failed(self, step):
+        self.log(STEP_FAILED, step=step.name)
+
+    def add_step(self, step: Step, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.dependencies:
+                raise ValueError(
+                    f"{step.name} depende de un paso no definido: {dependency}")
+        step.saga_id = self.saga_id
+        self.steps.append(step)
+        self.dependencies[step.name] = list(depends_on)
+
+    def send_data(self, raw_data, definition=None, retry_policies=None):
+        """
+        Crea los pasos del SAGA. `retry_policies` permite sobrescribir la
+        política de reintentos por tipo de paso, p.ej.
+        {"create_quota": RetryPolicy(max_retries=2)}.
+        """
+        if self.steps:
+            # Orquestador reutilizado: es una saga nueva, con su propio saga_id
+            # (y claves de idempotencia) y sin los pasos de la anterior
+            self._reset()
+        self.raw_data = raw_data
+        policies = dict(RETRY_POLICIES, **(retry_policies or {}))
+        names = {}
+        for step_type, depends_on in definition or SAGA_DEFINITION:
+            step = StepFactory.create(step_type, data=raw_data,
+                                      retry_policy=policies.get(step_type))
+            names[step_type] = step.name
+            self.add_step(step, [names[dep] for dep in depends_on])
+
+    def levels(self):
+        """Agrupa los pasos en niveles; los pasos de un nivel son independientes"""
+        levels, finished = [], set()
+        while len(finished) < len(self.steps):
+            level = self.ready_steps(finished, finished)
+            if not level:
+                raise ValueError("El grafo de pasos tiene un ciclo")
+            levels.append(level)
+            finished.update(step.name for step in level)
+        return levels
+
+    def ready_steps(self, finished, started):
+        """Pasos no iniciados cuyas dependencias ya terminaron"""
+        return [step for step in self.steps
+                if step.name not in started
+                and all(dep in finished for dep in self.dependencies[step.name])]
+
+
+class SagaOrchestrator(SagaGraph):
+
+    def submit_step(self, step, attempt=0) -> Future:
+        """
+        Ejecuta un paso con su política de reintentos sin bloquear ningún
+        hilo durante el backoff. El Future se resuelve con (status, respuesta).
+        Con attempt > 0 el paso ya se intentó (p.ej. en un lote de bulk.py):
+        STEP_STARTED ya está en el log y se sigue desde ese reintento.
+        """
+        self.logger.debug("➡️ Ejecutando paso: %s", step.name, extra={"step": step.name})
+        if attempt == 0:
+            self.mark_started(step)
+
+        future = Future()
+        _step_executor.submit(self._attempt, step, attempt, future)
+        return future
+
+    def _attempt(self, step, attempt, future):
+        """
+        Corre en el pool o en el planificador de reintentos, donde una
+        excepción se perdería: cualquier error inesperado resuelve el Future
+        del paso con esa excepción para que la saga termine y compense.
+        """
         try:
-            for step in self.steps:
-                print(f"➡️ Ejecutando paso: {step.name}")
+            self._try_step(step, attempt, future)
+        except Exception as e:
+            self.logger.exception("❌ Error inesperado en %s (intento %d): %s",
+                                  step.name, attempt, e, extra={"step": step.name})
+            if not future.done():
+                future.set_exception(e)
+
+    def _try_step(self, step, attempt, future):
+        policy = step.retry_policy
+        breaker = get_breaker(step.name)
+        if not breaker.allow():
+            # Servicio caído: la saga falla ya y compensa, sin gastar timeouts
+            future.set_result((False, reject_open_circuit(step)))
+            return
+
+        if attempt > 0:
+            saga_metrics.record_retry()
+            self.logger.info("🔄 Retry %d/%d en %s", attempt, policy.max_retries, step.name,
+                             extra={"step": step.name})
+
+        started_at = time.perf_counter()
+        try:
+            response = step.execute()
+        except Exception as e:
+            self.logger.warning("❌ Error en %s (intento %d): %s", step.name, attempt, e,
+                                extra={"step": step.name})
+            response = {"status": False}
+        saga_metrics.record_step_time(step.name, "retry" if attempt > 0 else "execute",
+                                      time.perf_counter() - started_at)
+
+        if response["status"]:
+            if attempt > 0:
+                self.logger.info("✅ Éxito en retry %d", attempt, extra={"step": step.name})
+            future.set_result((True, response))
+            return
+
+        # Si otra rama ya falló, la saga se va a compensar: no vale la pena
+        # reintentar; tampoco si este fallo abrió el circuito
+        if attempt < policy.max_retries and not self.aborted and not breaker.is_open():
+            wait_time = policy.delay_before(attempt + 1)
+            if wait_time > 0:
+                self.logger.debug("⏱ Esperando %.2fs antes del siguiente retry...", wait_time,
+                                  extra={"step": step.name})
+            handle = retry_scheduler.call_later(wait_time, self._attempt,
+                                                step, attempt + 1, future)
+            if handle is not None:
+                with self._parked_lock:
+                    self._parked[step.name] = (handle, future, response)
+                if self.aborted:
+                    # Otra rama falló mientras se estacionaba
+                    self.cancel_retries()
+        else:
+            future.set_result((False, response))
+
+    def cancel_retries(self):
+        """
+        Descarta los reintentos estacionados de la saga: se va a compensar y
+        no tiene sentido esperar su backoff. Cada paso termina con su última
+        respuesta fallida.
+        """
+        with self._parked_lock:
+            parked, self._parked = self._parked, {}
+        for step_name, (handle, future, response) in parked.items():
+            if retry_scheduler.cancel(handle):
+                self.logger.info("⏹ Reintento cancelado en %s", step_name,
+                                 extra={"step": step_name})
+                future.set_result((False, response))
+
+    def submit(self) -> Future:
+        """Inicia la saga sin bloquear; el Future se resuelve con el estado final"""
+        saga_metrics.record_saga_start()
 
+        self.logger.info("☸️ Iniciando Saga Orchestrator...")
+        self.start()
+        return self._submit_graph(time.time())
+
+    def execute_saga(self):
+        return self.submit().result()
+
+    def resume_saga(self):
+        """Continúa una saga recuperada del log desde sus pasos completados"""
+        self.logger.info("☸️ Reanudando saga %s...", self.saga_id)
+        return self._submit_graph(time.time()).result()
+
+    def _submit_graph(self, start_time):
+        """
+        Lanza cada paso en cuanto sus dependencias terminan. Si un paso falla
+        no se lanzan pasos nuevos, pero se espera a los que ya están en vuelo
+        para poder compensarlos.
+        """
+        saga_future = Future()
+        lock = threading.Lock()
+        self.aborted = False
+        # Al reanudar una saga recuperada se parte de los pasos ya completados
+        finished = {step.name for step in self.completed}
+        started = set(finished)
+        progress = {'running': 0, 'failure': None}
+
+        def take_ready():
+            if progress['failure'] is not None:
+                return []
+            ready = self.ready_steps(finished, started)
+            for step in ready:
+                started.add(step.name)
+            progress['running'] += len(ready)
+            return ready
+
+        def launch(ready, done):
+            for step in ready:
                 try:
-                    response = step.execute()
+                    future = self.submit_step(step)
                 except Exception as e:
-                    print(f"❌ Error en {step.name}: {e}")
-                    response = {"status": False}
-
-                status = response["status"]
-
-                if not status:
-                    max_retries = 5
-                    base_delay = 1
-                    max_delay = 60
-
-                    for i in range(max_retries):
-
-                        saga_metrics.record_retry()
-
-                        # Backoff exponencial: base_delay * (2^i)
-                        exponential_delay = base_delay * (2 ** i)
-
-                        # Agregar jitter (aleatoriedad ±25%)
-                        jitter = exponential_delay * \
-                            0.25 * random.uniform(-1, 1)
-                        wait_time = min(exponential_delay + jitter, max_delay)
-
-                        print(f"🔄 Retry {i+1}/{max_retries} en {step.name}")
-
-                        try:
-                            response = step.execute()
-                        except Exception as e:
-                            print(f"❌ Fallo en retry {i+1}: {e}")
-                            response = {"status": False}
-
-                        status = response["status"]
-                        if status:
-                            print(f"✅ Éxito en retry {i+1}")
-                            break
-
-                        if i < max_retries - 1:
-                            print(
-                                f"⏱ Esperando {wait_time:.2f}s antes del siguiente retry...")
-                            time.sleep(wait_time)
-
-                    if not status:
-                        print(
-                            f"❌ Fallo definitivo en {step.name} tras retries")
-                        self.send_to_dlq(step, response)
-                        self.compensate()
-
-                        execution_time = time.time() - start_time
-                        saga_metrics.record_saga_failure(
-                            step.name, execution_time)
-                        self.state = SagaState.COMPENSATED
-                        return
-
-                self.completed.append(step)
+                    # P.ej. el saga log no confirmó STEP_STARTED: el paso falla sin enviarse
+                    self.logger.exception("❌ No se pudo iniciar %s: %s", step.name, e,
+                                          extra={"step": step.name})
+                    future = Future()
+                    future.set_exception(e)
+                future.add_done_callback(
+                    lambda future, step=step: on_step_done(step, future))
+            if done:
+                _step_executor.submit(self._finish, start_time,
+                                      progress['failure'], saga_future)
+
+        def on_step_done(step, future):
+            # Los callbacks de un Future tragan sus excepciones: si alguna se
+            # escapara de aquí, saga_future no se resolvería nunca
+            try:
+                status, response = future.result()
+            except Exception as e:
+                status, response = False, {"status": False, "error": repr(e)}
+            with lock:
+                progress['running'] -= 1
+                try:
+                    if status:
+                        self.mark_completed(step)
+                        finished.add(step.name)
+                except Exception as e:
+                    self.logger.exception("❌ Error al registrar %s: %s", step.name, e,
+                                          extra={"step": step.name})
+                    status, response = False, {"status": False, "error": repr(e)}
+                aborting = not status and progress['failure'] is None
+                if aborting:
+                    progress['failure'] = (step, response)
+                    self.aborted = True
+                ready = take_ready()
+                done = progress['running'] == 0
+            launch(ready, done)
+            if aborting:
+                # Fuera del lock: cancelar resuelve Futures que vuelven a entrar aquí
+                self.cancel_retries()
+
+        with lock:
+            ready = take_ready()
+            done = progress['running'] == 0
+        launch(ready, done)
+        return saga_future
+
+    def _finish(self, start_time, failure, saga_future):
+        try:
+            self._complete(start_time, failure)
+        finally:
+            saga_future.set_result(self.state)
 
-            execution_time = time.time() - start_time
-            saga_metrics.record_saga_success(execution_time)
-            self.state = SagaState.SUCCEEDED
-            print("✅ Saga completada")
+    def _complete(self, start_time, failure):
+        try:
+            if failure is not None:
+                step, response = failure
+                self.logger.error("❌ Fallo definitivo en %s tras retries", step.name,
+                                  extra={"step": step.name})
+                self.mark_failed(step)
+                self.send_to_dlq(step, response)
+                self.compensate()
+
+                execution_time = time.time() - start_time
+                saga_metrics.record_saga_failure(
+                    step.name, execution_time)
+                self.set_state(SagaState.COMPENSATED)
+            else:
+                execution_time = time.time() - start_time
+                saga_metrics.record_saga_success(execution_time)
+                self.set_state(SagaState.SUCCEEDED)
+                self.logger.info("✅ Saga completada")
 
         except Exception as e:
-            print(f"❌ Error inesperado en saga: {e}")
+            self.logger.exception("❌ Error inesperado en saga: %s", e)
             self.compensate()
 
             execution_time = time.time() - start_time
             saga_metrics.record_saga_failure("Exception", execution_time)
-            self.state = SagaState.COMPENSATED
+            self.set_state(SagaState.COMPENSATED)
 
     def compensate(self):
         compensation_start = time.time()
-        print("🔁 Iniciando compensación...")
-        self.state = SagaState.COMPENSATING
+        self.logger.info("🔁 Iniciando compensación...")
+        self.set_state(SagaState.COMPENSATING)
 
+        # Solo los pasos completados, en orden topológico inverso
         for step in reversed(self.completed):
+            started_at = time.perf_counter()
             step.rollback()
+            saga_metrics.record_step_time(step.name, "rollback",
+                                          time.perf_counter() - started_at)
+            self.mark_compensated(step)
 
         compensation_time = time.time() - compensation_start
         saga_metrics.record_compensation_time(compensation_time)
 
-        print("✅ Compensación completada")
+        self.logger.info("✅ Compensación completada")
 
     def send_to_dlq(self, step, last_response):
         """Envía el paso fallido al DLQ para análisis posterior"""
-        dlq_message = {
-            'type': 'FailedStep',
-            'step_name': step.name,
-            'step_data': step.data,
-            'last_response': last_response,
-            'timestamp': time.time(),
-            'retry_attempts': 5
-        }
-
+        dlq_message = build_dlq_message(step, last_response)
+
+        # No bloquea: el publicador agrupa los envíos y, si el broker no
+        # responde, guarda el mensaje en disco para reenviarlo después
+        get_dlq_publisher().publish(dlq_message)
+
+        # Registrar mensaje enviado al DLQ
+        saga_metrics.record_dlq()
+        self.logger.info("Paso fallido enviado a DLQ: %s", step.name, extra={"step": step.name})
+
+
+def resolve_unconfirmed(saga):
+    """
+    Consulta al broker los pasos iniciados sin respuesta registrada: los
+    que se aplicaron pasan a completados (con su id para el rollback) y los
+    demás quedan cancelados en el broker, así que un comando que siga en
+    una cola ya no se aplicará.
+    """
+    for step in list(saga.unconfirmed):
+        if step.resolve():
+            saga.mark_completed(step)
+        saga.unconfirmed.remove(step)
+
+
+def recover_sagas(saga_log=None, mode="compensate"):
+    """
+    Recorre las sagas que quedaron sin terminar por una caída del
+    orquestador. Con mode="compensate" revierte sus pasos completados y
+    los iniciados que el broker llegó a aplicar; con mode="resume"
+    continúa las que estaban en RUNNING (los pasos sin confirmar se
+    vuelven a enviar con la misma clave de idempotencia, así que no se
+    aplican dos veces). Las que estaban compensando siempre terminan su
+    compensación.
+
+    Solo se debe ejecutar cuando ningún orquestador que escriba en el
+    mismo log está corriendo (ver `python saga_log.py`): una saga en curso
+    en otro proceso también figura como sin terminar.
+    """
+    saga_log = saga_log or get_saga_log()
+    if saga_log is None:
+        return []
+
+    recovered = []
+    for saga_id, state in saga_log.unfinished():
         try:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters('localhost'))
-            channel = connection.channel()
-
-            channel.basic_publish(
-                exchange='saga_exchange',
-                routing_key='saga_dlq',  # Usa el routing_key correcto
-                body=json.dumps(dlq_message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2)  # Mensaje persistente
-            )
-
-            connection.close()
-
-            # Registrar mensaje enviado al DLQ
-            saga_metrics.record_dlq()
-            print(f" Paso fallido enviado a DLQ: {step.name}")
+            saga = SagaOrchestrator.restore(saga_id, saga_log)
         except Exception as e:
-            print(f" Error al enviar a DLQ: {e}")
+            logger.error("❌ No se pudo reconstruir la saga %s: %s", saga_id, e,
+                         extra={"saga_id": saga_id})
+            continue
+
+        if state == SagaState.RUNNING.value and mode == "resume":
+            saga.resume_saga()
+        else:
+            try:
+                resolve_unconfirmed(saga)
+            except Exception as e:
+                # Sin saber si el paso se aplicó no se puede compensar: queda
+                # sin terminar para el próximo intento
+                saga.logger.error("❌ No se pudo consultar al broker por la saga %s: %s",
+                                  saga_id, e)
+                continue
+            saga.logger.info("🔁 Compensando saga recuperada %s...", saga_id)
+            saga.compensate()
+            saga.set_state(SagaState.COMPENSATED)
+        recovered.append(saga)
+    return recovered
@@ -0,0 +1,110 @@
+"""
+Política de reintentos por paso y planificador de reintentos diferidos.
+
+En lugar de dormir el hilo durante el backoff, el paso fallido se
+estaciona en un heap de temporizadores y un único hilo lo vuelve a
+entregar al pool de workers cuando vence la espera. Mientras tanto los
+workers quedan libres para atender otras sagas.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+from logger import get_logger
+
+logger = get_logger("retry")
+
+
+def backoff_delay(attempt, base_delay=1, max_delay=60, jitter=0.25):
+    """Backoff exponencial base_delay * (2^attempt) con jitter de ±25%"""
+    exponential_delay = base_delay * (2 ** attempt)
+    jitter = exponential_delay * jitter * random.uniform(-1, 1)
+    return min(exponential_delay + jitter, max_delay)
+
+
+class RetryPolicy:
+    def __init__(self, max_retries=5, base_delay=1, max_delay=60, jitter=0.25):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay_before(self, attempt):
+        """
+        Espera antes del intento `attempt` (0 = ejecución inicial). El primer
+        reintento es inmediato y luego la espera crece exponencialmente.
+        """
+        if attempt <= 1:
+            return 0
+        return backoff_delay(attempt - 2, self.base_delay, self.max_delay, self.jitter)
+
+    def __repr__(self):
+        return (f"RetryPolicy(max_retries={self.max_retries}, base_delay={self.base_delay}, "
+                f"max_delay={self.max_delay}, jitter={self.jitter})")
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class RetryScheduler:
+    def __init__(self, executor):
+        self.executor = executor
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, fn, *args):
+        """
+        Ejecuta fn(*args) en el executor cuando pasen `delay` segundos.
+        Retorna un identificador para cancel(), o None si se entregó ya.
+        """
+        if delay <= 0:
+            self.executor.submit(fn, *args)
+            return None
+
+        with self._condition:
+            handle = next(self._counter)
+            heapq.heappush(self._heap, (time.monotonic() + delay, handle, fn, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="saga-retry-scheduler",
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return handle
+
+    def cancel(self, handle):
+        """Descarta un reintento estacionado; False si ya se entregó al executor"""
+        with self._condition:
+            for i, entry in enumerate(self._heap):
+                if entry[1] == handle:
+                    self._heap[i] = self._heap[-1]
+                    self._heap.pop()
+                    heapq.heapify(self._heap)
+                    self._condition.notify()
+                    return True
+        return False
+
+    def pending(self):
+        """Reintentos estacionados esperando su backoff"""
+        with self._condition:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                due, _, fn, args = self._heap[0]
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                heapq.heappop(self._heap)
+            try:
+                self.executor.submit(fn, *args)
+            except Exception as e:
+                # P.ej. el pool ya se cerró; el hilo sigue para los demás reintentos
+                logger.error("No se pudo entregar un reintento al pool: %s", e)
@@ -0,0 +1,89 @@
+"""
+Topología de colas del SAGA.
+
+Cada tipo de comando tiene su propia cola y routing key derivada del
+`type` del evento, para que un backlog en un paso no retrase a los demás.
+Los comandos de compensación (Composite*) van a un carril propio para que
+los rollbacks no esperen detrás de los pasos normales.
+"""
+
+EXCHANGE_NAME = "saga_exchange"
+# Cola compartida original; se mantiene para el outbox y clientes antiguos
+COMMAND_QUEUE_NAME = "saga_commands"
+DLQ_QUEUE_NAME = "saga_dlq"
+COMPENSATION_QUEUE_NAME = "saga_compensations"
+
+STEP_COMMANDS = ["ProvisionUser", "AssignPermissions", "CreateQuota"]
+# Versiones por lotes de los pasos (ver bulk.py); cada una con su propia cola.
+# ProvisionAccountBatch escribe los tres pasos juntos (SAGA_STORAGE=single)
+BATCH_COMMANDS = [f"{evt_type}Batch" for evt_type in STEP_COMMANDS] + ["ProvisionAccountBatch"]
+# ResolveCommand (la consulta de la recuperación, ver RpcStep.resolve) va
+# en el mismo carril: solo se envía para compensar
+COMPENSATION_COMMANDS = ["CompositeProvisionUser",
+                         "CompositeAssignPermissions", "CompositeCreateQuota",
+                         "ResolveCommand"]
+
+# Nombres aceptados al elegir qué colas consume un worker
+COMPENSATIONS = "compensations"
+LEGACY = "legacy"
+
+
+def is_compensation(evt_type):
+    return evt_type in COMPENSATION_COMMANDS
+
+
+def routing_key_for(evt_type):
+    # Los tipos sin cola propia siguen yendo a la cola compartida
+    if evt_type not in STEP_COMMANDS + BATCH_COMMANDS and not is_compensation(evt_type):
+        return COMMAND_QUEUE_NAME
+    return f"saga.{evt_type}"
+
+
+def queue_for(evt_type):
+    if is_compensation(evt_type):
+        return COMPENSATION_QUEUE_NAME
+    return f"{COMMAND_QUEUE_NAME}.{evt_type}"
+
+
+def queues_for(subscriptions=None):
+    """
+    Traduce una lista de suscripciones (tipos de comando, 'compensations'
+    o 'legacy') a nombres de cola. Sin suscripciones se consumen todas.
+    """
+    if not subscriptions:
+        subscriptions = STEP_COMMANDS + BATCH_COMMANDS + [COMPENSATIONS, LEGACY]
+
+    queues = []
+    for name in subscriptions:
+        if name == COMPENSATIONS:
+            queue = COMPENSATION_QUEUE_NAME
+        elif name == LEGACY:
+            queue = COMMAND_QUEUE_NAME
+        elif name in STEP_COMMANDS + BATCH_COMMANDS + COMPENSATION_COMMANDS:
+            queue = queue_for(name)
+        else:
+            raise ValueError(f"Tipo de comando desconocido: {name}")
+        if queue not in queues:
+            queues.append(queue)
+    return queues
+
+
+def declare_topology(channel):
+    channel.exchange_declare(exchange=EXCHANGE_NAME,
+                             exchange_type="direct", durable=True)
+
+    channel.queue_declare(queue=COMMAND_QUEUE_NAME, durable=True)
+    channel.queue_declare(queue=DLQ_QUEUE_NAME, durable=True)
+    channel.queue_declare(queue=COMPENSATION_QUEUE_NAME, durable=True)
+
+    channel.queue_bind(exchange=EXCHANGE_NAME,
+                       queue=COMMAND_QUEUE_NAME, routing_key=COMMAND_QUEUE_NAME)
+    channel.queue_bind(exchange=EXCHANGE_NAME,
+                       queue=DLQ_QUEUE_NAME, routing_key=DLQ_QUEUE_NAME)
+
+    for evt_type in STEP_COMMANDS + BATCH_COMMANDS + COMPENSATION_COMMANDS:
+        queue = queue_for(evt_type)
+        if not is_compensation(evt_type):
+            channel.queue_declare(queue=queue, durable=True)
+        channel.queue_bind(exchange=EXCHANGE_NAME,
+                           queue=queue, routing_key=routing_key_for(evt_type))
@@ -0,0 +1,136 @@
+"""
+Cliente RPC reutilizable sobre RabbitMQ.
+
+Mantiene una sola conexión y una sola cola de respuesta por hilo, y
+empareja las respuestas por correlation_id, de modo que se pueden tener
+varias peticiones en vuelo sobre la misma conexión.
+"""
+import threading
+import time
+import uuid
+import pika
+from routing import EXCHANGE_NAME, routing_key_for
+from codec import get_codec, decode
+
+_local = threading.local()
+
+
+class RpcClient:
+    def __init__(self, host='localhost'):
+        self.host = host
+        self.connection = None
+        self.channel = None
+        self.callback_queue = None
+        # correlation_id -> respuesta recibida
+        self.responses = {}
+        # correlation_ids que todavía esperan respuesta
+        self.pending = set()
+        self.codec = get_codec()
+
+    def connect(self):
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(self.host))
+        self.channel = self.connection.channel()
+
+        result = self.channel.queue_declare(queue='', exclusive=True)
+        self.callback_queue = result.method.queue
+
+        self.channel.basic_consume(queue=self.callback_queue,
+                                   on_message_callback=self._on_response,
+                                   auto_ack=True)
+
+    def is_open(self):
+        return (self.connection is not None and self.connection.is_open
+                and self.channel is not None and self.channel.is_open)
+
+    def close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+        self.callback_queue = None
+        self.responses.clear()
+        self.pending.clear()
+
+    def _on_response(self, ch, method, props, body):
+        corr_id = props.correlation_id
+        # Las respuestas que llegan después del timeout se descartan
+        if corr_id in self.pending:
+            self.responses[corr_id] = decode(body, props.content_type)
+
+    def _publish(self, event, corr_id):
+        self.channel.basic_publish(
+            exchange=EXCHANGE_NAME,
+            routing_key=routing_key_for(event.get('type')),
+            body=self.codec.encode(event),
+            properties=pika.BasicProperties(
+                content_type=self.codec.content_type,
+                reply_to=self.callback_queue,
+                correlation_id=corr_id,
+                delivery_mode=2,
+            ),
+        )
+
+    def send(self, event: dict) -> str:
+        """Publica el comando sin esperar la respuesta y retorna su correlation_id"""
+        corr_id = uuid.uuid4().hex
+
+        if not self.is_open():
+            self.close()
+            self.connect()
+
+        self.pending.add(corr_id)
+        try:
+            self._publish(event, corr_id)
+        except pika.exceptions.AMQPError:
+            # Conexión caída: se reconecta una vez y se reintenta la publicación
+            self.close()
+            self.connect()
+            self.pending.add(corr_id)
+            self._publish(event, corr_id)
+        return corr_id
+
+    def wait(self, corr_id: str, timeout: float = 5.0):
+        """Espera la respuesta de un comando enviado con send(); None si vence el timeout"""
+        deadline = time.monotonic() + timeout
+        try:
+            while corr_id not in self.responses:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.connection.process_data_events(time_limit=remaining)
+            return self.responses.pop(corr_id)
+        except pika.exceptions.AMQPError:
+            self.close()
+            raise
+        finally:
+            self.pending.discard(corr_id)
+
+    def call(self, event: dict, timeout: float = 5.0):
+        return self.wait(self.send(event), timeout)
+
+    def call_many(self, events, timeout: float = 5.0):
+        """Envía todos los comandos y luego recoge las respuestas en el mismo orden"""
+        corr_ids = [self.send(event) for event in events]
+        deadline = time.monotonic() + timeout
+        return [self.wait(corr_id, max(deadline - time.monotonic(), 0))
+                for corr_id in corr_ids]
+
+
+def get_rpc_client() -> RpcClient:
+    """Retorna el cliente RPC del hilo actual, creándolo si no existe"""
+    client = getattr(_local, 'client', None)
+    if client is None:
+        client = RpcClient()
+        _local.client = client
+    return client
+
+
+def close_rpc_client():
+    client = getattr(_local, 'client', None)
+    if client is not None:
+        client.close()
+        _local.client = None
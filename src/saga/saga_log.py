@@ -0,0 +1,303 @@
+"""
+Log durable de las sagas.
+
+Cada transición de estado y cada paso iniciado, completado o compensado se
+guarda como un registro en SQLite. Las escrituras se encolan y un hilo las
+confirma por lotes (group commit), así que registrar no bloquea el hot
+path. La excepción es STEP_STARTED, que se escribe antes de enviar el
+comando (write-ahead): append(durable=True) retorna un Future que se
+resuelve con el commit, y el hilo escritor no espera a completar el lote
+si hay uno de esos registros pendiente. Así, tras una caída, todo comando
+que el broker pudo aplicar tiene su STEP_STARTED en el log (ver
+orchestrator.recover_sagas). La tabla saga_state guarda el último estado de cada saga (con su
+usuario y el paso que falló) indexado por estado y por usuario, de modo
+que la recuperación y las consultas (ver saga_query.py) nunca recorren el
+log completo.
+"""
+from concurrent.futures import Future
+from pathlib import Path
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from logger import get_logger
+
+# Ruta del log; vacío lo deshabilita (ver get_saga_log)
+SAGA_LOG_PATH = os.getenv("SAGA_LOG_PATH", "")
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 0.05
+
+# Estados a partir de los cuales una saga se considera sin terminar
+UNFINISHED_STATES = ("RUNNING", "COMPENSATING")
+
+# Eventos del log
+SAGA_STARTED = "SAGA_STARTED"
+STATE_CHANGED = "STATE_CHANGED"
+STEP_STARTED = "STEP_STARTED"
+STEP_COMPLETED = "STEP_COMPLETED"
+STEP_COMPENSATED = "STEP_COMPENSATED"
+STEP_FAILED = "STEP_FAILED"
+
+# Columnas agregadas a saga_state después de la versión original
+STATUS_COLUMNS = (("user_id", "TEXT"), ("failed_step", "TEXT"), ("started_at", "REAL"))
+
+STATUS_FIELDS = ("saga_id", "state", "user_id", "failed_step", "started_at", "updated_at")
+
+_STOP = object()
+
+logger = get_logger("saga_log")
+
+
+class SagaLogReader:
+    """
+    Consultas sobre un saga log existente con una conexión de solo lectura:
+    no crea el archivo ni toca el esquema, así que se puede abrir mientras
+    los orquestadores escriben (ver saga_query.py). En un log anterior a
+    STATUS_COLUMNS esas columnas se leen como None.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No existe el saga log: {path}")
+        self.path = path
+        self._read_lock = threading.Lock()
+        self._reader = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro",
+                                       uri=True, check_same_thread=False)
+        columns = {row[1] for row in self._reader.execute("PRAGMA table_info(saga_state)")}
+        self._status_select = ", ".join(field if field in columns else f"NULL AS {field}"
+                                        for field in STATUS_FIELDS)
+
+    def close(self):
+        self._reader.close()
+
+    # LECTURA
+
+    def unfinished(self):
+        """Sagas en RUNNING o COMPENSATING (usa el índice por estado)"""
+        placeholders = ", ".join("?" * len(UNFINISHED_STATES))
+        with self._read_lock:
+            return self._reader.execute(
+                f"SELECT saga_id, state FROM saga_state WHERE state IN ({placeholders})",
+                UNFINISHED_STATES
+            ).fetchall()
+
+    def status(self, saga_id):
+        """Fila de saga_state de una saga, o None si no está registrada"""
+        rows = self._statuses("WHERE saga_id=?", (saga_id,))
+        return rows[0] if rows else None
+
+    def statuses_for_user(self, user_id, limit=100):
+        """Sagas de un usuario, de la más reciente a la más antigua"""
+        return self._statuses("WHERE user_id=? ORDER BY updated_at DESC LIMIT ?",
+                              (user_id, limit))
+
+    def statuses_by_state(self, state, limit=100, after=None):
+        """
+        Sagas en `state` ordenadas por (updated_at, saga_id). `after` es la
+        clave de la última fila de la página anterior: la siguiente página
+        empieza en el índice, sin saltar filas con OFFSET.
+        """
+        if after is None:
+            return self._statuses("WHERE state=? ORDER BY updated_at, saga_id LIMIT ?",
+                                  (state, limit))
+        return self._statuses(
+            "WHERE state=? AND (updated_at, saga_id) > (?, ?) "
+            "ORDER BY updated_at, saga_id LIMIT ?",
+            (state, *after, limit))
+
+    def _statuses(self, where, params):
+        with self._read_lock:
+            rows = self._reader.execute(
+                f"SELECT {self._status_select} FROM saga_state {where}", params
+            ).fetchall()
+        return [dict(zip(STATUS_FIELDS, row)) for row in rows]
+
+    def entries(self, saga_id):
+        """Registros de una saga en orden de escritura"""
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT event, step, state, payload FROM saga_log "
+                "WHERE saga_id=? ORDER BY id",
+                (saga_id,)
+            ).fetchall()
+        return [{'event': event, 'step': step, 'state': state,
+                 'payload': json.loads(payload) if payload is not None else None}
+                for event, step, state, payload in rows]
+
+
+class SagaLog(SagaLogReader):
+    def __init__(self, path, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # El hilo escritor es el único que escribe; las lecturas usan otra conexión
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        super().__init__(path)
+
+        self.writer = threading.Thread(target=self._run_writer,
+                                       name="saga-log-writer", daemon=True)
+        self.writer.start()
+
+    def _create_schema(self):
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS saga_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                saga_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                step TEXT,
+                state TEXT,
+                payload TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_saga_log_saga ON saga_log(saga_id, id);
+            CREATE TABLE IF NOT EXISTS saga_state (
+                saga_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        ''')
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(saga_state)")}
+        for column, column_type in STATUS_COLUMNS:
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE saga_state ADD COLUMN {column} {column_type}")
+        # (state, updated_at, saga_id) sirve a unfinished() y a la paginación por cursor
+        self.conn.executescript('''
+            DROP INDEX IF EXISTS idx_saga_state_state;
+            CREATE INDEX IF NOT EXISTS idx_saga_state_listing
+                ON saga_state(state, updated_at, saga_id);
+            CREATE INDEX IF NOT EXISTS idx_saga_state_user ON saga_state(user_id, updated_at);
+        ''')
+        self.conn.commit()
+
+    # ESCRITURA
+
+    def append(self, saga_id, event, step=None, state=None, payload=None, durable=False):
+        """
+        Encola un registro; se confirma en el siguiente lote. Con durable=True
+        retorna un Future que se resuelve cuando el registro está confirmado
+        (o con la excepción si no se pudo escribir).
+        """
+        committed = Future() if durable else None
+        self.queue.put(((saga_id, event, step, state,
+                         json.dumps(payload) if payload is not None else None,
+                         time.time()), committed))
+        return committed
+
+    @staticmethod
+    def _user_id(payload):
+        try:
+            return json.loads(payload)['user']['id']
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def flush(self):
+        """Bloquea hasta que todos los registros encolados estén confirmados"""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.writer.join()
+        self.conn.close()
+        super().close()
+
+    def _run_writer(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            waiting = batch[0] is not _STOP and batch[0][1] is not None
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                try:
+                    # Con un registro durable pendiente solo se junta lo ya encolado
+                    timeout = 0 if waiting else max(deadline - time.monotonic(), 0)
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                waiting = waiting or (batch[-1] is not _STOP and batch[-1][1] is not None)
+
+            stop = batch[-1] is _STOP
+            entries = [entry for entry in batch if entry is not _STOP]
+            try:
+                if entries:
+                    self._write([record for record, _ in entries])
+            except Exception as e:
+                logger.error("Error al escribir el saga log: %s", e)
+                for _, committed in entries:
+                    if committed is not None:
+                        committed.set_exception(e)
+            else:
+                for _, committed in entries:
+                    if committed is not None:
+                        committed.set_result(None)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _write(self, records):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO saga_log (saga_id, event, step, state, payload, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                records
+            )
+            self.conn.executemany(
+                "INSERT INTO saga_state (saga_id, state, user_id, started_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(saga_id) DO UPDATE SET state=excluded.state, "
+                "updated_at=excluded.updated_at",
+                [(saga_id, state,
+                  self._user_id(payload) if event == SAGA_STARTED else None,
+                  created_at, created_at)
+                 for saga_id, event, _, state, payload, created_at in records
+                 if state is not None]
+            )
+            self.conn.executemany(
+                "UPDATE saga_state SET failed_step=? WHERE saga_id=?",
+                [(step, saga_id) for saga_id, event, step, _, _, _ in records
+                 if event == STEP_FAILED]
+            )
+
+
+_saga_log = None
+_saga_log_lock = threading.Lock()
+
+
+def get_saga_log():
+    """Log compartido del proceso, o None si SAGA_LOG_PATH no está definido"""
+    global _saga_log
+    if not SAGA_LOG_PATH:
+        return None
+    with _saga_log_lock:
+        if _saga_log is None:
+            _saga_log = SagaLog(SAGA_LOG_PATH)
+    return _saga_log
+
+
+if __name__ == "__main__":
+    import argparse
+    from orchestrator import recover_sagas
+
+    parser = argparse.ArgumentParser(
+        description="Recupera sagas sin terminar del saga log. Ejecutar solo con los "
+                    "orquestadores que escriben en el log detenidos")
+    parser.add_argument("--path", default=SAGA_LOG_PATH or os.path.join("db", "saga_log.db"))
+    parser.add_argument("--mode", choices=["compensate", "resume"], default="compensate")
+    args = parser.parse_args()
+
+    saga_log = SagaLog(args.path)
+    print(f"Recuperando sagas sin terminar (modo {args.mode})...")
+    recovered = recover_sagas(saga_log, args.mode)
+    print(f"Sagas recuperadas: {len(recovered)}")
+    saga_log.close()
@@ -0,0 +1,112 @@
+"""
+Consultas sobre el estado de las sagas.
+
+Lee la tabla saga_state del saga log (ver saga_log.py), que el orquestador
+actualiza en cada cambio de estado, así que requiere SAGA_LOG_PATH. La
+línea de comandos abre el log en solo lectura (SagaLogReader): no lo crea
+ni migra su esquema, y se puede usar con los orquestadores en marcha. Cada
+consulta usa un índice: por saga_id (clave primaria), por user_id y por
+estado. El listado por estado se pagina con un cursor (updated_at, saga_id)
+en lugar de OFFSET, de modo que cada página cuesta O(log n + limit) sin
+importar cuántas filas queden antes.
+
+    python saga_query.py saga <saga_id>
+    python saga_query.py user <user_id>
+    python saga_query.py list COMPENSATED --limit 20 [--after CURSOR]
+"""
+from saga_log import SagaLogReader, get_saga_log, SAGA_LOG_PATH
+from state import SagaState
+import argparse
+import os
+import time
+
+PAGE_SIZE = 50
+
+
+def _log(saga_log):
+    saga_log = saga_log or get_saga_log()
+    if saga_log is None:
+        raise RuntimeError("El saga log está deshabilitado: definir SAGA_LOG_PATH")
+    return saga_log
+
+
+def encode_cursor(status):
+    return f"{status['updated_at']!r}:{status['saga_id']}"
+
+
+def decode_cursor(cursor):
+    updated_at, saga_id = cursor.split(":", 1)
+    return float(updated_at), saga_id
+
+
+def get_saga(saga_id, saga_log=None):
+    """Estado de una saga: saga_id, state, user_id, failed_step, started_at, updated_at"""
+    return _log(saga_log).status(saga_id)
+
+
+def sagas_for_user(user_id, limit=PAGE_SIZE, saga_log=None):
+    """Sagas de un usuario, de la más reciente a la más antigua"""
+    return _log(saga_log).statuses_for_user(user_id, limit)
+
+
+def list_sagas(state, limit=PAGE_SIZE, cursor=None, saga_log=None):
+    """
+    Una página de sagas en `state` (SagaState o su valor), de la que lleva
+    más tiempo en ese estado a la más reciente. Retorna (filas, cursor de
+    la página siguiente o None si no hay más).
+    """
+    state = SagaState(getattr(state, 'value', state)).value
+    after = decode_cursor(cursor) if cursor else None
+    rows = _log(saga_log).statuses_by_state(state, limit, after)
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == limit else None
+    return rows, next_cursor
+
+
+def format_status(status):
+    started_at = time.strftime("%Y-%m-%d %H:%M:%S",
+                               time.localtime(status['started_at'] or status['updated_at']))
+    age = time.time() - status['updated_at']
+    failed = f" falló en {status['failed_step']}" if status['failed_step'] else ""
+    return (f"{status['saga_id']}  {status['state']:<12} user={status['user_id']} "
+            f"inicio={started_at} (hace {age:.0f}s en el estado){failed}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consulta el estado de las sagas")
+    parser.add_argument("--path", default=SAGA_LOG_PATH or os.path.join("db", "saga_log.db"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    saga = commands.add_parser("saga", help="Estado de una saga")
+    saga.add_argument("saga_id")
+    user = commands.add_parser("user", help="Sagas de un usuario")
+    user.add_argument("user_id")
+    user.add_argument("--limit", type=int, default=PAGE_SIZE)
+    listing = commands.add_parser("list", help="Sagas en un estado, paginadas")
+    listing.add_argument("state", choices=[state.value for state in SagaState])
+    listing.add_argument("--limit", type=int, default=PAGE_SIZE)
+    listing.add_argument("--after", default=None,
+                         help="Cursor impreso al final de la página anterior")
+    args = parser.parse_args(argv)
+
+    saga_log = SagaLogReader(args.path)
+    try:
+        if args.command == "saga":
+            status = get_saga(args.saga_id, saga_log)
+            print(format_status(status) if status else f"Saga {args.saga_id} no encontrada")
+            return status
+        if args.command == "user":
+            rows = sagas_for_user(args.user_id, args.limit, saga_log)
+            next_cursor = None
+        else:
+            rows, next_cursor = list_sagas(args.state, args.limit, args.after, saga_log)
+        for status in rows:
+            print(format_status(status))
+        print(f"{len(rows)} sagas")
+        if next_cursor:
+            print(f"Página siguiente: --after {next_cursor}")
+        return rows
+    finally:
+        saga_log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 from typing import Any, Dict, Optional
 from abc import ABC, abstractmethod
-import json
-import time
+import asyncio
 import sqlite3
+import time
 import uuid
-import pika
+from transport import get_transport
+from retry import DEFAULT_RETRY_POLICY
+from circuit_breaker import get_breaker
+from idempotency import idempotency_key
+from metrics import saga_metrics
+from logger import get_logger, bind
+
+logger = get_logger("steps")
 
 
 def get_connection(db_type):
@@ -12,68 +19,164 @@ def get_connection(db_type):
 
 
 def rpc_call(event: dict, timeout: float = 5.0) -> dict:
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters('localhost'))
-    channel = connection.channel()
+    # El transporte (RabbitMQ o en memoria) se elige con SAGA_TRANSPORT
+    return get_transport().call(event, timeout)
 
-    result = channel.queue_declare(queue='', exclusive=True)
-    callback_queue = result.method.queue
 
-    corr_id = str(time.time())
-    response = {'received': False, 'body': None}
+def rpc_call_many(events, timeout: float = 5.0) -> list:
+    return get_transport().call_many(events, timeout)
 
-    def on_response(ch, method, props, body):
-        if props.correlation_id == corr_id:
-            response['body'] = json.loads(body)
-            response['received'] = True
 
-    channel.basic_consume(queue=callback_queue,
-                          on_message_callback=on_response, auto_ack=True)
+async def async_rpc_call(event: dict, timeout: float = 5.0) -> dict:
+    return await get_transport().call_async(event, timeout)
 
-    channel.basic_publish(
-        exchange='saga_exchange',
-        routing_key='saga_commands',
-        body=json.dumps(event),
-        properties=pika.BasicProperties(
-            reply_to=callback_queue,
-            correlation_id=corr_id,
-            delivery_mode=2,
-        ),
-    )
 
-    start = time.time()
-    while not response['received'] and (time.time() - start) < timeout:
-        connection.process_data_events(time_limit=0.1)
+class Step(ABC):
+    # Cada paso puede tener su propia política (ver retry.RetryPolicy)
+    retry_policy = DEFAULT_RETRY_POLICY
+    # Campos que el paso agrega a `data` al completarse (los ids para el rollback)
+    result_fields = ()
+
+    @abstractmethod
+    def execute(self, *args, **kwargs) -> Any:
+        pass
 
-    connection.close()
+    @abstractmethod
+    def rollback(self, *args, **kwargs) -> None:
+        pass
 
-    return response['body']
+    async def execute_async(self) -> Any:
+        # Por defecto ejecuta la versión síncrona en un hilo aparte
+        return await asyncio.to_thread(self.execute)
 
+    async def rollback_async(self) -> None:
+        await asyncio.to_thread(self.rollback)
+
+
+class RpcStep(Step):
+    """
+    Paso que se ejecuta enviando un comando al message broker.
+    Las subclases construyen los comandos e interpretan las respuestas;
+    el transporte (síncrono o asyncio) lo decide esta clase.
+    """
+    # Lo asigna SagaGraph.add_step; con él los comandos llevan clave de idempotencia
+    saga_id = None
+
+    @property
+    def log(self):
+        return bind(logger, saga_id=self.saga_id, step=self.name)
 
-class Step(ABC):
     @abstractmethod
-    def execute(self, *args, **kwargs) -> Any:
+    def command(self) -> Dict:
         pass
 
     @abstractmethod
-    def rollback(self, *args, **kwargs) -> None:
+    def handle_result(self, result: Dict) -> Dict:
+        pass
+
+    @abstractmethod
+    def rollback_command(self) -> Optional[Dict]:
+        pass
+
+    @abstractmethod
+    def handle_rollback_result(self, result: Dict) -> None:
         pass
 
+    def _call(self, event: Dict, phase: Optional[str] = "rpc_wait") -> Dict:
+        """RPC con breaker; `phase` es la fase de métricas (None: no se mide)"""
+        breaker = get_breaker(self.name)
+        started_at = time.perf_counter()
+        try:
+            result = rpc_call(event)
+        except Exception:
+            breaker.record(False)
+            raise
+        if phase is not None:
+            saga_metrics.record_rpc(self.name, time.perf_counter() - started_at, result, phase)
+        # Sin respuesta (timeout) cuenta como fallo del servicio
+        breaker.record(result is not None)
+        return result
+
+    async def _call_async(self, event: Dict, phase: Optional[str] = "rpc_wait") -> Dict:
+        breaker = get_breaker(self.name)
+        started_at = time.perf_counter()
+        try:
+            result = await async_rpc_call(event)
+        except Exception:
+            breaker.record(False)
+            raise
+        if phase is not None:
+            saga_metrics.record_rpc(self.name, time.perf_counter() - started_at, result, phase)
+        breaker.record(result is not None)
+        return result
+
+    def keyed_command(self) -> Dict:
+        """
+        command() con la clave de idempotencia de la saga y el paso: si el
+        broker ya aplicó el comando (p.ej. venció el timeout de la
+        respuesta), un reintento recibe la respuesta original.
+        """
+        event = self.command()
+        if self.saga_id is not None:
+            event["data"]["idempotency_key"] = idempotency_key(self.saga_id, self.name)
+        return event
+
+    def execute(self) -> Dict:
+        return self.handle_result(self._call(self.keyed_command()))
+
+    def resolve(self) -> bool:
+        """
+        Para un paso iniciado cuya respuesta no llegó al saga log: pregunta
+        al broker por su clave de idempotencia. Si el comando se aplicó toma
+        la respuesta guardada (con el id para el rollback) y retorna True;
+        si no, el broker registra la clave como cancelada y el comando ya no
+        se aplicará aunque siga en una cola. Lanza excepción si el broker no
+        responde.
+        """
+        result = self._call({
+            "type": "ResolveCommand",
+            "data": {"idempotency_key": idempotency_key(self.saga_id, self.name),
+                     "command_type": self.command()["type"]},
+        }, phase=None)
+        if not result or result.get('status') != 'ok':
+            raise RuntimeError(f"No se pudo resolver {self.name}: {result}")
+        if not result.get('applied'):
+            self.log.info("     - %s no se aplicó; queda cancelado", self.name)
+            return False
+        return bool(self.handle_result(result['response'])["status"])
 
-class ProvisionUser(Step):
-    def __init__(self, step_name="ProvisionUser", data=None):
+    def rollback(self) -> None:
+        event = self.rollback_command()
+        if event is None:
+            return
+        self.handle_rollback_result(self._call(event, "rollback_rpc_wait"))
+
+    async def execute_async(self) -> Dict:
+        return self.handle_result(await self._call_async(self.keyed_command()))
+
+    async def rollback_async(self) -> None:
+        event = self.rollback_command()
+        if event is None:
+            return
+        self.handle_rollback_result(await self._call_async(event, "rollback_rpc_wait"))
+
+
+class ProvisionUser(RpcStep):
+    result_fields = ("user_id",)
+
+    def __init__(self, step_name="ProvisionUser", data=None, retry_policy=None):
         self.name = step_name
         self.data = data or {}
+        self.retry_policy = retry_policy or DEFAULT_RETRY_POLICY
 
-    def execute(self) -> None:
+    def command(self) -> Dict:
         fail = self.data.get("fail")[0]
 
         user_id = self.data["user"]["id"]
         user_name = self.data["user"]["name"]
         user_email = self.data["user"]["email"]
 
-        # Enviar al message broker
-        result = rpc_call({
+        return {
             "type": "ProvisionUser",
             "data": {
                 "id": user_id,
@@ -81,96 +184,112 @@ class ProvisionUser(Step):
                 "email": user_email,
                 "fail": fail
             }
-        })
+        }
 
+    def handle_result(self, result: Dict) -> Dict:
         if result.get('status') != 'ok':
             return {"status": False}
         # Guardar el id real generado por el broker para rollback
         self.data["user_id"] = result.get("id")
-        print("     - Solicitud de creación de usuario enviada al broker:",
-              user_id, user_name, user_email, "(db_id:", self.data["user_id"], ")")
+        user = self.data["user"]
+        self.log.debug("     - Solicitud de creación de usuario enviada al broker: %s %s %s (db_id: %s)",
+                       user["id"], user["name"], user["email"], self.data["user_id"])
         return {"status": True}
 
-    def rollback(self) -> None:
+    def rollback_command(self) -> Optional[Dict]:
         db_id = self.data.get("user_id")
         if db_id is None:
-            print("     - Rollback: No se tiene db_id para eliminar usuario")
-            return
-        result = rpc_call({
+            self.log.debug("     - Rollback: No se tiene db_id para eliminar usuario")
+            return None
+        return {
             "type": "CompositeProvisionUser",
             "data": {"db_id": db_id}
-        })
+        }
+
+    def handle_rollback_result(self, result: Dict) -> None:
+        db_id = self.data.get("user_id")
         if result and result.get("status") == "ok":
-            print(f"     - Rollback exitoso usuario: {db_id}")
+            self.log.info("     - Rollback exitoso usuario: %s", db_id)
         else:
-            print(f"     - Fallo rollback usuario: {db_id} -> {result}")
+            self.log.error("     - Fallo rollback usuario: %s -> %s", db_id, result)
 
     def rlq(self):
         return "Paso enviado a la cola"
 
 
-class AssignPermissions(Step):
-    def __init__(self, step_name="AssignPermissions", data=None):
+class AssignPermissions(RpcStep):
+    result_fields = ("permision_id",)
+
+    def __init__(self, step_name="AssignPermissions", data=None, retry_policy=None):
         self.name = step_name
         self.data = data or {}
+        self.retry_policy = retry_policy or DEFAULT_RETRY_POLICY
 
-    def execute(self) -> None:
+    def command(self) -> Dict:
         fail = self.data.get("fail")[1]
 
         user_id = self.data["user"]["id"]
         permissions = self.data["permissions"]
 
-        # Enviar al message broker
-        result = rpc_call({
+        return {
             "type": "AssignPermissions",
             "data": {
                 "id": user_id,
                 "permissions": permissions,
                 "fail": fail
             }
-        })
+        }
 
+    def handle_result(self, result: Dict) -> Dict:
         if result.get('status') != 'ok':
             return {"status": False}
 
         self.data["permision_id"] = result.get("id")
-        print(
-            f"     - Solicitud de asignación de permisos enviada al broker: {user_id}, {permissions} (db_id: {self.data['permision_id']})")
+        self.log.debug("     - Solicitud de asignación de permisos enviada al broker: %s, %s (db_id: %s)",
+                       self.data['user']['id'], self.data['permissions'],
+                       self.data['permision_id'])
         return {"status": True}
 
-    def rollback(self) -> None:
+    def rollback_command(self) -> Optional[Dict]:
         db_id = self.data.get("permision_id")
         if db_id is None:
-            print("     - Rollback: No se tiene db_id para eliminar permisos")
-            return
-        result = rpc_call({
+            self.log.debug("     - Rollback: No se tiene db_id para eliminar permisos")
+            return None
+        return {
             "type": "CompositeAssignPermissions",
             "data": {"db_id": db_id}
-        })
+        }
+
+    def handle_rollback_result(self, result: Dict) -> None:
+        db_id = self.data.get("permision_id")
         if result and result.get("status") == "ok":
-            print(f"     - Rollback exitoso permisos: {db_id}")
+            self.log.info("     - Rollback exitoso permisos: %s", db_id)
         else:
-            print(f"     - Fallo rollback permisos: {db_id} -> {result}")
+            self.log.error("     - Fallo rollback permisos: %s -> %s", db_id, result)
 
     def rlq(self):
         return "Paso enviado a la cola"
 
 
-class CreateQuota(Step):
-    def __init__(self, step_name="CreateQuota", data=None):
+class CreateQuota(RpcStep):
+    result_fields = ("qt_id",)
+
+    def __init__(self, step_name="CreateQuota", data=None, retry_policy=None):
         self.name = step_name
         self.data = data or {}
+        self.retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+        self.quota_id = None
 
-    def execute(self) -> None:
+    def command(self) -> Dict:
         fail = self.data.get("fail")[2]
 
         quota_id = self.data["quota"].get("quota_id", str(uuid.uuid4()))
+        self.quota_id = quota_id
         user_id = self.data["user"]["id"]
         storage_gb = self.data["quota"]["storage_gb"]
         ops_per_month = self.data["quota"]["ops_per_month"]
 
-        # Enviar al message broker
-        result = rpc_call({
+        return {
             "type": "CreateQuota",
             "data": {
                 "id": user_id,
@@ -179,28 +298,35 @@ class CreateQuota(Step):
                 "ops_per_month": ops_per_month,
                 "fail": fail
             }
-        })
+        }
+
+    def handle_result(self, result: Dict) -> Dict:
         if result.get('status') != 'ok':
             return {"status": False}
         self.data["qt_id"] = result.get("id")
-        print(
-            f"     - Solicitud de creación de quota enviada al broker: {quota_id}, {user_id}, {storage_gb}, {ops_per_month} (db_id: {self.data['qt_id']})")
+        quota = self.data["quota"]
+        self.log.debug("     - Solicitud de creación de quota enviada al broker: %s, %s, %s, %s (db_id: %s)",
+                       self.quota_id, self.data['user']['id'], quota['storage_gb'],
+                       quota['ops_per_month'], self.data['qt_id'])
 
         return {"status": True}
 
-    def rollback(self) -> None:
+    def rollback_command(self) -> Optional[Dict]:
         db_id = self.data.get("qt_id")
         if db_id is None:
-            print("     - Rollback: No se tiene db_id para eliminar quota")
-            return
-        result = rpc_call({
+            self.log.debug("     - Rollback: No se tiene db_id para eliminar quota")
+            return None
+        return {
             "type": "CompositeCreateQuota",
             "data": {"db_id": db_id}
-        })
+        }
+
+    def handle_rollback_result(self, result: Dict) -> None:
+        db_id = self.data.get("qt_id")
         if result and result.get("status") == "ok":
-            print(f"     - Rollback exitoso quota: {db_id}")
+            self.log.info("     - Rollback exitoso quota: %s", db_id)
         else:
-            print(f"     - Fallo rollback quota: {db_id} -> {result}")
+            self.log.error("     - Fallo rollback quota: %s -> %s", db_id, result)
 
     def rlq(self):
         return "Paso enviado a la cola"
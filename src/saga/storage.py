@@ -0,0 +1,160 @@
+"""
+Disposición de las tablas del broker en archivos SQLite.
+
+- split (por defecto): users.db, permissions.db y quotas.db, como siempre.
+- single: todas las tablas (y el outbox) en saga.db. Los pasos comparten
+  una conexión por hilo, un commit sincroniza un solo archivo, las
+  FOREIGN KEY sobre users(id) se validan y write_accounts inserta usuario,
+  permisos y cuota de varias sagas en una sola transacción.
+
+Se elige con SAGA_STORAGE. No se usa ATTACH: en modo WAL una transacción
+sobre bases adjuntas es atómica en cada archivo pero no en conjunto.
+
+    python storage.py -n 2000 --batch-size 100
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+STORAGE_MODES = ("split", "single")
+SAGA_STORAGE = os.getenv("SAGA_STORAGE", "split")
+SINGLE_DB_NAME = "saga"
+
+
+class Storage:
+    def __init__(self, mode=SAGA_STORAGE):
+        if mode not in STORAGE_MODES:
+            raise ValueError(f"Modo de almacenamiento desconocido: {mode}")
+        self.mode = mode
+
+    @property
+    def single(self):
+        return self.mode == "single"
+
+    def database_for(self, db_type):
+        """Nombre del archivo (sin .db) que guarda la tabla `db_type`"""
+        return SINGLE_DB_NAME if self.single else db_type
+
+    def path_for(self, db_type, db_dir):
+        return os.path.join(db_dir, f"{self.database_for(db_type)}.db")
+
+    def databases(self, db_types):
+        """Archivo -> tablas que contiene, en el orden de `db_types`"""
+        databases = {}
+        for db_type in db_types:
+            databases.setdefault(self.database_for(db_type), []).append(db_type)
+        return databases
+
+
+# Disposición del proceso (broker, relay, inicialización y limpieza)
+storage = Storage()
+
+
+def insert_account(conn, account):
+    """
+    Inserta usuario, permisos y cuota de un payload de saga sin hacer
+    commit; retorna (user_id, perm_id, quota_row_id).
+    """
+    user = account['user']
+    quota = account.get('quota', {})
+    conn.execute("INSERT INTO users (id, name, email) VALUES (?, ?, ?)",
+                 (user['id'], user['name'], user['email']))
+    perm_id = conn.execute(
+        "INSERT INTO permissions (user_id, permissions) VALUES (?, ?)",
+        (user['id'], json.dumps(account.get('permissions'))),
+    ).lastrowid
+    quota_row_id = conn.execute(
+        "INSERT INTO quotas (user_id, storage_gb, ops_per_month) VALUES (?, ?, ?)",
+        (user['id'], quota.get('storage_gb'), quota.get('ops_per_month')),
+    ).lastrowid
+    return user['id'], perm_id, quota_row_id
+
+
+def write_accounts(conn, accounts):
+    """
+    Escribe las filas de todas las sagas en una sola transacción (solo con
+    SAGA_STORAGE=single): o quedan las tres filas de cada saga o ninguna.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        ids = [insert_account(conn, account) for account in accounts]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return ids
+
+
+# BENCHMARK
+
+def sample_accounts(n):
+    return [{
+        "user": {"id": f"user-{i}", "name": f"bench-{i}", "email": f"bench-{i}@example.com"},
+        "permissions": ["read", "write"],
+        "quota": {"storage_gb": 10, "ops_per_month": 1000},
+    } for i in range(n)]
+
+
+def write_split(manager, accounts):
+    """Como los handlers de cada paso: un INSERT y un commit por base"""
+    for account in accounts:
+        user, quota = account['user'], account['quota']
+        for db_type, sql, params in (
+            ("users", "INSERT INTO users (id, name, email) VALUES (?, ?, ?)",
+             (user['id'], user['name'], user['email'])),
+            ("permissions", "INSERT INTO permissions (user_id, permissions) VALUES (?, ?)",
+             (user['id'], json.dumps(account['permissions']))),
+            ("quotas", "INSERT INTO quotas (user_id, storage_gb, ops_per_month) VALUES (?, ?, ?)",
+             (user['id'], quota['storage_gb'], quota['ops_per_month'])),
+        ):
+            conn = manager.get(db_type)
+            conn.execute(sql, params)
+            conn.commit()
+
+
+def benchmark_layout(mode, accounts, batch_size, synchronous):
+    """Segundos que toma escribir `accounts` con la disposición `mode`"""
+    from db_pool import ConnectionManager
+    from initialize_databases import initialize_database_by_type, database_types
+
+    db_dir = tempfile.mkdtemp(prefix=f"saga-storage-{mode}-")
+    layout = Storage(mode)
+    initialize_database_by_type(database_types, db_dir, layout)
+    manager = ConnectionManager(db_dir, synchronous=synchronous, storage=layout)
+    try:
+        started_at = time.perf_counter()
+        if layout.single:
+            conn = manager.get("users")
+            for start in range(0, len(accounts), batch_size):
+                write_accounts(conn, accounts[start:start + batch_size])
+        else:
+            write_split(manager, accounts)
+        return time.perf_counter() - started_at
+    finally:
+        manager.close_all()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compara la escritura de sagas en bases separadas y en un solo archivo")
+    parser.add_argument("-n", "--sagas", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Sagas por transacción en modo single")
+    parser.add_argument("--synchronous", default="NORMAL", choices=["OFF", "NORMAL", "FULL"])
+    args = parser.parse_args(argv)
+
+    accounts = sample_accounts(args.sagas)
+    runs = [("split", 1), ("single", 1), ("single", args.batch_size)]
+    results = {}
+    print(f"{'modo':<8}{'sagas/tx':>9}{'segundos':>10}{'sagas/s':>10}")
+    for mode, batch_size in runs:
+        elapsed = benchmark_layout(mode, accounts, batch_size, args.synchronous)
+        results[(mode, batch_size)] = elapsed
+        print(f"{mode:<8}{batch_size:>9}{elapsed:>10.3f}{args.sagas / elapsed:>10.0f}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
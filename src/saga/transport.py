@@ -0,0 +1,453 @@
+"""
+Transporte de mensajes entre el orquestador y el broker.
+
+- AmqpTransport: RabbitMQ (pika / aio-pika), el comportamiento de siempre.
+- InMemoryTransport: colas en proceso atendidas por hilos que llaman
+  directamente a message_broker.HANDLERS, sin red ni RabbitMQ. Sirve para
+  tests y benchmarks que quieren medir solo el overhead del orquestador.
+
+El transporte del proceso se elige con SAGA_TRANSPORT=amqp|memory (ver
+get_transport) o se fija con set_transport.
+"""
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import Future
+from routing import EXCHANGE_NAME, declare_topology, queue_for
+from rpc_client import get_rpc_client, close_rpc_client
+from async_rpc_client import async_rpc_call, get_async_rpc_client
+from codec import get_codec, codec_for, decode
+from idempotency import saga_id_from_key
+from logger import get_logger
+import asyncio
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+import pika
+
+SAGA_TRANSPORT = os.getenv("SAGA_TRANSPORT", "amqp")
+# Hilos consumidores por cola en el transporte en memoria
+MEMORY_WORKERS = int(os.getenv("SAGA_MEMORY_WORKERS", "4"))
+
+logger = get_logger("transport")
+
+
+class Transport(ABC):
+
+    @abstractmethod
+    def call(self, event: dict, timeout: float = 5.0):
+        """Envía un comando y espera su respuesta; None si vence el timeout"""
+
+    def call_many(self, events, timeout: float = 5.0) -> list:
+        return [self.call(event, timeout) for event in events]
+
+    async def call_async(self, event: dict, timeout: float = 5.0):
+        return await asyncio.to_thread(self.call, event, timeout)
+
+    @abstractmethod
+    def publish(self, routing_key: str, message: dict) -> None:
+        """Publica un mensaje persistente sin esperar respuesta; lanza excepción si falla"""
+
+    async def publish_async(self, routing_key: str, message: dict) -> None:
+        await asyncio.to_thread(self.publish, routing_key, message)
+
+    def publish_many(self, routing_key: str, messages) -> None:
+        """Publica un lote; si lanza excepción, ningún mensaje se da por publicado"""
+        for message in messages:
+            self.publish(routing_key, message)
+
+    @abstractmethod
+    def fetch(self, queue_name: str, max_messages: int) -> list:
+        """
+        Retira hasta `max_messages` mensajes de una cola sin consumidores
+        (p.ej. el DLQ) y retorna [(tag, mensaje)]. Quedan pendientes hasta
+        ack() o requeue() desde el mismo hilo.
+        """
+
+    @abstractmethod
+    def depth(self, queue_name: str) -> int:
+        """Mensajes listos en la cola (sin contar los retirados con fetch() sin ack)"""
+
+    @abstractmethod
+    def ack(self, tags) -> None:
+        """Confirma mensajes obtenidos con fetch(); no se vuelven a entregar"""
+
+    @abstractmethod
+    def requeue(self, tags) -> None:
+        """Devuelve a su cola mensajes obtenidos con fetch()"""
+
+    @abstractmethod
+    def listen(self, queues, dispatch, prefetch_count=1):
+        """Consume `queues` respondiendo cada comando con dispatch(evento); bloquea"""
+
+    def close(self):
+        pass
+
+
+# AMQP
+
+def handle_delivery(ch, method, properties, body, dispatch):
+    """
+    Callback de pika: decodifica según el content_type, despacha, responde
+    a reply_to en el mismo formato de la petición y hace ack.
+    """
+    codec = codec_for(properties.content_type)
+    try:
+        evt = codec.decode(body)
+    except Exception:
+        try:
+            evt = body.decode()
+        except Exception:
+            evt = body
+
+    resp_payload = dispatch(evt)
+
+    try:
+        if properties.reply_to:
+            ch.basic_publish(
+                exchange='',
+                routing_key=properties.reply_to,
+                body=codec.encode(resp_payload),
+                properties=pika.BasicProperties(
+                    content_type=codec.content_type,
+                    correlation_id=properties.correlation_id),
+            )
+    except Exception as e:
+        logger.error("Fallo al enviar la repuesta: %s", e)
+
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    # Cada mensaje completo solo con SAGA_LOG_LEVEL=DEBUG
+    if logger.isEnabledFor(logging.DEBUG):
+        data = evt.get('data', {}) if isinstance(evt, dict) else {}
+        logger.debug("Mensaje procesado: %s -> Respuesta: %s", evt, resp_payload,
+                     extra={"saga_id": saga_id_from_key(data.get('idempotency_key')),
+                            "step": evt.get('type') if isinstance(evt, dict) else None})
+
+
+class AmqpTransport(Transport):
+    def __init__(self, host='localhost'):
+        self.host = host
+        # Canal con publisher confirms por hilo, separado del canal RPC
+        self._local = threading.local()
+        self.codec = get_codec()
+
+    def call(self, event, timeout=5.0):
+        # Reutiliza la conexión y la cola de respuesta del hilo actual
+        return get_rpc_client().call(event, timeout)
+
+    def call_many(self, events, timeout=5.0):
+        # Todos los comandos quedan en vuelo a la vez sobre la misma conexión
+        return get_rpc_client().call_many(events, timeout)
+
+    async def call_async(self, event, timeout=5.0):
+        return await async_rpc_call(event, timeout)
+
+    def _publisher(self):
+        channel = getattr(self._local, 'channel', None)
+        if channel is None or channel.is_closed:
+            self._close_publisher()
+            connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+            channel = connection.channel()
+            declare_topology(channel)
+            channel.confirm_delivery()
+            self._local.connection = connection
+            self._local.channel = channel
+        return channel
+
+    def _close_publisher(self):
+        connection = getattr(self._local, 'connection', None)
+        try:
+            if connection is not None and connection.is_open:
+                connection.close()
+        except Exception:
+            pass
+        self._local.connection = None
+        self._local.channel = None
+        self._local.fetch_channel = None
+
+    def publish(self, routing_key, message):
+        try:
+            # Con confirm_delivery, basic_publish espera el ack del broker
+            self._publisher().basic_publish(
+                exchange=EXCHANGE_NAME,
+                routing_key=routing_key,
+                body=self.codec.encode(message),
+                # Mensaje persistente
+                properties=pika.BasicProperties(content_type=self.codec.content_type,
+                                                delivery_mode=2)
+            )
+        except pika.exceptions.AMQPConnectionError:
+            # La conexión ya no es usable: se reabrirá en la siguiente publicación
+            self._close_publisher()
+            raise
+
+    def publish_many(self, routing_key, messages):
+        """
+        Publica el lote por el canal con publisher confirms de la conexión
+        persistente: retorna cuando el broker confirmó (ack) cada mensaje.
+        Si falla a mitad del lote, los ya confirmados se vuelven a publicar
+        con el reintento (entrega al menos una vez, como el outbox).
+        """
+        try:
+            channel = self._publisher()
+            for message in messages:
+                # NackError/UnroutableError si el broker no confirma el mensaje
+                channel.basic_publish(
+                    exchange=EXCHANGE_NAME,
+                    routing_key=routing_key,
+                    body=self.codec.encode(message),
+                    properties=pika.BasicProperties(content_type=self.codec.content_type,
+                                                    delivery_mode=2)
+                )
+        except pika.exceptions.AMQPError:
+            self._close_publisher()
+            raise
+
+    async def publish_async(self, routing_key, message):
+        await get_async_rpc_client().publish(routing_key, message)
+
+    def _fetch_channel(self):
+        channel = getattr(self._local, 'fetch_channel', None)
+        if channel is None or channel.is_closed:
+            self._publisher()
+            channel = self._local.connection.channel()
+            self._local.fetch_channel = channel
+        return channel
+
+    def fetch(self, queue_name, max_messages):
+        channel = self._fetch_channel()
+        messages = []
+        while len(messages) < max_messages:
+            method, properties, body = channel.basic_get(queue=queue_name, auto_ack=False)
+            if method is None:
+                break
+            try:
+                message = decode(body, properties.content_type)
+            except Exception:
+                message = body.decode(errors="replace")
+            messages.append((method.delivery_tag, message))
+        return messages
+
+    def depth(self, queue_name):
+        declared = self._fetch_channel().queue_declare(queue=queue_name, passive=True)
+        return declared.method.message_count
+
+    def ack(self, tags):
+        channel = self._fetch_channel()
+        for tag in tags:
+            channel.basic_ack(delivery_tag=tag)
+
+    def requeue(self, tags):
+        channel = self._fetch_channel()
+        for tag in tags:
+            channel.basic_nack(delivery_tag=tag, requeue=True)
+
+    def listen(self, queues, dispatch, prefetch_count=1):
+        connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+        try:
+            channel = connection.channel()
+            declare_topology(channel)
+            channel.basic_qos(prefetch_count=prefetch_count)
+
+            for queue_name in queues:
+                logger.info("Escuchando mensajes en cola '%s'...", queue_name)
+                channel.basic_consume(
+                    queue=queue_name,
+                    on_message_callback=lambda ch, method, properties, body:
+                        handle_delivery(ch, method, properties, body, dispatch)
+                )
+            channel.start_consuming()
+        finally:
+            if connection.is_open:
+                connection.close()
+
+    def close(self):
+        """Cierra las conexiones del hilo actual"""
+        self._close_publisher()
+        close_rpc_client()
+
+
+# EN MEMORIA
+
+_STOP = object()
+
+
+class InMemoryTransport(Transport):
+    """
+    Una cola por tipo de comando (las mismas que en RabbitMQ, ver
+    routing.queue_for) con `workers` hilos cada una. Los comandos se
+    serializan con el codec de SAGA_CODEC igual que por AMQP, así que los
+    handlers reciben exactamente lo mismo. Los mensajes publicados sin respuesta (DLQ,
+    eventos del outbox) quedan en `published[routing_key]`, que hace de
+    cola para fetch().
+    `latency` simula el tiempo de red por mensaje.
+    """
+
+    def __init__(self, workers=MEMORY_WORKERS, latency=0.0, dispatch=None, codec=None):
+        self.workers = workers
+        self.latency = latency
+        self.dispatch = dispatch
+        self.codec = get_codec(codec)
+        self.queues = defaultdict(queue.Queue)
+        self.published = defaultdict(list)
+        # tag -> (cola, mensaje) de lo retirado con fetch() sin ack
+        self._unacked = {}
+        self._tags = itertools.count(1)
+        self._threads = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _dispatch(self):
+        if self.dispatch is None:
+            # Import diferido: message_broker importa este módulo
+            from message_broker import dispatch
+            self.dispatch = dispatch
+        return self.dispatch
+
+    def _ensure_consumers(self, queue_name):
+        if len(self._threads.get(queue_name, ())) >= self.workers:
+            return
+        with self._lock:
+            threads = self._threads[queue_name]
+            while len(threads) < self.workers:
+                thread = threading.Thread(target=self._consume, args=(queue_name,),
+                                          name=f"memory-{queue_name}-{len(threads)}",
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+
+    def _consume(self, queue_name):
+        dispatch = self._dispatch()
+        work = self.queues[queue_name]
+        while True:
+            item = work.get()
+            if item is _STOP:
+                return
+            body, future = item
+            try:
+                codec = self.codec
+                response = codec.decode(codec.encode(dispatch(codec.decode(body))))
+            except Exception as e:
+                response = {'status': 'error', 'detail': str(e)}
+            future.set_result(response)
+
+    def send(self, event) -> Future:
+        """Encola el comando y retorna un Future con la respuesta"""
+        queue_name = queue_for(event.get('type'))
+        self._ensure_consumers(queue_name)
+        future = Future()
+        self.queues[queue_name].put((self.codec.encode(event), future))
+        return future
+
+    def call(self, event, timeout=5.0):
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            return self.send(event).result(timeout)
+        except TimeoutError:
+            return None
+
+    def call_many(self, events, timeout=5.0):
+        if self.latency:
+            time.sleep(self.latency)
+        futures = [self.send(event) for event in events]
+        deadline = time.monotonic() + timeout
+        responses = []
+        for future in futures:
+            try:
+                responses.append(future.result(max(deadline - time.monotonic(), 0)))
+            except TimeoutError:
+                responses.append(None)
+        return responses
+
+    async def call_async(self, event, timeout=5.0):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(self.send(event)), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def publish(self, routing_key, message):
+        # Ida y vuelta por el codec para detectar payloads no serializables igual que AMQP
+        message = self.codec.decode(self.codec.encode(message))
+        with self._lock:
+            self.published[routing_key].append(message)
+
+    async def publish_async(self, routing_key, message):
+        self.publish(routing_key, message)
+
+    def fetch(self, queue_name, max_messages):
+        with self._lock:
+            pending = self.published[queue_name]
+            taken, self.published[queue_name] = pending[:max_messages], pending[max_messages:]
+            messages = []
+            for message in taken:
+                tag = next(self._tags)
+                self._unacked[tag] = (queue_name, message)
+                messages.append((tag, message))
+        return messages
+
+    def depth(self, queue_name):
+        with self._lock:
+            return len(self.published[queue_name])
+
+    def ack(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._unacked.pop(tag, None)
+
+    def requeue(self, tags):
+        with self._lock:
+            for tag in reversed(list(tags)):
+                queue_name, message = self._unacked.pop(tag)
+                self.published[queue_name].insert(0, message)
+
+    def listen(self, queues, dispatch, prefetch_count=1):
+        self.dispatch = dispatch
+        for queue_name in queues:
+            logger.info("Escuchando mensajes en cola '%s' (en memoria)...", queue_name)
+            self._ensure_consumers(queue_name)
+        with self._lock:
+            threads = [thread for name in queues for thread in self._threads[name]]
+        for thread in threads:
+            thread.join()
+
+    def close(self):
+        """Detiene los consumidores; se vuelven a crear con el próximo comando"""
+        with self._lock:
+            for queue_name, threads in self._threads.items():
+                for _ in threads:
+                    self.queues[queue_name].put(_STOP)
+            self._threads.clear()
+
+
+TRANSPORTS = {
+    "amqp": AmqpTransport,
+    "memory": InMemoryTransport,
+}
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    """Transporte del proceso, creado según SAGA_TRANSPORT"""
+    global _transport
+    if _transport is not None:
+        return _transport
+    with _transport_lock:
+        if _transport is None:
+            transport_cls = TRANSPORTS.get(SAGA_TRANSPORT)
+            if transport_cls is None:
+                raise ValueError(f"Transporte desconocido: {SAGA_TRANSPORT}")
+            _transport = transport_cls()
+    return _transport
+
+
+def set_transport(transport: Transport):
+    """Fija el transporte del proceso (p.ej. InMemoryTransport en tests)"""
+    global _transport
+    with _transport_lock:
+        _transport = transport
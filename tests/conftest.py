@@ -4,6 +4,7 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 from saga.orchestrator import SagaOrchestrator
 from saga.metrics import saga_metrics
+from saga import benchmark, circuit_breaker
 
 
 @pytest.fixture
@@ -13,4 +14,61 @@ def saga_orchestrator_instance():
 @pytest.fixture
 def fresh_metrics():
     saga_metrics.reset()
-    yield saga_metrics
\ No newline at end of file
+    yield saga_metrics
+
+
+@pytest.fixture(autouse=True)
+def closed_breakers():
+    # Los módulos importan circuit_breaker sin el prefijo saga.: se limpian
+    # los dos registros para que un circuito abierto no pase al test siguiente
+    circuit_breaker.reset_breakers()
+    sys.modules["circuit_breaker"].reset_breakers()
+
+
+@pytest.fixture
+def broker_layout():
+    """Disposición de las bases del broker; un test la cambia con parametrize"""
+    return benchmark.connections.storage
+
+
+@pytest.fixture
+def broker_db(tmp_path, monkeypatch, broker_layout):
+    """Bases del broker en tmp_path, para llamar a message_broker.dispatch"""
+    connections = benchmark.connections
+    benchmark.initialize_database_by_type(benchmark.database_types, str(tmp_path),
+                                          broker_layout)
+    monkeypatch.setattr(connections, "db_dir", str(tmp_path))
+    monkeypatch.setattr(connections, "storage", broker_layout)
+    # Las conexiones son por hilo: que no quede abierta una de otra carpeta
+    connections.close_all()
+    yield connections
+    connections.close_all()
+
+
+@pytest.fixture
+def memory_broker(tmp_path, monkeypatch, broker_layout):
+    """Transporte en memoria con las bases del broker en tmp_path/db"""
+    connections = benchmark.connections
+    # use_memory_transport cambia la carpeta y la disposición: se restauran al final
+    monkeypatch.setattr(connections, "db_dir", connections.db_dir)
+    monkeypatch.setattr(connections, "storage", connections.storage)
+    # Sin mensajes derramados a disco por otras corridas
+    monkeypatch.setattr(benchmark.get_dlq_publisher(), "spill_path",
+                        str(tmp_path / "dlq_spill.jsonl"))
+    previous = benchmark.get_transport()
+    connections.close_all()
+    transport = benchmark.use_memory_transport(str(tmp_path / "db"), layout=broker_layout)
+    yield transport
+    benchmark.get_dlq_publisher().flush()
+    transport.close()
+    benchmark.set_transport(previous)
+    connections.close_all()
+
+
+@pytest.fixture
+def count():
+    """count(tabla) con la conexión del broker, o count(tabla, conn)"""
+    def count(table, conn=None):
+        conn = conn or benchmark.connections.get(table)
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    return count
@@ -39,7 +39,8 @@ def test_chaos_step_failure(saga_orchestrator_instance):
 @pytest.mark.parametrize("scenario,fail_config,expected_compensations", [
     # Falla inmediato, sin compensación
     ("Fallo paso 1", [True, False, False], 0),
-    ("Fallo paso 2", [False, True, False], 1),   # Compensa paso 1
+    # Pasos 2 y 3 corren en paralelo: compensa pasos 1 y 3
+    ("Fallo paso 2", [False, True, False], 2),
     ("Fallo paso 3", [False, False, True], 2),   # Compensa pasos 1 y 2
 ])
 def test_chaos_different_failure_points(scenario, fail_config, expected_compensations, saga_orchestrator_instance):
@@ -55,6 +56,11 @@ def test_chaos_different_failure_points(scenario, fail_config, expected_compensa
     report = saga_metrics.get_report()
     assert report['compensation_rate'] == "100.00%"
     assert report['total_dlq_messages'] == 1
+    # Un rollback por cada paso completado antes del fallo
+    rollbacks = sum(phases['rollback'].count
+                    for phases in saga_metrics.data['step_timings'].values()
+                    if 'rollback' in phases)
+    assert rollbacks == expected_compensations
 
 def test_chaos_multiple_sagas_with_failures(saga_orchestrator_instance):
     print("\n" + "="*70)
@@ -0,0 +1,77 @@
+from saga import benchmark
+from saga.async_orchestrator import AsyncSagaOrchestrator, SagaState, run_sagas
+from saga.retry import RetryPolicy
+import asyncio
+
+NO_RETRY = {step_type: RetryPolicy(max_retries=0, base_delay=0)
+            for step_type, _ in benchmark.SAGA_DEFINITION}
+
+
+def run_saga(raw_data):
+    saga = AsyncSagaOrchestrator()
+    saga.saga_log = None  # sin log aunque SAGA_LOG_PATH esté definido
+    saga.send_data(raw_data, retry_policies=NO_RETRY)
+    asyncio.run(saga.execute_saga())
+    return saga
+
+
+def test_saga_runs_every_step_through_the_broker(memory_broker, count):
+    saga = run_saga(benchmark.build_payloads(1, 0)[0])
+
+    assert saga.state == SagaState.SUCCEEDED
+    # ProvisionUser primero; las otras dos ramas en cualquier orden
+    assert saga.completed[0].name == "ProvisionUser"
+    assert {step.name for step in saga.completed[1:]} == {"AssignPermissions", "CreateQuota"}
+    assert [count(table) for table in ("users", "permissions", "quotas")] == [1, 1, 1]
+
+
+def test_failed_step_compensates_the_completed_ones(memory_broker, count):
+    raw_data = benchmark.build_payloads(1, 0)[0]
+    raw_data["fail"] = [False, False, True]
+    saga = run_saga(raw_data)
+
+    assert saga.state == SagaState.COMPENSATED
+    assert [count(table) for table in ("users", "permissions", "quotas")] == [0, 0, 0]
+    benchmark.get_dlq_publisher().flush()
+    assert [m['step_name'] for m in memory_broker.published["saga_dlq"]] == ["CreateQuota"]
+
+
+def test_run_sagas_keeps_the_payload_order(memory_broker, count):
+    payloads = benchmark.build_payloads(6, 0)
+    sagas = asyncio.run(run_sagas(payloads, concurrency=2))
+
+    assert [saga.raw_data for saga in sagas] == payloads
+    assert all(saga.state == SagaState.SUCCEEDED for saga in sagas)
+    assert count("users") == 6
+
+
+def test_step_that_raises_waits_for_its_siblings_before_compensating(memory_broker, count):
+    saga = AsyncSagaOrchestrator()
+    saga.saga_log = None
+    saga.send_data(benchmark.build_payloads(1, 0)[0], retry_policies=NO_RETRY)
+    steps = {step.name: step for step in saga.steps}
+
+    assign = steps["AssignPermissions"]
+    execute_assign = assign.execute_async
+
+    async def slow_execute():
+        # La rama hermana se aplica y sigue en vuelo cuando CreateQuota lanza
+        response = await execute_assign()
+        await asyncio.sleep(0.05)
+        return response
+    assign.execute_async = slow_execute
+
+    log_started = saga.log_started
+
+    def failing_log_started(step):
+        if step.name == "CreateQuota":
+            raise RuntimeError("saga log no disponible")
+        return log_started(step)
+    saga.log_started = failing_log_started
+
+    asyncio.run(saga.execute_saga())
+
+    assert saga.state == SagaState.COMPENSATED
+    assert [count(table) for table in ("users", "permissions", "quotas")] == [0, 0, 0]
+    benchmark.get_dlq_publisher().flush()
+    assert [m['step_name'] for m in memory_broker.published["saga_dlq"]] == ["CreateQuota"]
@@ -0,0 +1,23 @@
+from saga import benchmark
+import json
+
+
+def test_memory_benchmark_writes_comparable_report(tmp_path, monkeypatch):
+    monkeypatch.setattr(benchmark.connections, "db_dir", benchmark.connections.db_dir)
+    output = tmp_path / "bench.json"
+
+    for _ in range(2):
+        report = benchmark.main(["-n", "20", "--concurrency", "4", "--failure-ratio", "0.5",
+                                 "--base-delay", "0", "--max-retries", "1", "--seed", "7",
+                                 "--db-dir", str(tmp_path / "db"), "--output", str(output)])
+
+    assert report['total_sagas'] == 20
+    assert float(report['throughput']) > 0
+    # Cada saga compensada deja exactamente un mensaje en el DLQ en memoria
+    compensated = round(20 * float(report['compensation_rate'].rstrip('%')) / 100)
+    assert report['total_dlq_messages'] == compensated > 0
+    saved = json.loads(output.read_text())
+    assert saved['throughput'] == report['throughput']
+    assert (tmp_path / "bench_previous.json").exists()
+    assert 'throughput' in benchmark.saga_metrics.calculate_trends(
+        str(tmp_path / "bench_previous.json"), current=saved)
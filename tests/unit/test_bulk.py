@@ -0,0 +1,159 @@
+from saga import benchmark, bulk, message_broker
+from saga.retry import RetryPolicy
+from concurrent.futures import Future
+import pytest
+
+NO_WAIT = {step_type: RetryPolicy(max_retries=1, base_delay=0)
+           for step_type, _ in benchmark.SAGA_DEFINITION}
+
+
+def user(user_id, fail=False):
+    return {"id": user_id, "name": "Ana", "email": f"{user_id}@example.com", "fail": fail}
+
+
+def test_duplicate_user_only_rejects_its_own_row(broker_db, count):
+    message_broker.dispatch({"type": "ProvisionUserBatch", "data": {"items": [user("u1")]}})
+    response = message_broker.dispatch({"type": "ProvisionUserBatch", "data": {"items": [
+        user("u2"), user("u1"), user("u3", fail=True), user("u4")]}})
+
+    assert [r['status'] for r in response['results']] == ['ok', 'error', 'error', 'ok']
+    assert response['results'][1]['detail'].startswith('Fallo al registrar usuario: UNIQUE')
+    assert [r.get('id') for r in response['results']] == ['u2', None, None, 'u4']
+    assert count("users") == 3
+
+
+def test_batch_ids_follow_item_order(broker_db):
+    items = [{"id": f"u{i}", "storage_gb": i, "ops_per_month": 1, "quota_id": f"q{i}",
+              "fail": i == 1} for i in range(4)]
+    response = message_broker.dispatch({"type": "CreateQuotaBatch", "data": {"items": items}})
+
+    results = response['results']
+    assert results[1]['status'] == 'error'
+    conn = broker_db.get("quotas")
+    for i in (0, 2, 3):
+        row = conn.execute("SELECT user_id, storage_gb FROM quotas WHERE id=?",
+                           (results[i]['id'],)).fetchone()
+        assert row == (f"u{i}", i)
+
+
+def test_run_bulk_compensates_only_the_failing_sagas(memory_broker, count):
+    payloads = benchmark.build_payloads(6, 0)
+    payloads[2]['fail'] = [False, False, True]
+    payloads[4]['fail'] = [True, False, False]
+
+    outcomes = bulk.run_bulk(payloads, chunk_size=4, retry_policies=NO_WAIT)
+
+    assert [o['user_id'] for o in outcomes] == [p['user']['id'] for p in payloads]
+    assert [(o['state'], o['failed_step']) for o in outcomes] == [
+        ('SUCCEEDED', None), ('SUCCEEDED', None), ('COMPENSATED', 'CreateQuota'),
+        ('SUCCEEDED', None), ('COMPENSATED', 'ProvisionUser'), ('SUCCEEDED', None)]
+    for table in benchmark.database_types:
+        assert count(table) == 4
+    benchmark.get_dlq_publisher().flush()
+    assert len(memory_broker.published["saga_dlq"]) == 2
+
+
+def test_resent_batch_and_single_retry_do_not_write_twice(broker_db, count):
+    items = [{"id": f"u{i}", "permissions": ["read"], "fail": False,
+              "idempotency_key": f"saga-{i}:AssignPermissions"} for i in range(3)]
+    batch = {"type": "AssignPermissionsBatch", "data": {"items": items}}
+    first = message_broker.dispatch(batch)['results']
+    # El lote se reenvía tras un timeout de la respuesta
+    again = message_broker.dispatch(batch)['results']
+    single = message_broker.dispatch({"type": "AssignPermissions", "data": items[1]})
+
+    assert [r['id'] for r in again] == [r['id'] for r in first]
+    assert single['id'] == first[1]['id']
+    assert count("permissions") == 3
+
+
+@pytest.mark.parametrize("broker_layout", [benchmark.Storage("single")])
+def test_single_storage_writes_each_saga_in_one_account_batch(memory_broker, broker_layout,
+                                                              monkeypatch, count):
+    monkeypatch.setattr(bulk, "storage", broker_layout)
+    broker_dispatch = memory_broker._dispatch()
+    commands = []
+
+    def dispatch(evt):
+        commands.append(evt['type'])
+        return broker_dispatch(evt)
+
+    memory_broker.dispatch = dispatch
+    payloads = benchmark.build_payloads(4, 0)
+    payloads[1]['fail'] = [False, False, True]
+    outcomes = bulk.run_bulk(payloads, retry_policies=NO_WAIT)
+    benchmark.get_dlq_publisher().flush()
+
+    assert [o['state'] for o in outcomes] == ['SUCCEEDED', 'COMPENSATED',
+                                              'SUCCEEDED', 'SUCCEEDED']
+    assert commands[0] == 'ProvisionAccountBatch'
+    # Solo la cuenta fallida sigue por los lotes de cada paso
+    assert 'ProvisionUserBatch' in commands
+    conn = benchmark.connections.get("users")
+    for table in benchmark.database_types:
+        assert count(table, conn) == 3
+    keys = conn.execute("SELECT COUNT(*) FROM processed_commands").fetchone()[0]
+    assert keys == 3 * 3 + 2
+
+
+def recorded_commands(transport):
+    """Tipos de los comandos que atiende el broker en memoria"""
+    broker_dispatch = transport._dispatch()
+    commands = []
+
+    def dispatch(evt):
+        commands.append(evt['type'])
+        return broker_dispatch(evt)
+
+    transport.dispatch = dispatch
+    return commands
+
+
+def test_batch_counts_as_the_first_attempt(memory_broker):
+    commands = recorded_commands(memory_broker)
+    payloads = benchmark.build_payloads(2, 0)
+    payloads[1]['fail'] = [False, True, False]
+
+    outcomes = bulk.run_bulk(payloads, retry_policies=NO_WAIT)
+
+    assert [o['state'] for o in outcomes] == ['SUCCEEDED', 'COMPENSATED']
+    # max_retries=1: el lote y un solo reintento individual
+    assert commands.count('AssignPermissionsBatch') == 1
+    assert commands.count('AssignPermissions') == 1
+
+
+def test_broker_error_compensates_the_steps_of_earlier_levels(memory_broker, monkeypatch,
+                                                               count):
+    call_many = memory_broker.call_many
+
+    def broker_down_after_users(events, timeout=5.0):
+        if events[0]['type'] != 'ProvisionUserBatch':
+            raise ConnectionError("broker caído")
+        return call_many(events, timeout)
+
+    monkeypatch.setattr(memory_broker, "call_many", broker_down_after_users)
+    outcomes = bulk.run_bulk(benchmark.build_payloads(3, 0), retry_policies=NO_WAIT)
+
+    assert [(o['state'], o['failed_step']) for o in outcomes] == \
+        [('COMPENSATED', 'AssignPermissions')] * 3
+    # Los usuarios del primer nivel se crearon y se compensaron
+    assert count("users") == 0
+    benchmark.get_dlq_publisher().flush()
+    assert len(memory_broker.published["saga_dlq"]) == 3
+
+
+def test_retry_that_raises_only_fails_its_own_saga(memory_broker, monkeypatch, count):
+    def broken_retry(self, step, attempt=0):
+        future = Future()
+        future.set_exception(OSError("disk I/O error"))
+        return future
+
+    monkeypatch.setattr(bulk.SagaOrchestrator, "submit_step", broken_retry)
+    payloads = benchmark.build_payloads(2, 0)
+    payloads[1]['fail'] = [False, False, True]
+
+    outcomes = bulk.run_bulk(payloads, retry_policies=NO_WAIT)
+
+    assert [(o['state'], o['failed_step']) for o in outcomes] == [
+        ('SUCCEEDED', None), ('COMPENSATED', 'CreateQuota')]
+    assert [count(table) for table in benchmark.database_types] == [1, 1, 1]
@@ -0,0 +1,77 @@
+from saga.circuit_breaker import CircuitBreaker, BreakerState
+from saga import orchestrator
+from saga.retry import RetryPolicy
+import uuid
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_opens_on_failure_rate_and_closes_after_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker("AssignPermissions", window=10, min_calls=4,
+                             failure_rate=0.5, open_seconds=5, clock=clock)
+    for success in (True, False, True):
+        breaker.record(success)
+    assert breaker.state == BreakerState.CLOSED
+
+    breaker.record(False)
+    assert breaker.state == BreakerState.OPEN
+    assert not breaker.allow()
+
+    clock.now += 5
+    assert breaker.state == BreakerState.HALF_OPEN
+    # Una sola llamada de prueba a la vez
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == BreakerState.CLOSED
+
+
+def test_failed_probe_reopens_and_old_calls_leave_the_window():
+    clock = FakeClock()
+    breaker = CircuitBreaker("CreateQuota", window=10, min_calls=2,
+                             failure_rate=0.5, open_seconds=5, clock=clock)
+    breaker.record(False)
+    clock.now += 11
+    breaker.record(False)
+    # El primer fallo ya salió de la ventana: 1 llamada < min_calls
+    assert breaker.state == BreakerState.CLOSED
+
+    breaker.record(False)
+    assert breaker.state == BreakerState.OPEN
+    clock.now += 5
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_open_circuit_fails_saga_without_calling_the_broker(monkeypatch):
+    breaker = CircuitBreaker("ProvisionUser", min_calls=1)
+    breaker.record(False)
+    assert breaker.is_open()
+    monkeypatch.setattr(orchestrator, "get_breaker", lambda name: breaker)
+    metrics = orchestrator.saga_metrics
+    metrics.reset()
+
+    saga = orchestrator.SagaOrchestrator()
+    saga.send_data({
+        "user": {"id": str(uuid.uuid4()), "name": "u", "email": "u@example.com"},
+        "permissions": ["read"],
+        "quota": {"storage_gb": 1, "ops_per_month": 1},
+        "fail": [False, False, False],
+    }, retry_policies={step_type: RetryPolicy(max_retries=5, base_delay=0)
+                       for step_type, _ in orchestrator.SAGA_DEFINITION})
+    saga.execute_saga()
+
+    data = metrics.data
+    assert data['compensated'] == 1
+    assert data['total_retries'] == 0
+    assert data['breaker_rejections'] == {"ProvisionUser": 1}
+    # Ni un RPC: el paso falló sin llegar al transporte
+    assert 'rpc_wait' not in data['step_timings'].get("ProvisionUser", {})
@@ -0,0 +1,64 @@
+from saga.codec import CODECS, codec_for, decode, get_codec
+from saga.transport import InMemoryTransport, handle_delivery
+from types import SimpleNamespace
+import pytest
+
+MESSAGE = {"type": "AssignPermissions",
+           "data": {"user_id": "u1", "permissions": ["read", "write"], "fail": False}}
+
+
+def test_json_is_the_default_and_legacy_messages_decode_as_json():
+    assert get_codec().name == "json"
+    body = b'{"type": "ProvisionUser", "data": {}}'
+    # Sin content_type: mensajes de versiones anteriores
+    assert decode(body, None) == {"type": "ProvisionUser", "data": {}}
+    assert codec_for("text/plain").name == "json"
+    with pytest.raises(ValueError):
+        get_codec("xml")
+
+
+def test_msgpack_round_trip_is_smaller():
+    pytest.importorskip("msgpack")
+    codec = CODECS["msgpack"]
+    body = codec.encode(MESSAGE)
+    assert decode(body, "application/msgpack") == MESSAGE
+    assert len(body) < len(CODECS["json"].encode(MESSAGE))
+
+
+class FakeChannel:
+    def __init__(self):
+        self.published = []
+        self.acked = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((body, properties))
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+@pytest.mark.parametrize("name", ["json", "msgpack"])
+def test_worker_replies_in_the_request_format(name):
+    if name == "msgpack":
+        pytest.importorskip("msgpack")
+    codec = CODECS[name]
+    channel = FakeChannel()
+    properties = SimpleNamespace(content_type=codec.content_type, reply_to="reply",
+                                 correlation_id="c1")
+    handle_delivery(channel, SimpleNamespace(delivery_tag=7), properties,
+                    codec.encode(MESSAGE), lambda evt: {"status": "ok", "type": evt["type"]})
+
+    body, reply_properties = channel.published[0]
+    assert reply_properties.content_type == codec.content_type
+    assert codec.decode(body) == {"status": "ok", "type": "AssignPermissions"}
+    assert channel.acked == [7]
+
+
+def test_memory_transport_uses_the_configured_codec():
+    pytest.importorskip("msgpack")
+    transport = InMemoryTransport(workers=1, codec="msgpack",
+                                  dispatch=lambda evt: {"status": "ok", "data": evt["data"]})
+    assert transport.call(MESSAGE)["data"] == MESSAGE["data"]
+    transport.publish("saga_dlq", MESSAGE)
+    assert transport.published["saga_dlq"] == [MESSAGE]
+    transport.close()
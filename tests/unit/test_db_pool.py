@@ -0,0 +1,62 @@
+from saga.db_pool import ConnectionManager
+from saga.storage import Storage
+import sqlite3
+import threading
+import pytest
+
+SPLIT, SINGLE = Storage("split"), Storage("single")
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = ConnectionManager(db_dir=str(tmp_path), synchronous="NORMAL", storage=SPLIT)
+    yield manager
+    manager.close_all()
+
+
+def test_each_thread_reuses_its_own_connection(manager):
+    conn = manager.get("users")
+    assert manager.get("users") is conn
+    assert manager.get("quotas") is not conn
+
+    other = []
+    thread = threading.Thread(target=lambda: (other.append(manager.get("users")),
+                                              manager.close_all()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+    # Cerrar las del otro hilo no afecta a las de este
+    assert conn.execute("SELECT 1").fetchone() == (1,)
+
+
+def test_single_storage_shares_one_connection(tmp_path):
+    manager = ConnectionManager(db_dir=str(tmp_path), storage=SINGLE)
+    try:
+        assert manager.get("users") is manager.get("quotas")
+        assert manager.get("users").execute("PRAGMA foreign_keys").fetchone() == (1,)
+    finally:
+        manager.close_all()
+
+
+def test_close_all_closes_and_forgets_the_connections(manager):
+    users, quotas = manager.get("users"), manager.get("quotas")
+    manager.close_all()
+
+    for conn in (users, quotas):
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+    assert manager.get("users") is not users
+
+
+def test_connections_use_wal_and_the_configured_synchronous(tmp_path):
+    for level, expected in (("NORMAL", 1), ("FULL", 2)):
+        manager = ConnectionManager(db_dir=str(tmp_path / level), synchronous=level,
+                                    storage=SPLIT)
+        (tmp_path / level).mkdir()
+        try:
+            conn = manager.get("users")
+            assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+            assert conn.execute("PRAGMA synchronous").fetchone() == (expected,)
+            assert conn.execute("PRAGMA busy_timeout").fetchone()[0] > 0
+        finally:
+            manager.close_all()
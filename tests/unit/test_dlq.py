@@ -0,0 +1,67 @@
+from saga.dlq import DLQPublisher
+from saga.transport import InMemoryTransport
+
+
+class FlakyTransport(InMemoryTransport):
+    """Transporte en memoria que simula un broker caído"""
+
+    def __init__(self):
+        super().__init__()
+        self.down = True
+
+    def publish_many(self, routing_key, messages):
+        if self.down:
+            raise ConnectionError("broker caído")
+        super().publish_many(routing_key, messages)
+
+
+def test_publishes_in_batches_through_the_transport(tmp_path):
+    transport = InMemoryTransport()
+    publisher = DLQPublisher(spill_path=str(tmp_path / "spill.jsonl"), transport=transport)
+    for i in range(10):
+        publisher.publish({"step_name": "CreateQuota", "n": i})
+    publisher.close()
+
+    assert [m["n"] for m in transport.published["saga_dlq"]] == list(range(10))
+    assert publisher.published == 10
+    assert not (tmp_path / "spill.jsonl").exists()
+
+
+def test_spills_to_disk_and_replays_when_broker_returns(tmp_path):
+    spill_path = tmp_path / "spill.jsonl"
+    transport = FlakyTransport()
+    publisher = DLQPublisher(spill_path=str(spill_path), transport=transport,
+                             replay_interval=3600)
+    for i in range(3):
+        publisher.publish({"step_name": "CreateQuota", "n": i})
+    publisher.flush()
+
+    assert publisher.spilled == 3
+    assert len(spill_path.read_text().splitlines()) == 3
+    assert transport.published["saga_dlq"] == []
+
+    transport.down = False
+    assert publisher.replay_spill() == 3
+    assert [m["n"] for m in transport.published["saga_dlq"]] == [0, 1, 2]
+    assert not spill_path.exists()
+    publisher.close()
+
+
+def test_a_failed_spill_does_not_stop_the_publisher(tmp_path, monkeypatch):
+    transport = FlakyTransport()
+    publisher = DLQPublisher(spill_path=str(tmp_path / "spill.jsonl"), transport=transport,
+                             replay_interval=3600)
+
+    def disk_full(messages):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(publisher, "_spill", disk_full)
+    publisher.publish({"step_name": "CreateQuota", "n": 0})
+    # Sin el hilo vivo flush() no retornaría nunca
+    publisher.flush()
+    assert publisher._thread.is_alive()
+
+    transport.down = False
+    publisher.publish({"step_name": "CreateQuota", "n": 1})
+    publisher.close()
+    assert [m["n"] for m in transport.published["saga_dlq"]] == [1]
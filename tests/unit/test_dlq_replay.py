@@ -0,0 +1,121 @@
+from saga.dlq_replay import DLQReplayer, SagaState, TokenBucket, parse_args, payload_from
+from saga.transport import InMemoryTransport
+from concurrent.futures import Future
+import time
+import pytest
+
+
+class RecordingSaga:
+    """Orquestador falso: registra el payload y los usuarios 'bad' se compensan"""
+    payloads = []
+
+    def send_data(self, raw_data, retry_policies=None):
+        self.raw_data = raw_data
+
+    def submit(self):
+        RecordingSaga.payloads.append(self.raw_data)
+        future = Future()
+        future.set_result(SagaState.COMPENSATED if self.raw_data['user']['name'] == 'bad'
+                          else SagaState.SUCCEEDED)
+        return future
+
+
+def failed_step(step_name, timestamp, name="ok"):
+    return {'type': 'FailedStep', 'step_name': step_name, 'timestamp': timestamp,
+            'step_data': {'user': {'id': 'u', 'name': name, 'email': 'e'},
+                          'user_id': 7, 'fail': [False, False, True]},
+            'last_response': None, 'retry_attempts': 3}
+
+
+def test_payload_drops_generated_ids_and_failure_flags():
+    payload = payload_from(failed_step("CreateQuota", 1))
+    assert 'user_id' not in payload
+    assert payload['fail'] == [False, False, False]
+    assert payload_from(failed_step("CreateQuota", 1), keep_fail=True)['fail'][2] is True
+
+
+def test_replays_matching_messages_and_requeues_the_rest():
+    RecordingSaga.payloads = []
+    transport = InMemoryTransport()
+    transport.published["saga_dlq"] = [
+        failed_step("CreateQuota", 100),
+        failed_step("AssignPermissions", 100),
+        failed_step("CreateQuota", 10),
+        failed_step("CreateQuota", 200, name="bad"),
+    ]
+    replayer = DLQReplayer(transport=transport, batch_size=2, concurrency=2, rate=1000,
+                           steps=["CreateQuota"], since=50,
+                           orchestrator_cls=RecordingSaga)
+    summary = replayer.run()
+
+    assert summary['replayed'] == 2
+    assert summary['succeeded'] == 1 and summary['compensated'] == 1
+    assert summary['skipped'] == 2
+    assert len(RecordingSaga.payloads) == 2
+    # Los omitidos vuelven a la cola en su orden y los reprocesados no
+    assert [(m['step_name'], m['timestamp']) for m in transport.published["saga_dlq"]] == [
+        ("AssignPermissions", 100), ("CreateQuota", 10)]
+    assert transport._unacked == {}
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # 1 token inicial + 5 a 50/s = 0.1s
+    assert time.monotonic() - start >= 0.09
+
+
+class FailingSaga(RecordingSaga):
+    """Vuelve a fallar: reenvía el paso al DLQ como lo haría la saga real"""
+    transport = None
+
+    def submit(self):
+        RecordingSaga.payloads.append(self.raw_data)
+        FailingSaga.transport.publish("saga_dlq", failed_step("CreateQuota", 300))
+        future = Future()
+        future.set_result(SagaState.COMPENSATED)
+        return future
+
+
+def test_messages_that_fail_again_wait_for_the_next_pass():
+    RecordingSaga.payloads = []
+    transport = InMemoryTransport()
+    FailingSaga.transport = transport
+    transport.published["saga_dlq"] = [failed_step("CreateQuota", i) for i in range(30)]
+    replayer = DLQReplayer(transport=transport, batch_size=7, concurrency=4, rate=10000,
+                           keep_fail=True, orchestrator_cls=FailingSaga)
+    summary = replayer.run()
+
+    assert summary['replayed'] == 30 and summary['compensated'] == 30
+    assert len(RecordingSaga.payloads) == 30
+    # Los reenvíos de esta pasada quedan en la cola para la siguiente
+    assert [m['timestamp'] for m in transport.published["saga_dlq"]] == [300] * 30
+    assert transport._unacked == {}
+
+
+def test_malformed_message_is_counted_and_requeued_without_stopping_the_pass():
+    RecordingSaga.payloads = []
+    transport = InMemoryTransport()
+    malformed = {'type': 'FailedStep', 'step_name': 'CreateQuota', 'timestamp': 100}
+    transport.published["saga_dlq"] = [
+        failed_step("CreateQuota", 100), malformed, failed_step("CreateQuota", 100)]
+    replayer = DLQReplayer(transport=transport, batch_size=2, concurrency=2, rate=1000,
+                           orchestrator_cls=RecordingSaga)
+    summary = replayer.run()
+
+    assert summary['replayed'] == 3
+    assert summary['succeeded'] == 2 and summary['error'] == 1
+    assert len(RecordingSaga.payloads) == 2
+    # Sin step_data no se puede reprocesar: queda en el DLQ para revisarlo
+    assert transport.published["saga_dlq"] == [malformed]
+    assert transport._unacked == {}
+
+
+def test_rate_must_be_positive():
+    with pytest.raises(SystemExit):
+        parse_args(["--rate", "0"])
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+    assert parse_args(["--rate", "0.5"]).rate == 0.5
@@ -0,0 +1,73 @@
+from saga.exporter import render_metrics, start_exporter
+from saga.metrics import SagaMetrics
+import logging
+import urllib.request
+import urllib.error
+import pytest
+
+
+@pytest.fixture
+def exporter():
+    metrics = SagaMetrics()
+    server = start_exporter(0, host="127.0.0.1", metrics=metrics, gauges={
+        "saga_outbox_backlog": ("Eventos del outbox sin publicar", None, lambda: 7),
+        "saga_queue_depth": ("Mensajes listos en la cola", "queue",
+                             lambda: {"saga_commands.CreateQuota": 3}),
+    })
+    yield metrics, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def scrape(url):
+    with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+        assert response.headers["Content-Type"].startswith("text/plain")
+        return response.read().decode("utf-8")
+
+
+def test_exports_counters_histograms_and_gauges(exporter):
+    metrics, url = exporter
+    metrics.record_saga_start()
+    metrics.record_saga_start()
+    metrics.record_retry()
+    metrics.record_saga_failure("CreateQuota", 0.2)
+    metrics.record_step_time("CreateQuota", "execute", 0.03)
+
+    body = scrape(url)
+    assert "saga_sagas_total 2" in body
+    assert "saga_retries_total 1" in body
+    assert "saga_compensations_total 1" in body
+    assert "saga_in_flight 1" in body
+    assert 'saga_step_failures_total{step="CreateQuota"} 1' in body
+    assert 'saga_execution_seconds_bucket{le="0.1"} 0' in body
+    assert 'saga_execution_seconds_bucket{le="+Inf"} 1' in body
+    assert 'saga_step_seconds_count{step="CreateQuota",phase="execute"} 1' in body
+    assert "saga_outbox_backlog 7" in body
+    assert 'saga_queue_depth{queue="saga_commands.CreateQuota"} 3' in body
+
+
+def test_unknown_path_returns_404(exporter):
+    _, url = exporter
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(f"{url}/other", timeout=5)
+    assert error.value.code == 404
+
+
+def test_a_failing_gauge_is_logged_and_skipped():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    exporter_logger = logging.getLogger("saga.exporter")
+    exporter_logger.addHandler(handler)
+    try:
+        body = render_metrics(SagaMetrics(), gauges={
+            "saga_broken": ("Gauge que falla", None, lambda: 1 / 0),
+            "saga_outbox_backlog": ("Eventos del outbox sin publicar", None, lambda: 7),
+        })
+    finally:
+        exporter_logger.removeHandler(handler)
+
+    assert "saga_broken" not in body
+    assert "saga_outbox_backlog 7" in body
+    assert [(r.levelname, r.getMessage()) for r in records] == [
+        ("ERROR", "Error al leer el gauge saga_broken: division by zero")]
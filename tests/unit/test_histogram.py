@@ -0,0 +1,39 @@
+from saga.histogram import LatencyHistogram
+import pytest
+
+
+def test_percentiles_within_precision():
+    histogram = LatencyHistogram()
+    for i in range(1, 1001):
+        histogram.record(i / 1000)
+
+    assert histogram.count == 1000
+    assert histogram.mean() == pytest.approx(0.5005)
+    assert histogram.percentile(50) == pytest.approx(0.5, rel=0.02)
+    assert histogram.percentile(99) == pytest.approx(0.99, rel=0.02)
+    assert histogram.summary()['max'] == 1.0
+
+
+def test_memory_does_not_grow_with_samples():
+    histogram = LatencyHistogram()
+    buckets = len(histogram.counts)
+    for _ in range(10000):
+        histogram.record(0.25)
+
+    assert len(histogram.counts) == buckets
+    assert histogram.percentile(90) == 0.25
+
+
+def test_merge():
+    first, second = LatencyHistogram(), LatencyHistogram()
+    first.record(0.1)
+    second.record(2.0)
+    first.merge(second)
+
+    assert first.count == 2
+    assert first.min == 0.1
+    assert first.max == 2.0
+
+
+def test_empty_histogram():
+    assert LatencyHistogram().summary() == {'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
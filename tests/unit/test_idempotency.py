@@ -0,0 +1,42 @@
+from saga import message_broker
+from saga.idempotency import prune
+import time
+
+
+def command(evt_type, key, **data):
+    return {"type": evt_type, "data": dict(data, fail=False, idempotency_key=key)}
+
+
+def test_repeated_command_returns_the_stored_reply(broker_db):
+    provision = command("ProvisionUser", "saga-1:ProvisionUser",
+                        id="u1", name="Ana", email="ana@example.com")
+    first = message_broker.dispatch(provision)
+    # Mismo id de usuario: sin la clave, el segundo INSERT violaría la PK
+    second = message_broker.dispatch(provision)
+    assert first['status'] == second['status'] == 'ok'
+    assert second['id'] == first['id']
+
+    assign = command("AssignPermissions", "saga-1:AssignPermissions",
+                     id="u1", permissions=["read"])
+    ids = {message_broker.dispatch(assign)['id'] for _ in range(3)}
+    assert len(ids) == 1
+    count = broker_db.get("permissions").execute("SELECT COUNT(*) FROM permissions").fetchone()[0]
+    assert count == 1
+
+
+def test_failures_are_not_cached(broker_db):
+    key = "saga-2:CreateQuota"
+    failing = command("CreateQuota", key, id="u2", storage_gb=1, ops_per_month=1)
+    failing["data"]["fail"] = True
+    assert message_broker.dispatch(failing)['status'] == 'error'
+
+    ok = command("CreateQuota", key, id="u2", storage_gb=1, ops_per_month=1)
+    assert message_broker.dispatch(ok)['status'] == 'ok'
+
+
+def test_prune_removes_expired_keys(broker_db):
+    message_broker.dispatch(command("CreateQuota", "saga-3:CreateQuota",
+                                    id="u3", storage_gb=1, ops_per_month=1))
+    conn = broker_db.get("quotas")
+    assert prune(conn, ttl=3600) == 0
+    assert prune(conn, ttl=3600, now=time.time() + 7200) == 1
@@ -0,0 +1,61 @@
+from saga import logger
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import pytest
+
+
+@pytest.fixture
+def json_logs():
+    root = logging.getLogger(logger.ROOT_LOGGER)
+    handlers, level = list(root.handlers), root.level
+    stream = io.StringIO()
+    logger.configure(level="INFO", fmt="json", stream=stream)
+    yield stream
+    # El resto de los tests sigue con la configuración del proceso
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def lines(stream):
+    logger.flush()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_records_carry_saga_and_step_fields(json_logs):
+    log = logger.bind(logger.get_logger("test"), saga_id="saga-1")
+    log.info("Retry %d en %s", 2, "CreateQuota", extra={"step": "CreateQuota"})
+    log.warning("sin paso")
+
+    first, second = lines(json_logs)
+    assert first["message"] == "Retry 2 en CreateQuota"
+    assert (first["level"], first["saga_id"], first["step"]) == ("INFO", "saga-1", "CreateQuota")
+    assert second["saga_id"] == "saga-1" and "step" not in second
+
+
+def test_disabled_levels_never_format_arguments(json_logs):
+    class Exploding:
+        def __str__(self):
+            raise AssertionError("formateado con el nivel deshabilitado")
+
+    logger.get_logger("test").debug("evento %s", Exploding())
+    assert lines(json_logs) == []
+
+
+def test_text_format_appends_context():
+    record = logging.LogRecord("saga.test", logging.INFO, __file__, 1, "Paso %s", ("A",), None)
+    record.saga_id, record.step = "s1", "A"
+    assert logger.TextFormatter("%(message)s").format(record) == "Paso A [saga_id=s1 step=A]"
+
+
+def test_imports_without_register_at_fork():
+    # Como en Windows, donde os.register_at_fork no existe
+    code = ("import os; del os.register_at_fork; import logger; "
+            "logger.get_logger('test').warning('sin fork'); logger.flush()")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(logger.__file__), timeout=30)
+    assert result.returncode == 0, result.stderr
+    assert "sin fork" in result.stdout
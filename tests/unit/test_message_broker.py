@@ -0,0 +1,100 @@
+from saga import message_broker
+from saga.transport import AmqpTransport
+from types import SimpleNamespace
+import json
+import queue
+import threading
+import pika
+
+WORKERS = 4
+
+
+class FakeChannel:
+    """Canal falso: consume de una cola compartida entre todos los workers"""
+
+    def __init__(self, deliveries, acks):
+        self.deliveries = deliveries
+        self.acks = acks
+        self.replies = []
+        self.callbacks = []
+        self.prefetch_count = None
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def queue_declare(self, **kwargs):
+        pass
+
+    def queue_bind(self, **kwargs):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        self.callbacks.append(on_message_callback)
+
+    def start_consuming(self):
+        # Un mensaje a la vez (prefetch 1) hasta vaciar la cola
+        while True:
+            try:
+                tag, body = self.deliveries.get_nowait()
+            except queue.Empty:
+                return
+            properties = pika.BasicProperties(content_type="application/json",
+                                              reply_to="amq.gen-reply", correlation_id=str(tag))
+            self.callbacks[0](self, SimpleNamespace(delivery_tag=tag), properties, body)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.replies.append((properties.correlation_id, json.loads(body)))
+
+    def basic_ack(self, delivery_tag):
+        self.acks.append((self, delivery_tag))
+
+
+class FakeConnection:
+    def __init__(self, channel):
+        self._channel = channel
+        self.is_open = True
+
+    def channel(self):
+        return self._channel
+
+    def close(self):
+        self.is_open = False
+
+
+def test_workers_consume_and_ack_concurrently(monkeypatch):
+    deliveries, acks, channels = queue.Queue(), [], []
+    for tag in range(WORKERS):
+        deliveries.put((tag, json.dumps({"type": "ProvisionUser", "data": {"n": tag}})))
+
+    def connect(params):
+        channels.append(FakeChannel(deliveries, acks))
+        return FakeConnection(channels[-1])
+
+    # Cada handler espera a los demás: solo termina si los WORKERS corren a la vez
+    barrier = threading.Barrier(WORKERS, timeout=5)
+    handled_by = set()
+
+    def dispatch(evt):
+        handled_by.add(threading.current_thread().name)
+        barrier.wait()
+        return {'status': 'ok', 'n': evt['data']['n']}
+
+    monkeypatch.setattr(pika, "BlockingConnection", connect)
+    monkeypatch.setattr(message_broker, "get_transport", AmqpTransport)
+    monkeypatch.setattr(message_broker, "dispatch", dispatch)
+
+    message_broker.start_workers(workers=WORKERS, prefetch_count=1, mode="thread")
+
+    assert not barrier.broken
+    assert len(handled_by) == WORKERS
+    # Cada worker hace ack en su propio canal y responde a su correlation_id
+    assert len(channels) == WORKERS
+    assert {channel for channel, _ in acks} == set(channels)
+    assert sorted(tag for _, tag in acks) == list(range(WORKERS))
+    replies = [reply for channel in channels for reply in channel.replies]
+    assert sorted((corr_id, reply['n']) for corr_id, reply in replies) == [
+        (str(tag), tag) for tag in range(WORKERS)]
+    assert all(channel.prefetch_count == 1 for channel in channels)
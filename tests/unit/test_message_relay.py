@@ -0,0 +1,94 @@
+from saga.initialize_databases import initialize_database_by_type
+from saga.message_relay import OutboxRelay
+from saga.transport import InMemoryTransport
+import pika
+import sqlite3
+import time
+import pytest
+
+
+def connect(tmp_path, db_type):
+    return sqlite3.connect(str(tmp_path / f"{db_type}.db"))
+
+
+def test_relay_prunes_only_old_processed_rows(tmp_path):
+    initialize_database_by_type(["users"], str(tmp_path))
+    conn = connect(tmp_path, "users")
+    now = time.time()
+    conn.executemany("INSERT INTO outbox (step, payload, processed, processed_at) VALUES (?, ?, ?, ?)",
+                     [("a", "{}", 1, now - 3600), ("b", "{}", 1, now), ("c", "{}", 0, None)])
+    conn.commit()
+
+    relay = OutboxRelay(db_path=str(tmp_path / "users.db"), transport=InMemoryTransport(),
+                        retention=60)
+    try:
+        assert relay.prune_processed(now=now) == 1
+        assert relay.process_batch() == (1, 1)
+    finally:
+        relay.close()
+    rows = conn.execute("SELECT step, processed, processed_at IS NOT NULL FROM outbox ORDER BY id")
+    assert rows.fetchall() == [("b", 1, 1), ("c", 1, 1)]
+
+
+def test_relay_refuses_an_unmigrated_outbox(tmp_path):
+    conn = connect(tmp_path, "users")
+    conn.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, step TEXT NOT NULL, "
+                 "payload TEXT NOT NULL, processed INTEGER DEFAULT 0)")
+    conn.execute("INSERT INTO outbox (step, payload) VALUES ('ProvisionUser', '{}')")
+    conn.commit()
+
+    transport = InMemoryTransport()
+    relay = OutboxRelay(db_path=str(tmp_path / "users.db"), transport=transport)
+    try:
+        # Falla antes de publicar: si no, el evento saldría en cada reintento
+        with pytest.raises(RuntimeError, match="initialize_databases"):
+            relay.run_forever()
+    finally:
+        relay.close()
+    assert transport.published == {}
+
+    initialize_database_by_type(["users"], str(tmp_path))
+    relay = OutboxRelay(db_path=str(tmp_path / "users.db"), transport=transport)
+    try:
+        assert relay.process_batch() == (1, 1)
+    finally:
+        relay.close()
+
+
+def test_relay_publishes_each_batch_with_one_call(tmp_path):
+    class CountingTransport(InMemoryTransport):
+        def __init__(self, fail=False):
+            super().__init__()
+            self.fail = fail
+            self.batches = []
+
+        def publish(self, routing_key, message):
+            raise AssertionError("el relay publica por lotes")
+
+        def publish_many(self, routing_key, messages):
+            if self.fail:
+                raise pika.exceptions.AMQPConnectionError("broker caído")
+            self.batches.append([message["id"] for message in messages])
+
+    initialize_database_by_type(["users"], str(tmp_path))
+    conn = connect(tmp_path, "users")
+    conn.executemany("INSERT INTO outbox (step, payload) VALUES (?, ?)",
+                     [("ProvisionUser", '{"n": %d}' % i) for i in range(5)])
+    conn.commit()
+    db_path = str(tmp_path / "users.db")
+
+    relay = OutboxRelay(db_path=db_path, batch_size=3, transport=CountingTransport(fail=True))
+    try:
+        # Lote rechazado: ninguna fila queda como procesada
+        assert relay.process_batch() == (3, 0)
+    finally:
+        relay.close()
+
+    transport = CountingTransport()
+    relay = OutboxRelay(db_path=db_path, batch_size=3, transport=transport)
+    try:
+        assert relay.process_batch() == (3, 3)
+        assert relay.process_batch() == (2, 2)
+    finally:
+        relay.close()
+    assert transport.batches == [[1, 2, 3], [4, 5]]
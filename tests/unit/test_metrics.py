@@ -1,5 +1,7 @@
-from saga.metrics import saga_metrics
+from saga.metrics import saga_metrics, SagaMetrics
+from concurrent.futures import ThreadPoolExecutor
 from saga.orchestrator import SagaOrchestrator
+import pickle
 import sys
 import os
 import uuid
@@ -82,5 +84,83 @@ def test_full_metrics_report(fresh_metrics):
     print("\nTest completado")
 
 
+def test_concurrent_recording_does_not_lose_updates():
+    metrics = SagaMetrics()
+
+    def record(n):
+        for _ in range(n):
+            metrics.record_saga_start()
+            metrics.record_retry()
+            metrics.record_saga_failure("CreateQuota", 0.1)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(record, [2000] * 16))
+
+    other = SagaMetrics()
+    other.record_saga_start()
+    other.record_saga_success(0.2)
+    metrics.merge(other.snapshot())
+
+    report = metrics.get_report()
+    assert report['total_sagas'] == 32001
+    assert report['step_failures'] == {"CreateQuota": 32000}
+    assert metrics.data['total_retries'] == 32000
+
+
+def test_step_latency_breakdown():
+    metrics = SagaMetrics()
+    metrics.record_step_time("CreateQuota", "execute", 0.05)
+    metrics.record_step_time("CreateQuota", "retry", 0.07)
+    metrics.record_rpc("CreateQuota", 0.04, {'status': 'ok', 'handler_time': 0.01})
+    metrics.record_saga_start()
+
+    latencies = metrics.get_report()['step_latencies']['CreateQuota']
+    assert list(latencies) == ["execute", "retry", "rpc_wait", "handler"]
+    assert latencies['handler']['max'] == "0.0100s"
+
+
+def test_broker_and_orchestrator_do_not_double_count_the_handler():
+    # Broker y orquestador en el mismo proceso miden el mismo handler
+    metrics = SagaMetrics()
+    metrics.record_command("CreateQuota", 0.01, "ok")
+    metrics.record_rpc("CreateQuota", 0.04, {'status': 'ok', 'handler_time': 0.01})
+
+    data = metrics.data
+    assert data['step_timings']["CreateQuota"]['handler'].count == 1
+    assert data['command_timings']["CreateQuota"].count == 1
+    assert data['commands'] == {"CreateQuota": {"ok": 1}}
+    metrics.merge(metrics.snapshot())
+    assert metrics.data['command_timings']["CreateQuota"].count == 2
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requiere os.fork")
+def test_forked_child_starts_with_empty_shards():
+    metrics = SagaMetrics()
+    metrics.record_saga_start()
+    metrics.record_step_time("CreateQuota", "execute", 0.05)
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Hijo: registra lo suyo y envía el snapshot, como un worker de un pool
+        try:
+            os.close(read_fd)
+            metrics.record_saga_start()
+            metrics.record_saga_success(0.1)
+            with os.fdopen(write_fd, "wb") as pipe:
+                pickle.dump(metrics.snapshot(), pipe)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as pipe:
+        snapshot = pickle.load(pipe)
+    os.waitpid(pid, 0)
+
+    assert snapshot['total_sagas'] == 1 and snapshot['succeeded'] == 1
+    assert snapshot['step_timings'] == {}
+    metrics.merge(snapshot)
+    assert metrics.data['total_sagas'] == 2
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "-s"])
@@ -0,0 +1,46 @@
+from saga.initialize_databases import (initialize_database_by_type, database_types,
+                                      schema_version, MIGRATIONS)
+import sqlite3
+
+
+def connect(tmp_path, db_type):
+    return sqlite3.connect(str(tmp_path / f"{db_type}.db"))
+
+
+def test_new_databases_get_latest_schema_and_pragmas(tmp_path):
+    initialize_database_by_type(database_types, str(tmp_path))
+    initialize_database_by_type(database_types, str(tmp_path))
+
+    for db_type in database_types:
+        conn = connect(tmp_path, db_type)
+        assert schema_version(conn) == len(MIGRATIONS[db_type])
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA page_size").fetchone()[0] == 8192
+
+    conn = connect(tmp_path, "users")
+    plan = " ".join(row[-1] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id, step, payload FROM outbox "
+        "WHERE processed=0 ORDER BY id LIMIT 100"))
+    assert "idx_outbox_unprocessed" in plan
+    plan = " ".join(row[-1] for row in connect(tmp_path, "quotas").execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM quotas WHERE user_id=?", ("u1",)))
+    assert "idx_quotas_user_id" in plan
+
+
+def test_legacy_database_is_migrated_in_place(tmp_path):
+    conn = connect(tmp_path, "users")
+    conn.execute("CREATE TABLE users (id TEXT PRIMARY KEY, name TEXT NOT NULL, email TEXT NOT NULL)")
+    conn.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, step TEXT NOT NULL, "
+                 "payload TEXT NOT NULL, processed INTEGER DEFAULT 0)")
+    conn.executemany("INSERT INTO outbox (step, payload, processed) VALUES (?, ?, ?)",
+                     [("ProvisionUser", "{}", 1), ("ProvisionUser", "{}", 0)])
+    conn.commit()
+    conn.close()
+
+    initialize_database_by_type(["users"], str(tmp_path))
+
+    conn = connect(tmp_path, "users")
+    assert schema_version(conn) == len(MIGRATIONS["users"])
+    rows = conn.execute("SELECT processed, processed_at IS NOT NULL FROM outbox ORDER BY id").fetchall()
+    assert rows == [(1, 1), (0, 0)]
+
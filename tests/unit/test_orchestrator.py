@@ -0,0 +1,154 @@
+from saga import benchmark, orchestrator
+from saga.orchestrator import SagaOrchestrator, SagaState, Step
+from saga.retry import RetryPolicy
+import time
+import uuid
+import pytest
+
+
+class FakeStep(Step):
+    def __init__(self, name, execute=None):
+        # Nombre único: cada paso tiene su propio circuit breaker
+        self.name = f"{name}-{uuid.uuid4().hex[:8]}"
+        self.data = {}
+        self.retry_policy = RetryPolicy(max_retries=1, base_delay=0)
+        self._execute = execute or (lambda: {"status": True})
+        self.rolled_back = False
+
+    def execute(self):
+        return self._execute()
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+class RecordingPublisher:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, message):
+        self.messages.append(message)
+
+
+@pytest.fixture
+def dlq(monkeypatch):
+    publisher = RecordingPublisher()
+    monkeypatch.setattr(orchestrator, "get_dlq_publisher", lambda: publisher)
+    return publisher
+
+
+def saga_with(*steps):
+    saga = SagaOrchestrator()
+    saga.saga_log = None  # sin log aunque SAGA_LOG_PATH esté definido
+    first, *rest = steps
+    saga.add_step(first)
+    for step in rest:
+        saga.add_step(step, [first.name])
+    return saga
+
+
+def test_steps_run_after_their_dependency_and_the_saga_succeeds(dlq):
+    first, second, third = FakeStep("a"), FakeStep("b"), FakeStep("c")
+    saga = saga_with(first, second, third)
+
+    assert saga.submit().result(timeout=5) == SagaState.SUCCEEDED
+    assert saga.completed[0] is first
+    assert {step.name for step in saga.completed[1:]} == {second.name, third.name}
+    assert dlq.messages == []
+
+
+def test_a_step_that_breaks_the_attempt_compensates_the_saga(dlq):
+    first = FakeStep("a")
+    # Una respuesta None rompe response["status"] fuera del try de execute()
+    broken = FakeStep("b", execute=lambda: None)
+    saga = saga_with(first, broken)
+
+    assert saga.submit().result(timeout=5) == SagaState.COMPENSATED
+    assert first.rolled_back
+    assert [message['step_name'] for message in dlq.messages] == [broken.name]
+    assert "TypeError" in dlq.messages[0]['last_response']['error']
+
+
+def test_a_step_that_cannot_start_compensates_the_saga(dlq, monkeypatch):
+    first, second = FakeStep("a"), FakeStep("b")
+    saga = saga_with(first, second)
+    mark_started = saga.mark_started
+
+    def fail_second(step):
+        if step is second:
+            raise OSError("disk I/O error")
+        mark_started(step)
+
+    monkeypatch.setattr(saga, "mark_started", fail_second)
+
+    assert saga.submit().result(timeout=5) == SagaState.COMPENSATED
+    assert first.rolled_back and not second.rolled_back
+    assert "disk I/O error" in dlq.messages[0]['last_response']['error']
+
+
+def test_a_failed_log_write_after_a_step_still_finishes_the_saga(dlq, monkeypatch):
+    first, second = FakeStep("a"), FakeStep("b")
+    saga = saga_with(first, second)
+    mark_completed = saga.mark_completed
+
+    def fail_second(step):
+        mark_completed(step)
+        if step is second:
+            raise OSError("saga log cerrado")
+
+    monkeypatch.setattr(saga, "mark_completed", fail_second)
+
+    assert saga.submit().result(timeout=5) == SagaState.COMPENSATED
+    # El paso se aplicó: también se compensa
+    assert first.rolled_back and second.rolled_back
+
+
+def test_aborting_cancels_the_retries_waiting_for_their_backoff(dlq):
+    attempts = []
+
+    def always_fails():
+        attempts.append(1)
+        return {"status": False}
+
+    def fails_once_the_retry_is_parked():
+        deadline = time.monotonic() + 2
+        while orchestrator.retry_scheduler.pending() == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return {"status": False}
+
+    first = FakeStep("a")
+    slow = FakeStep("b", execute=always_fails)
+    slow.retry_policy = RetryPolicy(max_retries=3, base_delay=10, jitter=0)
+    failing = FakeStep("c", execute=fails_once_the_retry_is_parked)
+    failing.retry_policy = RetryPolicy(max_retries=0)
+    saga = saga_with(first, slow, failing)
+
+    started_at = time.monotonic()
+    assert saga.submit().result(timeout=5) == SagaState.COMPENSATED
+    # No espera los 10s de backoff del reintento estacionado
+    assert time.monotonic() - started_at < 5
+    assert len(attempts) == 2
+    assert orchestrator.retry_scheduler.pending() == 0
+    assert first.rolled_back
+    assert [message['step_name'] for message in dlq.messages] == [failing.name]
+
+
+def test_reused_orchestrator_runs_each_saga_from_scratch(memory_broker, dlq, count):
+    no_retry = {step_type: RetryPolicy(max_retries=0, base_delay=0)
+                for step_type, _ in orchestrator.SAGA_DEFINITION}
+    first, second = benchmark.build_payloads(2, 0)
+    second["fail"] = [False, False, True]
+    saga = SagaOrchestrator()
+    saga.saga_log = None  # sin log aunque SAGA_LOG_PATH esté definido
+
+    saga.send_data(first, retry_policies=no_retry)
+    assert saga.execute_saga() == SagaState.SUCCEEDED
+    first_id = saga.saga_id
+    saga.send_data(second, retry_policies=no_retry)
+    assert saga.execute_saga() == SagaState.COMPENSATED
+
+    assert saga.saga_id != first_id
+    assert len(saga.steps) == 3
+    # La segunda saga corrió sus pasos y los compensó; la primera quedó intacta
+    assert [count(table) for table in benchmark.database_types] == [1, 1, 1]
+    assert [message['step_name'] for message in dlq.messages] == ["CreateQuota"]
@@ -0,0 +1,94 @@
+from saga import benchmark
+from saga.orchestrator import SagaOrchestrator, SagaState
+from saga.retry import RetryPolicy, RetryScheduler
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+def test_first_retry_is_immediate_then_backs_off():
+    policy = RetryPolicy(base_delay=1, max_delay=3, jitter=0)
+    assert [policy.delay_before(attempt) for attempt in range(5)] == [0, 0, 1, 2, 3]
+
+
+def test_delayed_calls_run_in_due_order_without_blocking_the_caller():
+    executor = ThreadPoolExecutor(max_workers=2)
+    scheduler = RetryScheduler(executor)
+    calls, done = [], threading.Event()
+
+    def record(name):
+        calls.append(name)
+        if len(calls) == 3:
+            done.set()
+
+    started_at = time.monotonic()
+    scheduler.call_later(0.2, record, "late")
+    scheduler.call_later(0.05, record, "early")
+    scheduler.call_later(0, record, "now")
+    assert time.monotonic() - started_at < 0.05
+    assert scheduler.pending() == 2
+
+    assert done.wait(2)
+    assert calls == ["now", "early", "late"]
+    assert scheduler.pending() == 0
+    executor.shutdown()
+
+
+def test_scheduler_survives_an_executor_that_rejects_a_call():
+    class FlakyExecutor(ThreadPoolExecutor):
+        rejected = False
+
+        def submit(self, fn, *args):
+            if not self.rejected:
+                self.rejected = True
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            return super().submit(fn, *args)
+
+    executor = FlakyExecutor(max_workers=1)
+    scheduler = RetryScheduler(executor)
+    ran = threading.Event()
+    scheduler.call_later(0.01, lambda: None)
+    scheduler.call_later(0.05, ran.set)
+
+    # El primer reintento se pierde, pero el hilo sigue entregando los demás
+    assert ran.wait(2)
+    executor.shutdown()
+
+
+def test_cancelled_calls_never_run():
+    executor = ThreadPoolExecutor(max_workers=1)
+    scheduler = RetryScheduler(executor)
+    calls, done = [], threading.Event()
+
+    cancelled = scheduler.call_later(0.05, calls.append, "cancelled")
+    scheduler.call_later(0.1, lambda: (calls.append("kept"), done.set()))
+    assert scheduler.cancel(cancelled)
+    assert scheduler.pending() == 1
+
+    assert done.wait(2)
+    assert calls == ["kept"]
+    # Ya no está estacionado: no se puede cancelar dos veces
+    assert not scheduler.cancel(cancelled)
+    assert scheduler.call_later(0, calls.append, "now") is None
+    executor.shutdown()
+
+
+def test_retry_policies_override_the_policy_of_one_step_type(memory_broker):
+    raw_data = benchmark.build_payloads(1, 0)[0]
+    raw_data["fail"] = [False, False, True]
+    saga = SagaOrchestrator()
+    saga.saga_log = None  # sin log aunque SAGA_LOG_PATH esté definido
+    saga.send_data(raw_data, retry_policies={
+        "create_quota": RetryPolicy(max_retries=2, base_delay=0)})
+    steps = {step.name: step for step in saga.steps}
+
+    attempts = []
+    execute = steps["CreateQuota"].execute
+    steps["CreateQuota"].execute = lambda: (attempts.append(1), execute())[1]
+
+    assert saga.execute_saga() == SagaState.COMPENSATED
+    # Ejecución inicial + 2 reintentos; los demás pasos conservan la política por defecto
+    assert len(attempts) == 3
+    assert steps["ProvisionUser"].retry_policy.max_retries == 5
+    benchmark.get_dlq_publisher().flush()
+    assert [m['retry_attempts'] for m in memory_broker.published["saga_dlq"]] == [2]
@@ -0,0 +1,59 @@
+from saga.routing import (BATCH_COMMANDS, COMMAND_QUEUE_NAME, COMPENSATION_COMMANDS,
+                          COMPENSATION_QUEUE_NAME, DLQ_QUEUE_NAME, STEP_COMMANDS,
+                          declare_topology, queue_for, queues_for, routing_key_for)
+import pytest
+
+
+class RecordingChannel:
+    """Registra los bindings: routing key -> cola"""
+
+    def __init__(self):
+        self.bindings = {}
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def queue_declare(self, **kwargs):
+        pass
+
+    def queue_bind(self, exchange, queue, routing_key):
+        # Una routing key nunca se enlaza a dos colas distintas
+        assert self.bindings.setdefault(routing_key, queue) == queue
+
+
+def bindings():
+    channel = RecordingChannel()
+    declare_topology(channel)
+    return channel.bindings
+
+
+def deliver_to(evt_type):
+    return bindings()[routing_key_for(evt_type)]
+
+
+def test_each_command_type_gets_its_own_queue():
+    for evt_type in STEP_COMMANDS + BATCH_COMMANDS:
+        assert routing_key_for(evt_type) == f"saga.{evt_type}"
+        assert deliver_to(evt_type) == queue_for(evt_type) == f"{COMMAND_QUEUE_NAME}.{evt_type}"
+    # Las compensaciones comparten su propio carril
+    for evt_type in COMPENSATION_COMMANDS:
+        assert deliver_to(evt_type) == COMPENSATION_QUEUE_NAME
+
+
+def test_unknown_types_fall_back_to_the_legacy_queue():
+    assert routing_key_for("LegacyEvent") == COMMAND_QUEUE_NAME
+    assert routing_key_for(None) == COMMAND_QUEUE_NAME
+    assert deliver_to("LegacyEvent") == COMMAND_QUEUE_NAME
+    assert deliver_to("FailedStep") == COMMAND_QUEUE_NAME
+    assert bindings()[DLQ_QUEUE_NAME] == DLQ_QUEUE_NAME
+
+
+def test_subscriptions_map_to_queues():
+    assert queues_for(["CreateQuota", "compensations", "legacy", "CompositeCreateQuota"]) == [
+        f"{COMMAND_QUEUE_NAME}.CreateQuota", COMPENSATION_QUEUE_NAME, COMMAND_QUEUE_NAME]
+    # Sin suscripciones se consumen todas las colas, incluida la compartida
+    everything = queues_for()
+    assert COMMAND_QUEUE_NAME in everything and COMPENSATION_QUEUE_NAME in everything
+    assert len(everything) == len(STEP_COMMANDS + BATCH_COMMANDS) + 2
+    with pytest.raises(ValueError):
+        queues_for(["NoSuchCommand"])
@@ -0,0 +1,101 @@
+from saga import rpc_client
+from saga.rpc_client import RpcClient, get_rpc_client, close_rpc_client
+from types import SimpleNamespace
+import threading
+import time
+import pika
+import pytest
+
+
+class FakeConnection:
+    """Conexión y canal falsos: responde los comandos en orden inverso al envío"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.is_open = True
+        self.published = []
+        self.in_flight = []
+        self.on_response = None
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue, exclusive):
+        return SimpleNamespace(method=SimpleNamespace(queue="amq.gen-reply"))
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self.on_response = on_message_callback
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        event = self.codec.decode(body)
+        self.published.append((properties.correlation_id, event))
+        if event['type'] != 'Slow':
+            self.in_flight.append((properties.correlation_id, event))
+
+    def process_data_events(self, time_limit=None):
+        if not self.in_flight:
+            time.sleep(min(time_limit or 0, 0.01))
+            return
+        # Una respuesta sin dueño se descarta
+        self.reply("stale", {'status': 'ok'})
+        for corr_id, event in reversed(self.in_flight):
+            self.reply(corr_id, {'status': 'ok', 'data': event['data']})
+        self.in_flight = []
+
+    def reply(self, corr_id, response):
+        props = pika.BasicProperties(correlation_id=corr_id,
+                                     content_type=self.codec.content_type)
+        self.on_response(self, None, props, self.codec.encode(response))
+
+    def close(self):
+        self.is_open = False
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def connect(params):
+        opened.append(FakeConnection(rpc_client.get_codec()))
+        return opened[-1]
+    monkeypatch.setattr(rpc_client.pika, "BlockingConnection", connect)
+    return opened
+
+
+def test_responses_are_matched_by_correlation_id(connections):
+    client = RpcClient()
+    responses = client.call_many([{"type": "CreateQuota", "data": {"n": i}} for i in range(3)])
+
+    assert [response['data']['n'] for response in responses] == [0, 1, 2]
+    assert client.call({"type": "ProvisionUser", "data": {"n": 3}})['data'] == {"n": 3}
+    # Una sola conexión para todas las llamadas, sin respuestas pendientes
+    assert len(connections) == 1
+    assert client.responses == {} and client.pending == set()
+    client.close()
+
+
+def test_timeout_returns_none_and_drops_the_late_response(connections):
+    client = RpcClient()
+    started_at = time.monotonic()
+    assert client.call({"type": "Slow", "data": {}}, timeout=0.05) is None
+    assert time.monotonic() - started_at < 1
+
+    corr_id, _ = connections[0].published[0]
+    connections[0].reply(corr_id, {'status': 'ok'})
+    assert client.responses == {}
+    client.close()
+
+
+def test_each_thread_reuses_its_own_client():
+    client = get_rpc_client()
+    assert get_rpc_client() is client
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(get_rpc_client()))
+    thread.start()
+    thread.join()
+    assert other[0] is not client
+
+    close_rpc_client()
+    assert get_rpc_client() is not client
+    close_rpc_client()
@@ -0,0 +1,90 @@
+from saga import benchmark
+from saga.orchestrator import SagaOrchestrator, recover_sagas
+from saga.saga_log import SagaLog, STEP_COMPLETED, STEP_STARTED
+from saga.state import SagaState
+import time
+import pytest
+
+
+@pytest.fixture
+def saga_log(tmp_path):
+    log = SagaLog(str(tmp_path / "saga_log.db"))
+    yield log
+    log.close()
+
+
+def crashed_saga(saga_log, applied, sent_only):
+    """Saga cuyo proceso cayó: `applied` llegó al broker sin STEP_COMPLETED"""
+    saga = SagaOrchestrator(saga_log=saga_log)
+    saga.send_data(benchmark.build_payloads(1, 0)[0])
+    saga.start()
+    steps = {step.name: step for step in saga.steps}
+    for name in applied:
+        saga.mark_started(steps[name])
+        assert steps[name].execute()["status"]
+    for name in sent_only:
+        saga.mark_started(steps[name])
+    return saga, steps
+
+
+def test_durable_append_does_not_wait_for_the_batch(tmp_path):
+    saga_log = SagaLog(str(tmp_path / "slow.db"), flush_interval=5)
+    try:
+        started_at = time.monotonic()
+        saga_log.append("s1", STEP_STARTED, step="ProvisionUser",
+                        durable=True).result(timeout=2)
+        # El registro durable se confirma sin esperar los 5s del lote
+        assert time.monotonic() - started_at < 1
+        assert [entry['event'] for entry in saga_log.entries("s1")] == [STEP_STARTED]
+    finally:
+        saga_log.close()
+
+
+def test_recovery_compensates_applied_steps_and_cancels_the_rest(memory_broker, saga_log, count):
+    saga, steps = crashed_saga(saga_log, applied=["ProvisionUser"],
+                               sent_only=["AssignPermissions"])
+    saga_log.flush()
+    assert count("users") == 1
+
+    recovered = recover_sagas(saga_log)
+    saga_log.flush()
+
+    assert [s.saga_id for s in recovered] == [saga.saga_id]
+    assert saga_log.status(saga.saga_id)['state'] == SagaState.COMPENSATED.value
+    assert count("users") == 0
+    # El comando que seguía en una cola llega tarde y ya no se aplica
+    late = memory_broker.call(steps["AssignPermissions"].keyed_command())
+    assert late['status'] == 'error'
+    assert count("permissions") == 0
+    assert recover_sagas(saga_log) == []
+
+
+def test_resume_reuses_the_idempotency_key_of_unconfirmed_steps(memory_broker, saga_log, count):
+    saga, _ = crashed_saga(saga_log, applied=["ProvisionUser"], sent_only=[])
+    saga_log.flush()
+
+    recover_sagas(saga_log, mode="resume")
+    saga_log.flush()
+
+    assert saga_log.status(saga.saga_id)['state'] == SagaState.SUCCEEDED.value
+    assert [count(table) for table in benchmark.database_types] == [1, 1, 1]
+
+
+def test_completed_steps_log_only_their_own_ids(memory_broker, saga_log):
+    saga, steps = crashed_saga(saga_log, applied=["ProvisionUser", "AssignPermissions"],
+                               sent_only=[])
+    for name in ("ProvisionUser", "AssignPermissions"):
+        saga.mark_completed(steps[name])
+    saga_log.flush()
+
+    payloads = {entry['step']: entry['payload'] for entry in saga_log.entries(saga.saga_id)
+                if entry['event'] == STEP_COMPLETED}
+    assert payloads == {
+        "ProvisionUser": {"user_id": saga.raw_data["user_id"]},
+        "AssignPermissions": {"permision_id": saga.raw_data["permision_id"]},
+    }
+    # La saga restaurada recupera los datos iniciales más los ids de cada paso
+    restored = SagaOrchestrator.restore(saga.saga_id, saga_log)
+    assert restored.raw_data["user"] == saga.raw_data["user"]
+    assert restored.raw_data["user_id"] == saga.raw_data["user_id"]
+    assert restored.raw_data["permision_id"] == saga.raw_data["permision_id"]
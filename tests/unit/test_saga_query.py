@@ -0,0 +1,96 @@
+from saga.orchestrator import SagaGraph
+from saga.saga_log import SagaLog
+from saga.saga_query import get_saga, sagas_for_user, list_sagas, main
+from saga.state import SagaState
+import os
+import sqlite3
+import pytest
+
+
+@pytest.fixture
+def saga_log(tmp_path):
+    log = SagaLog(str(tmp_path / "saga_log.db"))
+    yield log
+    log.close()
+
+
+def run_saga(saga_log, user_id, failed_step=None):
+    saga = SagaGraph(saga_log=saga_log)
+    saga.send_data({"user": {"id": user_id, "name": "Ana", "email": "ana@example.com"},
+                    "permissions": ["read"], "quota": {"storage_gb": 1, "ops_per_month": 1}})
+    saga.start()
+    if failed_step is not None:
+        saga.mark_failed(saga.steps[failed_step])
+        saga.set_state(SagaState.COMPENSATING)
+        saga.set_state(SagaState.COMPENSATED)
+    return saga.saga_id
+
+
+def test_status_tracks_user_and_failed_step(saga_log):
+    running = run_saga(saga_log, "u1")
+    failed = run_saga(saga_log, "u1", failed_step=2)
+    run_saga(saga_log, "u2")
+    saga_log.flush()
+
+    assert get_saga(running, saga_log)['state'] == 'RUNNING'
+    status = get_saga(failed, saga_log)
+    assert (status['state'], status['user_id'], status['failed_step']) == \
+        ('COMPENSATED', 'u1', 'CreateQuota')
+    assert status['started_at'] <= status['updated_at']
+    assert [s['saga_id'] for s in sagas_for_user("u1", saga_log=saga_log)] == [failed, running]
+    assert get_saga("desconocida", saga_log) is None
+
+
+def test_listing_pages_with_a_cursor(saga_log):
+    ids = [run_saga(saga_log, f"u{i}") for i in range(7)]
+    run_saga(saga_log, "u-failed", failed_step=0)
+    saga_log.flush()
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = list_sagas(SagaState.RUNNING, limit=3, cursor=cursor, saga_log=saga_log)
+        seen.extend(row['saga_id'] for row in rows)
+        if cursor is None:
+            break
+    assert sorted(seen) == sorted(ids)
+    assert len(seen) == len(set(seen))
+
+    plan = " ".join(row[-1] for row in saga_log.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT saga_id FROM saga_state "
+        "WHERE state=? AND (updated_at, saga_id) > (?, ?) ORDER BY updated_at, saga_id LIMIT 3",
+        ("RUNNING", 0, "")))
+    assert "idx_saga_state_listing" in plan
+
+
+def test_legacy_log_gets_status_columns_and_cli_reads_it(tmp_path, capsys):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE saga_state (saga_id TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                 "updated_at REAL NOT NULL)")
+    conn.execute("CREATE INDEX idx_saga_state_state ON saga_state(state)")
+    conn.execute("INSERT INTO saga_state VALUES ('s1', 'RUNNING', 1.0)")
+    conn.commit()
+    conn.close()
+
+    rows = main(["--path", path, "list", "RUNNING"])
+    assert [(row['saga_id'], row['user_id']) for row in rows] == [("s1", None)]
+    assert "1 sagas" in capsys.readouterr().out
+    # Solo lectura: el esquema del log queda como estaba
+    conn = sqlite3.connect(path)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(saga_state)")]
+    conn.close()
+    assert columns == ["saga_id", "state", "updated_at"]
+
+
+def test_cli_reads_a_live_log_without_writing_to_it(saga_log, tmp_path, capsys):
+    saga_id = run_saga(saga_log, "u1")
+    saga_log.flush()
+
+    status = main(["--path", saga_log.path, "saga", saga_id])
+    assert status['state'] == 'RUNNING'
+    assert saga_id in capsys.readouterr().out
+
+    missing = str(tmp_path / "missing.db")
+    with pytest.raises(FileNotFoundError):
+        main(["--path", missing, "list", "RUNNING"])
+    assert not os.path.exists(missing)
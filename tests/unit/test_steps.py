@@ -0,0 +1,35 @@
+from saga import steps
+from saga.steps import ProvisionUser, RpcStep
+import pytest
+
+
+def user_data(**extra):
+    return dict({"user": {"id": "u1", "name": "Ana", "email": "ana@example.com"},
+                 "fail": [False, False, False]}, **extra)
+
+
+def test_rollback_rpc_is_not_recorded_as_the_step_rpc(monkeypatch):
+    replies = iter([{'status': 'ok', 'id': 7, 'handler_time': 0.01},
+                    {'status': 'ok', 'handler_time': 0.02}])
+    monkeypatch.setattr(steps, "rpc_call", lambda event: next(replies))
+    metrics = steps.saga_metrics
+    metrics.reset()
+
+    step = ProvisionUser(data=user_data())
+    assert step.execute() == {"status": True}
+    step.rollback()
+
+    phases = metrics.data['step_timings']["ProvisionUser"]
+    assert phases['rpc_wait'].count == phases['handler'].count == 1
+    assert phases['rollback_rpc_wait'].count == phases['rollback_handler'].count == 1
+    assert phases['rollback_handler'].max == 0.02
+
+
+def test_rpc_step_subclass_must_build_and_handle_its_commands():
+    class Incomplete(RpcStep):
+        def command(self):
+            return {"type": "ProvisionUser", "data": {}}
+
+    # Sin handle_result ni los de rollback no se puede instanciar
+    with pytest.raises(TypeError, match="handle_result"):
+        Incomplete()
@@ -0,0 +1,79 @@
+from saga import message_broker
+from saga.clean_databases import clean
+from saga.db_pool import ConnectionManager
+from saga.initialize_databases import (initialize_database_by_type, database_types,
+                                      schema_version, MIGRATIONS)
+from saga.storage import Storage, write_accounts
+import sqlite3
+import pytest
+
+SINGLE = Storage("single")
+
+
+@pytest.fixture
+def broker_layout():
+    return SINGLE
+
+
+def account(user_id, failing_step=None):
+    # Mismo payload que arman demo.py y benchmark.py
+    fail = [False, False, False]
+    if failing_step is not None:
+        fail[failing_step] = True
+    return {"user": {"id": user_id, "name": "Ana", "email": "ana@example.com"},
+            "permissions": ["read"], "quota": {"storage_gb": 1, "ops_per_month": 10},
+            "fail": fail}
+
+
+def test_single_file_holds_every_table_with_foreign_keys(tmp_path):
+    initialize_database_by_type(database_types, str(tmp_path), SINGLE)
+    initialize_database_by_type(database_types, str(tmp_path), SINGLE)
+    assert [path.name for path in tmp_path.glob("*.db")] == ["saga.db"]
+
+    manager = ConnectionManager(str(tmp_path), storage=SINGLE)
+    try:
+        conn = manager.get("users")
+        assert manager.get("quotas") is conn
+        for db_type in database_types:
+            assert schema_version(conn, db_type) == len(MIGRATIONS[db_type])
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO quotas (user_id, storage_gb) VALUES ('nadie', 1)")
+    finally:
+        manager.close_all()
+
+
+def test_write_accounts_is_all_or_nothing(tmp_path, count):
+    initialize_database_by_type(database_types, str(tmp_path), SINGLE)
+    manager = ConnectionManager(str(tmp_path), storage=SINGLE)
+    try:
+        conn = manager.get("users")
+        write_accounts(conn, [account("u1")])
+        with pytest.raises(sqlite3.IntegrityError):
+            write_accounts(conn, [account("u2"), account("u1")])
+        assert [count(table, conn) for table in database_types] == [1, 1, 1]
+    finally:
+        manager.close_all()
+
+    clean(str(tmp_path), SINGLE)
+    conn = sqlite3.connect(str(tmp_path / "saga.db"))
+    assert [count(table, conn) for table in database_types] == [0, 0, 0]
+
+
+def test_account_batch_isolates_failures(broker_db, count):
+    message_broker.dispatch({"type": "ProvisionAccountBatch",
+                             "data": {"items": [account("u1")]}})
+    response = message_broker.dispatch({"type": "ProvisionAccountBatch", "data": {
+        "items": [account("u2"), account("u1"), account("u3", failing_step=2)]}})
+
+    statuses = [result['status'] for result in response['results']]
+    assert statuses == ['ok', 'error', 'error']
+    assert response['results'][0]['quota_id'] is not None
+    conn = broker_db.get("users")
+    assert [count(table, conn) for table in database_types] == [2, 2, 2]
+
+
+def test_account_batch_requires_single_file(monkeypatch):
+    monkeypatch.setattr(message_broker.connections, "storage", Storage("split"))
+    response = message_broker.dispatch({"type": "ProvisionAccountBatch",
+                                        "data": {"items": [account("u1")]}})
+    assert response['status'] == 'error'
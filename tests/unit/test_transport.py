@@ -0,0 +1,68 @@
+from saga.transport import AmqpTransport, InMemoryTransport
+import asyncio
+import pika
+import pytest
+import threading
+
+
+def echo(evt):
+    if evt['type'] == 'Slow':
+        threading.Event().wait(0.5)
+    return {'status': 'ok', 'type': evt['type'], 'data': evt['data']}
+
+
+def test_call_dispatches_through_the_queue():
+    transport = InMemoryTransport(workers=2, dispatch=echo)
+    response = transport.call({"type": "ProvisionUser", "data": {"id": "u1"}})
+    assert response == {'status': 'ok', 'type': 'ProvisionUser', 'data': {'id': 'u1'}}
+
+    responses = transport.call_many([{"type": "CreateQuota", "data": {"n": i}} for i in range(5)])
+    assert [r['data']['n'] for r in responses] == list(range(5))
+    transport.close()
+
+
+def test_call_returns_none_on_timeout():
+    transport = InMemoryTransport(workers=1, dispatch=echo)
+    assert transport.call({"type": "Slow", "data": {}}, timeout=0.05) is None
+    transport.close()
+
+
+def test_async_call_and_publish():
+    transport = InMemoryTransport(workers=1, dispatch=echo)
+
+    async def run():
+        response = await transport.call_async({"type": "AssignPermissions", "data": {}})
+        await transport.publish_async("saga_dlq", {"type": "FailedStep"})
+        return response
+
+    assert asyncio.run(run())['type'] == 'AssignPermissions'
+    assert transport.published["saga_dlq"] == [{"type": "FailedStep"}]
+    transport.close()
+
+
+class ConfirmingChannel:
+    """Canal con publisher confirms falso: el broker rechaza el mensaje `nack_at`"""
+
+    def __init__(self, nack_at=None):
+        self.nack_at = nack_at
+        self.bodies = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        if len(self.bodies) == self.nack_at:
+            raise pika.exceptions.NackError([body])
+        self.bodies.append(body)
+
+
+def test_amqp_publish_many_waits_for_the_confirm_of_each_message(monkeypatch):
+    transport = AmqpTransport()
+    channel = ConfirmingChannel()
+    monkeypatch.setattr(transport, "_publisher", lambda: channel)
+    transport.publish_many("saga_commands", [{"n": i} for i in range(3)])
+    assert [transport.codec.decode(body)["n"] for body in channel.bodies] == [0, 1, 2]
+
+    closed = []
+    monkeypatch.setattr(transport, "_publisher", lambda: ConfirmingChannel(nack_at=1))
+    monkeypatch.setattr(transport, "_close_publisher", lambda: closed.append(True))
+    with pytest.raises(pika.exceptions.NackError):
+        transport.publish_many("saga_commands", [{"n": i} for i in range(3)])
+    assert closed == [True]